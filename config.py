@@ -1,6 +1,9 @@
 import os
 from dotenv import load_dotenv
 
+# Максимум одновременных звонков: ограничение pjsua и размер пулов соединений
+MAX_CALLS = int(os.getenv('MAX_CALLS', '4'))
+
 class ConfigError(Exception):
     pass
 
@@ -15,7 +18,11 @@ def load_config():
         'DEEPGRAM_API_KEY': os.getenv('DEEPGRAM_API_KEY'),
         'ELEVENLABS_API_KEY': os.getenv('ELEVENLABS_API_KEY'),
     }
-    missing = [k for k, v in config.items() if not v and k not in ['SIP_PROXY']]
+    optional = ['SIP_PROXY']
+    if os.getenv('STT_BACKEND', 'deepgram') != 'deepgram':
+        # Офлайн-распознавание не требует ключа Deepgram
+        optional.append('DEEPGRAM_API_KEY')
+    missing = [k for k, v in config.items() if not v and k not in optional]
     if missing:
         raise ConfigError(f"Отсутствуют значения конфигурации: {', '.join(missing)}")
     return config
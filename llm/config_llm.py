@@ -1,4 +1,9 @@
 LLM="meta-llama/llama-4-maverick-17b-128e-instruct"
+# Резервная модель: страхующий запрос, если основная не ответила в срок
+FALLBACK_LLM="llama-3.3-70b-versatile"
+
+# Произносится, если ни одна модель не ответила
+ERROR_REPLY="Извините, не расслышал. Повторите, пожалуйста."
 
 SYSTEM_PROMPT = """
 Ты — Валентин, оператор фирмы по доставке корпоративного питания. Ты живой человек, отвечаешь по телефону ГОЛОСОМ — вежливо, чётко и ОЧЕНЬ ЛАКОНИЧНО (максимум 10 слов на вопрос).
@@ -0,0 +1,141 @@
+"""
+Контекст запроса к LLM в пределах бюджета токенов.
+
+История лида хранится между звонками, поэтому без ограничения каждый
+повторный звонок платил бы токенами и задержкой за все прошлые разговоры.
+В запрос идут системный промпт, краткое содержание старой части истории
+и последние сообщения целиком — столько, сколько помещается в
+CONTEXT_TOKEN_BUDGET. Краткое содержание считается после звонка, вне
+горячего пути (schedule_summary), и хранится рядом с историей лида.
+
+Токены оцениваются по длине текста: токенизатора модели Groq локально нет,
+а для бюджета достаточно оценки с запасом.
+"""
+
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+import metrics
+from llm.config_llm import LLM
+from llm.groq_client import get_groq_client
+from stt.io_loop import get_io_loop
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+# Сколько последних сообщений остаются дословно после сворачивания
+CONTEXT_KEEP_RECENT = int(os.getenv('CONTEXT_KEEP_RECENT', '8'))
+# Сворачивать, только если несвёрнутая старая часть длиннее (токенов)
+SUMMARY_MIN_TOKENS = int(os.getenv('CONTEXT_SUMMARY_MIN_TOKENS', '300'))
+SUMMARY_MODEL = os.getenv('CONTEXT_SUMMARY_MODEL', LLM)
+# Для русского текста токенайзеры Llama дают около трёх символов на токен
+CHARS_PER_TOKEN = 3.0
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = """Ты ведёшь заметки оператора по доставке корпоративного питания.
+Кратко, до 80 слов, перескажи разговоры с клиентом: какие ответы он уже дал
+(количество человек, сроки, адрес и т.д.), что осталось невыясненным, о чём договорились.
+Только факты из диалога, без вступлений. Если есть прежние заметки — дополни их."""
+
+
+def count_tokens(text: str) -> int:
+    """Оценка числа токенов текста"""
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    return count_tokens(str(message.get('content', ''))) + MESSAGE_OVERHEAD_TOKENS
+
+
+def _dialog_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    result = []
+    for msg in messages:
+        role = msg.get('role', '').lower()
+        content = str(msg.get('content', '')).strip()
+        if role in ['user', 'assistant'] and content:
+            result.append({"role": role, "content": content})
+    return result
+
+
+def build_context(system_prompt: str, messages: List[Dict[str, Any]], summary: Optional[str] = None,
+                  summary_covered: int = 0, budget: int = CONTEXT_TOKEN_BUDGET) -> List[Dict[str, str]]:
+    """
+    Собирает сообщения для запроса.
+
+    Args:
+        system_prompt: Системный промпт агента
+        messages: История лида вместе с новой репликой клиента
+        summary: Краткое содержание первых summary_covered сообщений
+        budget: Бюджет промпта (токенов)
+
+    Returns:
+        List[Dict[str, str]]: Сообщения для chat.completions
+    """
+    head = [{"role": "system", "content": system_prompt}]
+    if summary and summary_covered:
+        head.append({"role": "system", "content": f"Краткое содержание прошлых разговоров с клиентом:\n{summary}"})
+    else:
+        summary_covered = 0
+    used = sum(message_tokens(msg) for msg in head)
+
+    recent = _dialog_messages(messages[summary_covered:])
+    kept = []
+    for msg in reversed(recent):
+        tokens = message_tokens(msg)
+        # Последняя реплика клиента нужна всегда, даже сверх бюджета
+        if kept and used + tokens > budget:
+            break
+        kept.append(msg)
+        used += tokens
+    kept.reverse()
+
+    metrics.observe('llm.prompt_tokens', used)
+    if len(kept) < len(recent):
+        metrics.inc('context.dropped_messages', len(recent) - len(kept))
+    return head + kept
+
+
+def schedule_summary(history) -> None:
+    """
+    После звонка сворачивает в краткое содержание всё, кроме последних
+    CONTEXT_KEEP_RECENT сообщений. Запрос идёт в общем цикле ввода-вывода.
+
+    Args:
+        history: llm.dialog_history.DialogHistory лида
+    """
+    if history is None or not history.lead_id:
+        return
+    messages = history.snapshot()
+    covered = len(messages) - CONTEXT_KEEP_RECENT
+    start = history.summary_covered
+    if covered <= start:
+        return
+    pending = _dialog_messages(messages[start:covered])
+    if sum(message_tokens(msg) for msg in pending) < SUMMARY_MIN_TOKENS:
+        return
+
+    def on_done(future):
+        if not future.cancelled() and future.exception():
+            logging.error(f"[CONTEXT] Ошибка сворачивания истории лида {history.lead_id}: {future.exception()}")
+
+    get_io_loop().submit(_summarize(history, history.summary, pending, covered)).add_done_callback(on_done)
+
+
+async def _summarize(history, previous: Optional[str], pending: List[Dict[str, str]], covered: int) -> None:
+    dialog = '\n'.join(f"{'КЛИЕНТ' if m['role'] == 'user' else 'ОПЕРАТОР'}: {m['content']}" for m in pending)
+    content = f"Прежние заметки:\n{previous}\n\nНовый диалог:\n{dialog}" if previous else f"Диалог:\n{dialog}"
+    response = await get_groq_client().chat.completions.create(
+        model=SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": content},
+        ],
+        temperature=0.2,
+        max_tokens=300,
+    )
+    summary = (response.choices[0].message.content or '').strip()
+    if not summary:
+        return
+    await asyncio.get_running_loop().run_in_executor(None, history.set_summary, summary, covered)
+    logging.info(f"[CONTEXT] История лида {history.lead_id} свёрнута: {covered} сообщений, "
+                 f"{count_tokens(summary)} токенов в кратком содержании")
@@ -0,0 +1,274 @@
+"""
+История диалога с лидом.
+
+Во время звонка история хранится в памяти (DialogHistory), а на диск пишется
+журналом: каждое изменение — одна строка JSONL в lead_<id>_history.jsonl.
+Строки сразу уходят в ОС, а fsync выполняется пачками фоновым потоком раз
+в HISTORY_FSYNC_MS, поэтому реплика не ждёт диска. После звонка журнал
+сворачивается в снимок lead_<id>_history.json (прежний формат файла
+истории) и удаляется.
+
+Рядом хранится краткое содержание старой части истории
+(lead_<id>_summary.json, см. llm.context_window): summary покрывает первые
+summary_covered сообщений.
+
+Запись журнала — {"i": индекс, "msg": сообщение}: применение идемпотентно,
+так что журнал, оставшийся после сбоя во время сворачивания, безопасно
+наложить на уже обновлённый снимок.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+HISTORY_DIR = os.path.join(os.path.dirname(__file__), '..', 'dialog_history')
+HISTORY_FSYNC_MS = int(os.getenv('HISTORY_FSYNC_MS', '200'))
+
+
+class DialogHistory:
+    """Сообщения диалога с лидом; без lead_id — только в памяти"""
+
+    def __init__(self, lead_id: Optional[str] = None, directory: Optional[str] = None):
+        self.lead_id = lead_id
+        self.directory = directory or HISTORY_DIR
+        self.messages: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._journal = None
+        self._owners = set()  # звонки, открывшие историю
+        self.summary: Optional[str] = None
+        self.summary_covered = 0
+
+    @property
+    def snapshot_path(self) -> Optional[str]:
+        if not self.lead_id:
+            return None
+        return os.path.join(self.directory, f"lead_{self.lead_id}_history.json")
+
+    @property
+    def journal_path(self) -> Optional[str]:
+        if not self.lead_id:
+            return None
+        return os.path.join(self.directory, f"lead_{self.lead_id}_history.jsonl")
+
+    @property
+    def summary_path(self) -> Optional[str]:
+        if not self.lead_id:
+            return None
+        return os.path.join(self.directory, f"lead_{self.lead_id}_summary.json")
+
+    def load(self) -> "DialogHistory":
+        """Читает снимок и накладывает на него журнал"""
+        if not self.lead_id:
+            return self
+        messages = []
+        try:
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                    messages = json.load(f)
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            # Недописанная при сбое последняя строка
+                            continue
+                        _apply(messages, record['i'], record['msg'])
+            if os.path.exists(self.summary_path):
+                with open(self.summary_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.summary = data.get('summary')
+                self.summary_covered = min(int(data.get('covered', 0)), len(messages))
+        except Exception as e:
+            logging.error(f"[HISTORY] Ошибка загрузки истории для лида {self.lead_id}: {e}")
+        with self._lock:
+            self.messages = messages
+        logging.info(f"[HISTORY] Загружена история для лида {self.lead_id}: {len(messages)} сообщений")
+        return self
+
+    def set_summary(self, summary: str, covered: int) -> None:
+        """Сохраняет краткое содержание первых covered сообщений"""
+        with self._lock:
+            self.summary = summary
+            self.summary_covered = covered
+        if not self.lead_id:
+            return
+        try:
+            tmp_path = self.summary_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"summary": summary, "covered": covered}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.summary_path)
+        except Exception as e:
+            logging.error(f"[HISTORY] Ошибка сохранения краткого содержания для лида {self.lead_id}: {e}")
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """Копия сообщений"""
+        with self._lock:
+            return list(self.messages)
+
+    def append(self, *messages: Dict[str, Any]) -> None:
+        with self._lock:
+            for message in messages:
+                self.messages.append(message)
+                self._write(len(self.messages) - 1, message)
+
+    def replace_last(self, role: str, content: str, message: Dict[str, Any]) -> bool:
+        """
+        Заменяет последнее сообщение role с текстом content.
+
+        Returns:
+            bool: Найдено ли сообщение
+        """
+        with self._lock:
+            for index in range(len(self.messages) - 1, -1, -1):
+                msg = self.messages[index]
+                if msg.get('role') == role and msg.get('content') == content:
+                    self.messages[index] = message
+                    self._write(index, message)
+                    return True
+        return False
+
+    def _write(self, index: int, message: Dict[str, Any]) -> None:
+        if not self.lead_id:
+            return
+        try:
+            if self._journal is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            self._journal.write(json.dumps({"i": index, "msg": message}, ensure_ascii=False) + '\n')
+            self._journal.flush()
+            _flusher.mark_dirty(self)
+        except Exception as e:
+            logging.error(f"[HISTORY] Ошибка записи журнала для лида {self.lead_id}: {e}")
+
+    def sync(self) -> None:
+        """
+        fsync журнала (вызывается фоновым потоком). fsync идёт по копии
+        дескриптора и без блокировки, чтобы append() не ждал диска.
+        """
+        with self._lock:
+            if self._journal is None:
+                return
+            try:
+                fd = os.dup(self._journal.fileno())
+            except (OSError, ValueError) as e:
+                logging.error(f"[HISTORY] Ошибка fsync журнала для лида {self.lead_id}: {e}")
+                return
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            logging.error(f"[HISTORY] Ошибка fsync журнала для лида {self.lead_id}: {e}")
+        finally:
+            os.close(fd)
+
+    def compact(self) -> None:
+        """Сворачивает журнал в снимок и удаляет его"""
+        if not self.lead_id:
+            return
+        with self._lock:
+            if self._journal is None and not os.path.exists(self.journal_path):
+                return
+            messages = list(self.messages)
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            try:
+                tmp_path = self.snapshot_path + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(messages, f, ensure_ascii=False, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.snapshot_path)
+                os.remove(self.journal_path)
+                logging.info(f"[HISTORY] Сохранена история для лида {self.lead_id}: {len(messages)} сообщений")
+            except Exception as e:
+                # Журнал остаётся на диске и будет наложен при следующей загрузке
+                logging.error(f"[HISTORY] Ошибка сворачивания журнала для лида {self.lead_id}: {e}")
+
+
+def _apply(messages: List[Dict[str, Any]], index: int, message: Dict[str, Any]) -> None:
+    if index < len(messages):
+        messages[index] = message
+    else:
+        messages.append(message)
+
+
+class _Flusher:
+    """Фоновый fsync журналов, изменённых за последний интервал"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def mark_dirty(self, history: DialogHistory) -> None:
+        with self._lock:
+            self._dirty.add(history)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="history_fsync", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            # Копим изменения интервал, затем один fsync на журнал
+            time.sleep(self.interval)
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+            for history in dirty:
+                history.sync()
+
+
+_flusher = _Flusher(HISTORY_FSYNC_MS / 1000.0)
+_compact_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+_open: Dict[str, DialogHistory] = {}
+_open_lock = threading.Lock()
+
+
+def open_dialog_history(lead_id: Optional[str], owner) -> DialogHistory:
+    """
+    Возвращает историю лида для звонка owner, загружая её с диска при первом
+    открытии. Повторные звонки того же лида, пока история открыта, получают
+    тот же объект.
+    """
+    if not lead_id:
+        return DialogHistory()
+    with _open_lock:
+        history = _open.get(lead_id)
+        if history is None:
+            history = DialogHistory(lead_id).load()
+            _open[lead_id] = history
+        history._owners.add(owner)
+        return history
+
+
+def close_dialog_history(history: Optional[DialogHistory], owner) -> None:
+    """
+    Освобождает историю после звонка owner; последний звонок лида сворачивает
+    журнал в фоне. Повторное закрытие тем же звонком ничего не делает.
+    """
+    if history is None or not history.lead_id:
+        return
+    with _open_lock:
+        if owner not in history._owners:
+            return
+        history._owners.discard(owner)
+        if history._owners:
+            return
+    _compact_pool.submit(_compact_and_forget, history)
+
+
+def _compact_and_forget(history: DialogHistory) -> None:
+    history.compact()
+    with _open_lock:
+        # За время сворачивания лид мог позвонить снова
+        if not history._owners and _open.get(history.lead_id) is history:
+            del _open[history.lead_id]
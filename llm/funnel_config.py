@@ -15,7 +15,8 @@ FUNNEL_STAGES = [
         "questions": [
             {
                 "id": 724645, # адрес
-                "comment": "нужен город и точный адрес, если есть"
+                "comment": "нужен город и точный адрес, если есть",
+                "endpointing_ms": 900 # адрес диктуют с паузами
             },
             {
                 "id": 724671, # приём пищи
@@ -23,7 +24,8 @@ FUNNEL_STAGES = [
             },
             {
                 "id": 731375, # состав блюд
-                "comment": "спроси пожелания по типу блюд, если есть, например, первое/второе/салат..."
+                "comment": "спроси пожелания по типу блюд, если есть, например, первое/второе/салат...",
+                "endpointing_ms": 700
             },
             {
                 "id": 729891, # кто питается
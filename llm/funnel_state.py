@@ -0,0 +1,209 @@
+"""
+Состояние воронки в звонке.
+
+FunnelState знает, на какие вопросы клиент уже ответил и какой этап воронки
+идёт сейчас. В системный промпт попадают только открытые вопросы текущего
+этапа (с вариантами ответов из CRM), а не все вопросы всех этапов.
+
+После каждой реплики FunnelTracker в фоне, пока звучит ответ агента,
+спрашивает быструю модель, на какие вопросы клиент ответил и какой вопрос
+задал агент. Когда все вопросы этапа закрыты, сделка в AmoCRM переводится
+в следующий статус (STAGE_STATUS_IDS[1..3]) — прогресс виден в CRM сразу.
+Заданный вопрос становится session.current_question_id (им пользуется
+локальный детектор конца реплики).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import metrics
+from crm.status_config import STAGE_STATUS_IDS
+from llm.groq_client import get_groq_client
+
+FUNNEL_TRACKER_MODEL = os.getenv('FUNNEL_TRACKER_MODEL', 'llama-3.1-8b-instant')
+FUNNEL_TRACKING = os.getenv('FUNNEL_TRACKING', '1') != '0'
+
+# Обновление статуса сделки — синхронный HTTP-запрос, вне цикла ввода-вывода
+_crm_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="funnel_crm")
+
+
+def _question_line(question: Dict[str, Any]) -> str:
+    line = f"- {question.get('name', '')}"
+    enums = [e.get('value') for e in (question.get('enums') or []) if e.get('value')]
+    if enums:
+        line += f" (варианты: {', '.join(enums)})"
+    if question.get('comment'):
+        line += f" — {question['comment']}"
+    return line
+
+
+class FunnelState:
+    def __init__(self, stages: List[Dict[str, Any]]):
+        self.stages = stages
+        self.answered: Set[int] = set()
+        self.stage_index = 0
+        self.current_question_id: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_lead(cls, stages: List[Dict[str, Any]], lead: Optional[Dict[str, Any]]) -> "FunnelState":
+        """
+        Состояние с учётом того, что уже известно по сделке: заполненные поля
+        считаются отвеченными, а статус сделки — пройденными этапами.
+        """
+        state = cls(stages)
+        if not lead:
+            return state
+        filled = [f.get('field_id') for f in (lead.get('custom_fields_values') or []) if f.get('values')]
+        status_id = lead.get('status_id')
+        if status_id in STAGE_STATUS_IDS:
+            # Статус STAGE_STATUS_IDS[k] означает, что пройдены первые k этапов
+            for stage in stages[:STAGE_STATUS_IDS.index(status_id)]:
+                filled.extend(q.get('id') for q in stage['questions'])
+        state.mark_answered(filled)
+        return state
+
+    @property
+    def complete(self) -> bool:
+        return self.stage_index >= len(self.stages)
+
+    def open_questions(self) -> List[Dict[str, Any]]:
+        """Неотвеченные вопросы текущего этапа"""
+        with self._lock:
+            if self.complete:
+                return []
+            return [q for q in self.stages[self.stage_index]['questions'] if q.get('id') not in self.answered]
+
+    def mark_answered(self, question_ids: Iterable[int]) -> List[int]:
+        """
+        Отмечает вопросы отвеченными и переходит к следующему незакрытому этапу.
+
+        Returns:
+            List[int]: Индексы этапов, закрытых этим вызовом
+        """
+        completed = []
+        with self._lock:
+            self.answered.update(q for q in question_ids if q)
+            while not self.complete and all(q.get('id') in self.answered
+                                            for q in self.stages[self.stage_index]['questions']):
+                completed.append(self.stage_index)
+                self.stage_index += 1
+        return completed
+
+    def key(self) -> str:
+        """Компактный ключ состояния (этап и отвеченные вопросы)"""
+        with self._lock:
+            return f"{self.stage_index}:{','.join(str(q) for q in sorted(self.answered))}"
+
+    def prompt_section(self) -> str:
+        """Часть системного промпта с вопросами текущего этапа"""
+        questions = self.open_questions()
+        if not questions:
+            return ("[Вопросы для пользователя:]\n- вопросов больше нет: попрощайся и скажи, "
+                    "что с клиентом свяжутся в ближайшее время")
+        stage = self.stages[self.stage_index]
+        lines = '\n'.join(_question_line(q) for q in questions)
+        return f"[Этап: {stage['name']}]\n[Вопросы для пользователя:]\n{lines}"
+
+
+TRACKER_PROMPT = """Ты отслеживаешь ход телефонного разговора оператора с клиентом по анкете.
+Даны открытые вопросы анкеты с их ID, последняя реплика клиента и ответ оператора.
+Верни ТОЛЬКО JSON: {"answered": [ID вопросов, на которые клиент в этой реплике дал чёткий ответ],
+"asked": ID вопроса, который оператор задал в своём ответе, или null}.
+Не отмечай вопрос отвеченным, если ответ неясный или оператор переспрашивает."""
+
+
+class FunnelTracker:
+    def __init__(self, model: str = FUNNEL_TRACKER_MODEL):
+        self.model = model
+        # Цикл держит задачи только по слабым ссылкам: храним их до завершения
+        self._tasks: Set[asyncio.Future] = set()
+
+    async def update(self, session, user_text: str, reply_text: str) -> None:
+        """Обновляет состояние воронки звонка по завершённой реплике"""
+        state: FunnelState = session.funnel
+        questions = state.open_questions() if state else []
+        if not questions:
+            return
+        listing = '\n'.join(f"{q.get('id')}: {q.get('name', '')}" for q in questions)
+        response = await get_groq_client().chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": TRACKER_PROMPT},
+                {"role": "user", "content": f"Вопросы:\n{listing}\n\nКлиент: {user_text}\nОператор: {reply_text}"},
+            ],
+            response_format={"type": "json_object"},
+            temperature=0,
+            max_tokens=100,
+        )
+        try:
+            result = json.loads(response.choices[0].message.content)
+        except (json.JSONDecodeError, TypeError):
+            logging.warning(f"[FUNNEL] Неверный JSON от модели: {response.choices[0].message.content}")
+            return
+        open_ids = {q.get('id') for q in questions}
+        answered = [_to_int(q) for q in result.get('answered') or []]
+        answered = [q for q in answered if q in open_ids]
+        asked = _to_int(result.get('asked'))
+
+        completed = state.mark_answered(answered)
+        if answered:
+            metrics.inc('funnel.answered', len(answered))
+            logging.info(f"[FUNNEL] Звонок {session.call_id}: отвечены вопросы {answered}")
+        remaining = {q.get('id') for q in state.open_questions()}
+        state.current_question_id = asked if asked in remaining else None
+        session.current_question_id = state.current_question_id
+        for stage_index in completed:
+            self._advance_status(session.lead_id, stage_index)
+
+    def _advance_status(self, lead_id, stage_index: int) -> None:
+        stage_status = stage_index + 1
+        if not lead_id or stage_status >= len(STAGE_STATUS_IDS):
+            return
+        status_id = STAGE_STATUS_IDS[stage_status]
+        metrics.inc('funnel.stages_completed')
+        logging.info(f"[FUNNEL] Лид {lead_id}: этап {stage_index + 1} пройден, статус {status_id}")
+
+        def update():
+            from crm.crm_api import AmoCRMClient
+            try:
+                status, _ = AmoCRMClient().update_lead_status(lead_id, status_id)
+                logging.info(f"[CRM] Статус сделки обновлён: {status}")
+            except Exception as e:
+                logging.error(f"[CRM] Ошибка обновления статуса сделки {lead_id}: {e}")
+        _crm_pool.submit(update)
+
+    def schedule(self, session, user_text: str, reply_text: str) -> None:
+        """Запускает обновление в фоне (в цикле ввода-вывода)"""
+        if not FUNNEL_TRACKING or session.funnel is None:
+            return
+
+        def on_done(task):
+            self._tasks.discard(task)
+            if not task.cancelled() and task.exception():
+                logging.warning(f"[FUNNEL] Не удалось обновить состояние воронки: {task.exception()}")
+        task = asyncio.ensure_future(self.update(session, user_text, reply_text))
+        self._tasks.add(task)
+        task.add_done_callback(on_done)
+
+
+def _to_int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+_tracker: Optional[FunnelTracker] = None
+
+
+def get_funnel_tracker() -> FunnelTracker:
+    global _tracker
+    if _tracker is None:
+        _tracker = FunnelTracker()
+    return _tracker
@@ -1,33 +1,47 @@
 import asyncio
-import json
 import logging
 import os
 import time
-from typing import List, Dict, Any, Optional
+import wave
+from contextlib import aclosing
+from typing import AsyncIterator, List, Dict, Any, Optional
 
-from groq import Groq
-from llm.config_llm import SYSTEM_PROMPT, LLM
+from llm.config_llm import SYSTEM_PROMPT, LLM, FALLBACK_LLM, ERROR_REPLY
+from llm.groq_client import get_groq_client
+from llm.dialog_history import DialogHistory, open_dialog_history
+from llm.context_window import build_context
+from llm.funnel_state import get_funnel_tracker
+from llm.response_cache import ResponseCache, get_response_cache
+from llm.hedging import hedged_stream
 from crm.crm_api import load_enriched_funnel_config
-from sip.utils import get_active_lead_id
-from tts.elevenlabs_tts import text_to_speech_async
+from sip.session import get_session
+from stt.io_loop import get_io_loop
+from llm.speculation import Speculation
+from llm.sentence_splitter import SentenceSplitter
+import metrics
+from tts.elevenlabs_tts import text_to_speech_async, text_to_speech_stream_async
 
 logging.basicConfig(level=logging.INFO)
 
+# Генерировать ответ по финальным фрагментам, не дожидаясь конца реплики
+SPECULATIVE_LLM = os.getenv('SPECULATIVE_LLM', '1') != '0'
+# Получать ответ потоком и отдавать в TTS по предложениям
+STREAMING_LLM = os.getenv('STREAMING_LLM', '1') != '0'
+
 _llm_agent_instance = None
 
 class GroqAgent:
-    def __init__(self, instructions=SYSTEM_PROMPT, model=LLM):
-        self.client = Groq()
+    def __init__(self, instructions=SYSTEM_PROMPT, model=LLM, fallback_model=FALLBACK_LLM):
+        self.client = get_groq_client()
         self.funnel_stages = load_enriched_funnel_config()
+        self.instructions = instructions
         questions = self.get_all_questions()
         questions_text = '\n'.join(f'- {q}' for q in questions) if questions else '- нет вопросов'
+        # Полный список вопросов — только для звонков без состояния воронки
         self.system_prompt = f"{instructions}\n\n[Вопросы для пользователя:]\n{questions_text}"
         self.model = model
-        self.lock = asyncio.Lock()
-        self.llm_busy = False
-        self.history_dir = os.path.join(os.path.dirname(__file__), '..', 'dialog_history')
-        os.makedirs(self.history_dir, exist_ok=True)
-        logging.info(f"[GROQ] Агент инициализирован с моделью {self.model}")
+        self.fallback_model = fallback_model
+        logging.info(f"[GROQ] Агент инициализирован с моделью {self.model} (резервная {self.fallback_model})")
 
     def get_all_questions(self) -> List[str]:
         questions = []
@@ -36,125 +50,311 @@ class GroqAgent:
                 questions.append(q.get('name', ''))
         return questions
 
-    def _get_history_file_path(self, lead_id: Optional[str]) -> Optional[str]:
-        if not lead_id:
-            return None
-        return os.path.join(self.history_dir, f"lead_{lead_id}_history.json")
+    @staticmethod
+    def _history(session) -> DialogHistory:
+        """История лида звонка (открывается при ответе на звонок, см. sip.account)"""
+        if session.history is None:
+            session.history = open_dialog_history(session.lead_id, session)
+        return session.history
 
-    def _load_history(self, lead_id: Optional[str]) -> List[Dict[str, Any]]:
-        if not lead_id:
-            return []
-        
-        history_file = self._get_history_file_path(lead_id)
-        if not history_file or not os.path.exists(history_file):
-            return []
+    def _system_prompt(self, session) -> str:
+        """Инструкции и открытые вопросы текущего этапа воронки"""
+        if session.funnel is None:
+            return self.system_prompt
+        return f"{self.instructions}\n\n{session.funnel.prompt_section()}"
+
+    def _build_messages(self, session, user_text: str) -> List[Dict[str, str]]:
+        """Промпт с краткой историей прошлых звонков и последними репликами в пределах бюджета"""
+        history = self._history(session)
+        messages = history.snapshot()
+        messages.append({"role": "user", "content": user_text})
+        return build_context(self._system_prompt(session), messages, history.summary, history.summary_covered)
+
+    async def process_async(self, user_text: str, call_id: Optional[int] = None) -> str:
+        session = get_session(call_id)
+        if not session:
+            logging.warning(f"[GROQ] Сессия звонка {call_id} не найдена")
+            return ""
         
-        try:
-            with open(history_file, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-                logging.info(f"[GROQ] Загружена история для лида {lead_id}: {len(history)} сообщений")
-                return history
-        except Exception as e:
-            logging.error(f"[GROQ] Ошибка загрузки истории для лида {lead_id}: {e}")
-            return []
-
-    def _save_history(self, lead_id: Optional[str], history: List[Dict[str, Any]]) -> None:
+        lead_id = session.lead_id
         if not lead_id:
-            return
+            logging.warning(f"[GROQ] Не удалось получить ID лида для звонка {call_id}")
         
-        history_file = self._get_history_file_path(lead_id)
-        if not history_file:
-            return
-            
+        # Реплики одного звонка приходят сюда по очереди (llm.turn_queue);
+        # флаг нужен, чтобы не запускать спекуляцию во время ответа
+        session.llm_busy = True
+        turn = session.start_turn(user_text)
+        turn.cache_key = ResponseCache.key_for(session, user_text)
         try:
-            with open(history_file, 'w', encoding='utf-8') as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
-                logging.info(f"[GROQ] Сохранена история для лида {lead_id}: {len(history)} сообщений")
-        except Exception as e:
-            logging.error(f"[GROQ] Ошибка сохранения истории для лида {lead_id}: {e}")
-
-    def _format_history_for_groq(self, history: List[Dict[str, Any]]) -> List[Dict[str, str]]:
-        groq_messages = [{"role": "system", "content": self.system_prompt}]
-        
-        for msg in history:
-            role = msg.get('role', '').lower()
-            content = str(msg.get('content', '')).strip()
+            history = self._history(session)
+            user_message = {"role": "user", "content": user_text}
+            groq_messages = self._build_messages(session, user_text)
             
-            if role in ['user', 'assistant'] and content:
-                groq_messages.append({"role": role, "content": content})
-        
-        return groq_messages
-
-    async def process_async(self, user_text: str) -> str:
-        if self.llm_busy:
-            return "[GROQ] Пожалуйста, дождитесь ответа на предыдущий вопрос."
-        
-        lead_id = get_active_lead_id()
-        if not lead_id:
-            logging.warning("[GROQ] Не удалось получить ID активного лида")
-        
-        async with self.lock:
-            self.llm_busy = True
             try:
-                history = self._load_history(lead_id) if lead_id else []
-                history.append({"role": "user", "content": user_text})
-                groq_messages = self._format_history_for_groq(history)
-                
+                # Ответ генерируется отдельной задачей: перебивание отменяет её
+                # вместе с запросами к LLM, не затрагивая очередь реплик звонка
+                reply_task = turn.track(asyncio.ensure_future(
+                    self._reply_for(session, user_text, groq_messages, turn)))
                 try:
-                    response = self.client.chat.completions.create(
-                        model=self.model,
-                        messages=groq_messages,
-                        temperature=0.7,
-                        max_tokens=1024
-                    )
-                    
-                    full_reply = response.choices[0].message.content
-                    
-                    # Отправляем реплику в TTS и на воспроизведение
-                    self._send_to_tts_and_play(full_reply)
-                    
-                    history.append({"role": "assistant", "content": full_reply})
-                    self._save_history(lead_id, history)
-                    self._log_conversation_history(history, lead_id)
-                    
-                    return full_reply
-                    
-                except Exception as e:
-                    logging.error(f"[GROQ] Ошибка при обращении к API: {str(e)}", exc_info=True)
-                    return f"Произошла ошибка при обработке запроса: {str(e)}"
-                    
-            finally:
-                self.llm_busy = False
-
-    def _log_conversation_history(self, history: List[Dict[str, Any]], lead_id: Optional[str]) -> None:
-        log_lines = [f"\n========== ИСТОРИЯ ДИАЛОГА ЛИДА {lead_id or 'UNKNOWN'} =========="]
-        for msg in history:
-            role = msg.get('role', 'unknown').upper()
-            content = str(msg.get('content', '')).strip()
-            log_lines.append(f"[{role}] {content}")
-        log_lines.append("========== КОНЕЦ ИСТОРИИ ==========")
-        logging.info("\n".join(log_lines))
-
-    def _send_to_tts_and_play(self, text: str) -> None:
+                    full_reply = await reply_task
+                except asyncio.CancelledError:
+                    if not turn.cancelled.is_set():
+                        raise
+                    full_reply = turn.spoken_text
+                
+                with turn.lock:
+                    turn.llm_done = True
+                    if turn.cancelled.is_set():
+                        # Клиент перебил, пока генерировался ответ: сохраняем его слова
+                        # и то, что из начала ответа он успел услышать
+                        logging.info(f"[GROQ] Ответ отброшен: клиент перебил агента (звонок {call_id})")
+                        if turn.heard_text is not None:
+                            history.append(user_message, {
+                                "role": "assistant",
+                                "content": f"{turn.heard_text}..." if turn.heard_text else "",
+                                "full_content": turn.spoken_text,
+                                "interrupted": True,
+                            })
+                        else:
+                            history.append(user_message)
+                        get_funnel_tracker().schedule(session, user_text, turn.heard_text or "")
+                        return ""
+                    assistant_message = {"role": "assistant", "content": full_reply}
+                    history.append(user_message, assistant_message)
+                    turn.reply_text = full_reply
+                self._cache_reply(turn)
+                self._log_turn(lead_id, [user_message, assistant_message])
+                # Пока звучит ответ, в фоне отмечаем отвеченные вопросы воронки
+                get_funnel_tracker().schedule(session, user_text, full_reply)
+                
+                return full_reply
+                
+            except Exception as e:
+                logging.error(f"[GROQ] Ошибка при обращении к API: {str(e)}", exc_info=True)
+                # Текст ошибки не озвучивается: клиент слышит короткую просьбу повторить
+                self._recover_from_error(session, turn, user_message)
+                return ""
+                
+        finally:
+            session.llm_busy = False
+
+    def _recover_from_error(self, session, turn, user_message: Dict[str, str]) -> None:
         """
-        Отправляет текст в TTS и добавляет аудиофайл в очередь для воспроизведения
+        Ни одна модель не ответила (или ответ оборвался). Текст ошибки не
+        озвучивается: если клиент ещё ничего не услышал, он слышит короткую
+        просьбу повторить, а в историю попадает то, что было сказано.
         """
+        with turn.lock:
+            turn.llm_done = True
+            turn.cache_key = None
+            cancelled = turn.cancelled.is_set()
+            spoken = turn.spoken_text
+        if cancelled:
+            self._history(session).append(user_message)
+            return
+        if not spoken:
+            self._speak_segment(ERROR_REPLY, session.call_id, turn)
+            spoken = ERROR_REPLY
+        with turn.lock:
+            turn.reply_text = spoken
+        self._history(session).append(user_message, {"role": "assistant", "content": spoken})
+
+    async def _complete(self, groq_messages: List[Dict[str, str]]) -> str:
+        return ''.join([delta async for delta in self._stream(groq_messages)])
+
+    def _stream(self, groq_messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+        """Токены ответа по мере генерации; медленный ответ страхуется резервной моделью"""
+        return hedged_stream(self.client, groq_messages, self.model, self.fallback_model,
+                             temperature=0.7, max_tokens=1024)
+
+    async def _reply_for(self, session, user_text: str, groq_messages: List[Dict[str, str]], turn) -> str:
+        """
+        Получает ответ и озвучивает его по фрагментам по мере готовности.
+        Берёт ответ спекуляции, если она шла по этой же реплике, иначе
+        запрашивает LLM (потоково, если включено STREAMING_LLM).
+
+        Returns:
+            str: Озвученный текст ответа
+        """
+        speculation = session.speculation
+        session.speculation = None
+        cached = get_response_cache().get(turn.cache_key)
+        if cached is not None:
+            # Готовый ответ с озвучкой: без LLM и TTS
+            if speculation:
+                speculation.cancel()
+            turn.cache_key = None
+            logging.info(f"[CACHE] Ответ из кэша (звонок {session.call_id}, "
+                         f"доля попаданий {get_response_cache().hit_rate():.0%})")
+            for text, pcm in cached:
+                self._speak_segment(text, session.call_id, turn, pcm)
+            return turn.spoken_text
+        reply = None
+        if speculation:
+            turn.track(speculation.task)
+            reply = await speculation.take(user_text)
+            if turn.cancelled.is_set():
+                return turn.spoken_text
+        if reply is None and not STREAMING_LLM:
+            reply = await self._complete(groq_messages)
+
+        splitter = SentenceSplitter()
+        if reply is not None:
+            segments = splitter.feed(reply)
+        else:
+            segments = []
+            async with aclosing(self._stream(groq_messages)) as stream:
+                async for delta in stream:
+                    for segment in splitter.feed(delta):
+                        self._speak_segment(segment, session.call_id, turn)
+                    if turn.cancelled.is_set():
+                        return turn.spoken_text
+        tail = splitter.flush()
+        for segment in segments + ([tail] if tail else []):
+            self._speak_segment(segment, session.call_id, turn)
+        return turn.spoken_text
+
+    def speculate(self, user_text: str, call_id: Optional[int] = None) -> None:
+        """
+        Начинает генерацию ответа по ещё не законченной реплике.
+        Вызывается из цикла ввода-вывода STT при каждом финальном фрагменте.
+        """
+        if not SPECULATIVE_LLM or not user_text:
+            return
+        session = get_session(call_id)
+        if not session or session.llm_busy:
+            return
+        previous = session.speculation
+        if previous and previous.matches(user_text):
+            return
+        if previous:
+            previous.cancel()
+        groq_messages = self._build_messages(session, user_text)
+        task = asyncio.ensure_future(self._complete(groq_messages))
+        session.speculation = Speculation(user_text, task)
+
+    def record_interrupted_reply(self, session, reply_text: Optional[str], heard_ratio: float) -> None:
+        """
+        Заменяет в истории прерванный ответ агента на услышанную клиентом часть,
+        чтобы LLM знала, что клиент на самом деле услышал.
+        """
+        if not reply_text:
+            return
+        heard_text = self._cut_heard_text(reply_text, heard_ratio)
+        replaced = self._history(session).replace_last('assistant', reply_text, {
+            "role": "assistant",
+            "content": f"{heard_text}..." if heard_text else "",
+            "full_content": reply_text,
+            "interrupted": True,
+            "heard_ratio": round(heard_ratio, 2),
+        })
+        if replaced:
+            logging.info(f"[GROQ] Ответ прерван клиентом, услышано: '{heard_text}'")
+
+    @staticmethod
+    def _cut_heard_text(text: str, heard_ratio: float) -> str:
+        """Обрезает текст до услышанной доли по границе слова"""
+        cut = int(len(text) * max(0.0, min(1.0, heard_ratio)))
+        if cut >= len(text):
+            return text
+        head = text[:cut]
+        if ' ' in head:
+            head = head[:head.rfind(' ')]
+        return head.strip()
+
+    @staticmethod
+    def _log_turn(lead_id: Optional[str], messages: List[Dict[str, Any]]) -> None:
+        # Только новые сообщения: полная история пишется в лог один раз, при постобработке
+        for msg in messages:
+            logging.info(f"[DIALOG {lead_id or 'UNKNOWN'}] [{msg.get('role', 'unknown').upper()}] "
+                         f"{str(msg.get('content', '')).strip()}")
+
+    def _speak_segment(self, text: str, call_id: Optional[int], turn, pcm: Optional[bytes] = None) -> None:
+        """
+        Отправляет фрагмент ответа в потоковый TTS и ставит его в плейлист
+        звонка. Фрагменты синтезируются параллельно, а звучат по порядку:
+        клип занимает место в плейлисте в момент вызова. Если поток не удался,
+        фрагмент синтезируется в файл и дописывается в тот же клип.
+        Готовый PCM (из кэша ответов) ставится в плейлист без синтеза.
+        """
+        session = get_session(call_id)
+        if not session:
+            logging.warning(f"[TTS] Звонок {call_id} завершен, ответ не воспроизводится")
+            return
+        with turn.lock:
+            if turn.cancelled.is_set():
+                return
+            if not turn.segments:
+                metrics.observe('llm.first_segment_ms', (time.time() - turn.started_at) * 1000)
+            index = len(turn.segments)
+            clip = session.playlist.open_stream(label=f"turn_{turn.turn_id}_{index}")
+            turn.segments.append((text, clip))
+        if pcm is not None:
+            clip.write(pcm)
+            clip.close()
+            return
         logging.info(f"[GROQ->TTS] Отправляем в TTS: {text}")
-        
-        def tts_callback(audio_filepath: Optional[str]) -> None:
-            if audio_filepath and os.path.exists(audio_filepath):
-                logging.info(f"[TTS] Аудиофайл готов: {audio_filepath}")
-                # Добавляем файл в очередь воспроизведения (безопасно из любого потока)
-                from sip.audio_player import queue_audio_for_playback
-                queue_audio_for_playback(audio_filepath)
-                logging.info(f"[TTS] Файл добавлен в очередь: {os.path.basename(audio_filepath)}")
-            else:
-                logging.error("[TTS] Не удалось создать аудиофайл")
-        
-        # Асинхронно создаем аудио и добавляем в очередь
-        text_to_speech_async(text, tts_callback)
+        cancel_event = turn.cancelled
+        # Озвучка копится для кэша ответов, если реплику можно кэшировать
+        chunks = [] if turn.cache_key is not None else None
+
+        def on_chunk(data: bytes) -> None:
+            clip.write(data)
+            if chunks is not None:
+                chunks.append(data)
+
+        def on_done(ok: bool) -> None:
+            if ok or clip.written or cancel_event.is_set():
+                clip.close()
+                if ok and chunks is not None:
+                    turn.segment_audio[index] = b''.join(chunks)
+                    self._cache_reply(turn)
+                return
+            logging.warning("[TTS] Потоковый синтез не удался, пробуем через файл")
+            text_to_speech_async(text, lambda path: self._fill_clip_from_file(session, clip, path, cancel_event))
 
-    def process(self, user_text: str):
+        text_to_speech_stream_async(text, on_chunk, on_done, cancel_event=cancel_event,
+                                    on_cancel=turn.on_cancel)
+
+    @staticmethod
+    def _cache_reply(turn) -> None:
+        """Кладёт ответ в кэш, когда он сохранён в историю и озвучен целиком"""
+        with turn.lock:
+            key = turn.cache_key
+            if (key is None or turn.reply_text is None or turn.cancelled.is_set()
+                    or not turn.segments or len(turn.segment_audio) < len(turn.segments)):
+                return
+            turn.cache_key = None
+            segments = [(text, turn.segment_audio[i]) for i, (text, _) in enumerate(turn.segments)]
+        get_response_cache().put(key, segments)
+
+    @staticmethod
+    def _fill_clip_from_file(session, clip, audio_filepath: Optional[str], cancel_event) -> None:
+        """Дописывает в клип звук из файла TTS, сохраняя порядок фрагментов"""
+        if cancel_event.is_set():
+            clip.close()
+            logging.info("[TTS] Реплика отменена, файл не воспроизводится")
+            return
+        if not audio_filepath or not os.path.exists(audio_filepath):
+            clip.close()
+            logging.error("[TTS] Не удалось создать аудиофайл")
+            return
+        try:
+            with wave.open(audio_filepath, 'rb') as wav:
+                if (wav.getnchannels() != 1 or wav.getsampwidth() != 2
+                        or wav.getframerate() != session.playlist.clock_rate):
+                    raise wave.Error('формат не совпадает с портом')
+                clip.write(wav.readframes(wav.getnframes()))
+            clip.close()
+            logging.info(f"[TTS] Аудиофайл готов: {audio_filepath}")
+        except (wave.Error, EOFError):
+            # Файл не в формате порта (например, MP3 без ffmpeg): играет плеер pjsua,
+            # уже после фрагментов, поставленных раньше
+            clip.close()
+            session.playlist.enqueue_file(audio_filepath)
+            logging.info(f"[TTS] Файл добавлен в очередь: {os.path.basename(audio_filepath)}")
+
+    def process(self, user_text: str, call_id: Optional[int] = None):
         loop = None
         try:
             loop = asyncio.get_running_loop()
@@ -162,9 +362,10 @@ class GroqAgent:
             pass
             
         if loop and loop.is_running():
-            return asyncio.create_task(self.process_async(user_text))
+            return asyncio.create_task(self.process_async(user_text, call_id))
         else:
-            return asyncio.run(self.process_async(user_text))
+            # Клиент Groq работает в общем цикле ввода-вывода, не в новом
+            return get_io_loop().submit(self.process_async(user_text, call_id)).result()
 
 
 # Глобальные функции для совместимости
@@ -177,12 +378,16 @@ def get_llm_agent():
         _llm_agent_instance = GroqAgent()
     return _llm_agent_instance
 
-async def process_transcript_async(transcript: str) -> str:
-    """Асинхронная обработка транскрипта"""
+def speculate_transcript(transcript: str, call_id: Optional[int] = None) -> None:
+    """Спекулятивно начинает ответ на незавершённую реплику звонка"""
+    get_llm_agent().speculate(transcript, call_id)
+
+async def process_transcript_async(transcript: str, call_id: Optional[int] = None) -> str:
+    """Асинхронная обработка транскрипта звонка"""
     agent = get_llm_agent()
-    return await agent.process_async(transcript)
+    return await agent.process_async(transcript, call_id)
 
-def process_transcript(transcript: str):
+def process_transcript(transcript: str, call_id: Optional[int] = None):
     """Синхронная обработка транскрипта"""
     loop = None
     try:
@@ -191,6 +396,6 @@ def process_transcript(transcript: str):
         pass
         
     if loop and loop.is_running():
-        return asyncio.create_task(process_transcript_async(transcript))
+        return asyncio.create_task(process_transcript_async(transcript, call_id))
     else:
-        return asyncio.run(process_transcript_async(transcript))
+        return get_io_loop().submit(process_transcript_async(transcript, call_id)).result()
@@ -0,0 +1,42 @@
+"""
+Общий асинхронный клиент Groq.
+
+Один AsyncGroq с пулом постоянных HTTP-соединений на весь процесс: реплики
+всех звонков и постобработка завершённых звонков идут через него
+одновременно, не блокируя цикл и без TLS-рукопожатия на каждый запрос.
+Пул соединений httpx привязан к циклу, в котором используется, поэтому
+запросы выполняются только в общем цикле ввода-вывода (stt.io_loop).
+"""
+
+import os
+import threading
+from typing import Optional
+
+import httpx
+from groq import AsyncGroq, DefaultAsyncHttpxClient
+
+GROQ_MAX_CONNECTIONS = int(os.getenv('GROQ_MAX_CONNECTIONS', '20'))
+# Сколько держать простаивающее соединение открытым (секунды)
+GROQ_KEEPALIVE_EXPIRY = float(os.getenv('GROQ_KEEPALIVE_EXPIRY', '120'))
+GROQ_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+
+_client: Optional[AsyncGroq] = None
+_client_lock = threading.Lock()
+
+
+def get_groq_client() -> AsyncGroq:
+    """Глобальный асинхронный клиент Groq"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = AsyncGroq(
+                timeout=GROQ_TIMEOUT,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=GROQ_MAX_CONNECTIONS,
+                        max_keepalive_connections=GROQ_MAX_CONNECTIONS,
+                        keepalive_expiry=GROQ_KEEPALIVE_EXPIRY,
+                    ),
+                ),
+            )
+        return _client
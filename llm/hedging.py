@@ -0,0 +1,131 @@
+"""
+Страхующие (hedged) запросы к LLM.
+
+Запрос уходит основной модели. Если первый токен не пришёл за бюджет
+времени — p95 времени до первого токена этой модели по последним запросам —
+или запрос завершился ошибкой, параллельно отправляется запрос резервной
+модели. Ответ берётся у той, что первой выдала токен; второй запрос
+отменяется. Время до первого токена каждой модели пишется в гистограмму
+llm.ttft_ms.<модель>, по ней же считается бюджет. Для запроса, отменённого
+до первого токена, в гистограмму пишется прошедшее время (не меньше бюджета),
+иначе она видела бы только быстрые запросы и бюджет сползал бы к минимуму.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import metrics
+
+HEDGE_LLM = os.getenv('HEDGE_LLM', '1') != '0'
+# Бюджет до первого токена, пока статистики мало, и его границы (мс)
+HEDGE_DEFAULT_MS = float(os.getenv('HEDGE_DEFAULT_MS', '1500'))
+HEDGE_MIN_MS = float(os.getenv('HEDGE_MIN_MS', '300'))
+HEDGE_MAX_MS = float(os.getenv('HEDGE_MAX_MS', '4000'))
+HEDGE_MIN_SAMPLES = 20
+
+
+def ttft_metric(model: str) -> str:
+    return f'llm.ttft_ms.{model}'
+
+
+def ttft_budget_ms(model: str) -> float:
+    """Сколько ждать первого токена модели, прежде чем страховать запрос"""
+    name = ttft_metric(model)
+    if metrics.histogram_count(name) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_MS
+    return max(HEDGE_MIN_MS, min(HEDGE_MAX_MS, metrics.percentile(name, 95)))
+
+
+async def _model_stream(client, model: str, messages: List[Dict[str, str]],
+                        params: Dict[str, Any]) -> AsyncIterator[str]:
+    started = time.monotonic()
+    stream = await client.chat.completions.create(model=model, messages=messages, stream=True, **params)
+    first = True
+    # При отмене соединение закрывается и генерация прекращается
+    async with stream:
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            if first:
+                first = False
+                metrics.observe(ttft_metric(model), (time.monotonic() - started) * 1000)
+            yield delta
+
+
+class _Attempt:
+    """Поток одной модели и задача ожидания его первого токена"""
+
+    def __init__(self, client, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]):
+        self.model = model
+        self.started = time.monotonic()
+        self.stream = _model_stream(client, model, messages, params)
+        self.first = asyncio.ensure_future(self.stream.__anext__())
+
+    def failed(self) -> bool:
+        return (self.first.done() and not self.first.cancelled()
+                and not isinstance(self.first.exception(), (type(None), StopAsyncIteration)))
+
+    async def cancel(self) -> None:
+        if not self.first.done():
+            # Первого токена так и не было: время ожидания — нижняя оценка TTFT
+            metrics.observe(ttft_metric(self.model), (time.monotonic() - self.started) * 1000)
+        self.first.cancel()
+        try:
+            await self.first
+        except BaseException:
+            pass
+        await self.stream.aclose()
+
+
+async def hedged_stream(client, messages: List[Dict[str, str]], primary: str,
+                        fallback: Optional[str] = None, **params) -> AsyncIterator[str]:
+    """
+    Токены ответа по мере генерации. Если основная модель не выдала первый
+    токен за бюджет или упала, ответ берётся у той модели, что ответит первой.
+
+    Raises:
+        Exception: Ошибка запроса, если не ответила ни одна модель
+    """
+    attempts = [_Attempt(client, primary, messages, params)]
+    winner = None
+    try:
+        budget = ttft_budget_ms(primary) / 1000.0
+        done, _ = await asyncio.wait({attempts[0].first}, timeout=budget)
+        if (not done or attempts[0].failed()) and HEDGE_LLM and fallback and fallback != primary:
+            reason = 'ошибка' if done else f'нет первого токена за {budget * 1000:.0f} мс'
+            logging.warning(f"[LLM] {primary}: {reason}, страхующий запрос к {fallback}")
+            metrics.inc('llm.hedges')
+            attempts.append(_Attempt(client, fallback, messages, params))
+
+        pending = {a.first for a in attempts}
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in attempts:
+                if attempt.first in done and not attempt.failed():
+                    winner = attempt
+                    break
+        if winner is None:
+            # Ни одна модель не ответила: пробрасываем ошибку основной
+            metrics.inc('llm.errors')
+            raise attempts[0].first.exception()
+        if winner.model != primary:
+            metrics.inc('llm.hedge_wins')
+    finally:
+        for attempt in attempts:
+            if attempt is not winner:
+                await attempt.cancel()
+
+    try:
+        try:
+            first = winner.first.result()
+        except StopAsyncIteration:
+            return
+        yield first
+        async for delta in winner.stream:
+            yield delta
+    finally:
+        await winner.stream.aclose()
@@ -2,19 +2,19 @@ import asyncio
 import json
 import logging
 import os
-import threading
 from datetime import datetime
 from typing import Dict, Any, List, Optional
 
-from groq import Groq
 from crm.crm_api import load_enriched_post_funnel_config
+from llm.groq_client import get_groq_client
+from stt.io_loop import get_io_loop
 
 
 class PostCallProcessor:
     """Обработчик для анализа истории звонков после их завершения"""
     
     def __init__(self):
-        self.client = Groq()
+        self.client = get_groq_client()
         self.model = "qwen-qwq-32b"
         self.tmp_dir = os.path.join(os.path.dirname(__file__), '..', 'tmp')
         os.makedirs(self.tmp_dir, exist_ok=True)
@@ -109,21 +109,19 @@ class PostCallProcessor:
 
     def process_call_history_async(self, lead_id: str, history: List[Dict[str, Any]]) -> None:
         """
-        Асинхронно обрабатывает историю звонка в отдельном потоке
+        Асинхронно обрабатывает историю звонка в общем цикле ввода-вывода
         
         Args:
             lead_id: ID лида/сделки
             history: История диалога
         """
-        def run_processing():
-            try:
-                asyncio.run(self._process_call_history(lead_id, history))
-            except Exception as e:
-                logging.error(f"[POST_PROCESSOR] Ошибка в асинхронной обработке: {e}")
+        def on_done(future):
+            if not future.cancelled() and future.exception():
+                logging.error(f"[POST_PROCESSOR] Ошибка в асинхронной обработке: {future.exception()}")
         
-        # Запускаем в отдельном потоке, чтобы не блокировать основной поток
-        thread = threading.Thread(target=run_processing, daemon=True)
-        thread.start()
+        # Задача цикла вместо отдельного потока: запрос к Groq идёт через общий
+        # пул соединений параллельно с репликами звонков
+        get_io_loop().submit(self._process_call_history(lead_id, history)).add_done_callback(on_done)
         logging.info(f"[POST_PROCESSOR] Запущена постобработка для лида {lead_id}")
 
     async def _process_call_history(self, lead_id: str, history: List[Dict[str, Any]]) -> None:
@@ -153,7 +151,7 @@ class PostCallProcessor:
             
             logging.info(f"[POST_PROCESSOR] Отправляем запрос к Groq для лида {lead_id}")
             
-            response = self.client.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 response_format={"type": "json_object"},
@@ -162,11 +160,15 @@ class PostCallProcessor:
             
             analysis_result = response.choices[0].message.content
             
-            # Сохраняем результат в tmp
-            self._save_analysis_result(lead_id, analysis_result, dialog_text)
+            # Сохраняем результат в tmp (запись файла — вне цикла)
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._save_analysis_result, lead_id, analysis_result, dialog_text)
             
             logging.info(f"[POST_PROCESSOR] Анализ завершен для лида {lead_id}")
             
+        except asyncio.CancelledError:
+            logging.info(f"[POST_PROCESSOR] Обработка для лида {lead_id} отменена")
+            raise
         except Exception as e:
             logging.error(f"[POST_PROCESSOR] Ошибка обработки истории для лида {lead_id}: {e}")
 
@@ -0,0 +1,105 @@
+"""
+Кэш ответов агента вместе с озвучкой.
+
+Короткие реплики клиента («алло», «да», «до свидания») в одном и том же
+месте разговора почти всегда получают один и тот же ответ. Для них ответ
+берётся из кэша вместе с уже синтезированным PCM — без запроса к LLM и TTS.
+
+Ключ — нормализованный текст реплики, состояние воронки и предыдущая
+реплика агента: если контекст разговора отличается, ключ другой и ответ
+генерируется заново. Длинные реплики не кэшируются (CACHE_MAX_WORDS).
+Записи вытесняются по LRU и живут не дольше RESPONSE_CACHE_TTL секунд.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import metrics
+from llm.speculation import normalize_text
+
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', '1') != '0'
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '200'))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+# Кэшируются только реплики клиента не длиннее этого числа слов
+CACHE_MAX_WORDS = int(os.getenv('RESPONSE_CACHE_MAX_WORDS', '4'))
+
+# Фрагменты ответа: (текст, PCM 16 бит моно с частотой плейлиста)
+Segments = List[Tuple[str, bytes]]
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Segments]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(session, user_text: str) -> Optional[str]:
+        """
+        Ключ кэша для реплики звонка или None, если реплику кэшировать нельзя.
+        """
+        if not RESPONSE_CACHE:
+            return None
+        text = normalize_text(user_text)
+        if not text or len(text.split()) > CACHE_MAX_WORDS:
+            metrics.inc('response_cache.bypass')
+            return None
+        funnel = session.funnel.key() if session.funnel is not None else ''
+        last_reply = ''
+        if session.history is not None:
+            for msg in reversed(session.history.snapshot()):
+                if msg.get('role') == 'assistant':
+                    last_reply = normalize_text(str(msg.get('content', '')))
+                    break
+        context = hashlib.sha1(f"{funnel}|{last_reply}".encode('utf-8')).hexdigest()[:16]
+        return f"{text}|{context}"
+
+    def get(self, key: Optional[str]) -> Optional[Segments]:
+        if key is None:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                metrics.inc('response_cache.misses')
+                return None
+            self._entries.move_to_end(key)
+        metrics.inc('response_cache.hits')
+        return entry[1]
+
+    def put(self, key: str, segments: Segments) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), segments)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        metrics.inc('response_cache.stores')
+        logging.info(f"[CACHE] Ответ сохранён: {' '.join(text for text, _ in segments)}")
+
+    def hit_rate(self) -> Optional[float]:
+        hits = metrics.get_counter('response_cache.hits')
+        total = hits + metrics.get_counter('response_cache.misses')
+        return hits / total if total else None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+_response_cache: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> ResponseCache:
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
@@ -0,0 +1,132 @@
+"""
+Нарезка потока токенов LLM на фрагменты для TTS.
+
+Ответ режется по концам предложений, а длинные предложения — ещё и по
+запятым, точкам с запятой, двоеточиям и тире, чтобы первый фрагмент ушёл
+в синтез как можно раньше. Точка считается концом предложения, только если
+следующее слово начинается с заглавной буквы (иначе это сокращение вроде
+«т. е.»). Ремарки в скобках и звёздочках, которые запрещены промптом, но
+иногда всё же приходят от модели, вырезаются и не озвучиваются. Звёздочка
+открывает ремарку, только если парная звёздочка стоит до конца предложения;
+одиночная (например, маркер списка) просто убирается.
+"""
+
+import os
+import re
+from typing import List, Optional
+
+# Минимальная длина фрагмента, отрезаемого по запятой/тире (символов)
+MIN_CLAUSE_CHARS = int(os.getenv('TTS_MIN_CLAUSE_CHARS', '40'))
+
+_SENTENCE_END = '!?…'
+_CLAUSE_END = ',;:—'
+_OPENERS = {'(': ')', '[': ']', '*': '*'}
+_REMARK_RE = re.compile(r'\([^)]*\)|\[[^\]]*\]|\*[^*]*\*')
+_SPACES_RE = re.compile(r'\s+')
+
+
+def clean_segment(text: str) -> str:
+    """Убирает ремарки и лишние пробелы"""
+    text = _REMARK_RE.sub(' ', text).replace('*', ' ')
+    text = _SPACES_RE.sub(' ', text).strip()
+    # Пробел перед знаком препинания остаётся после вырезанной ремарки
+    return re.sub(r' ([,.!?…;:])', r'\1', text)
+
+
+class SentenceSplitter:
+    def __init__(self, min_clause_chars: int = MIN_CLAUSE_CHARS):
+        self.min_clause_chars = min_clause_chars
+        self._buffer = ''
+        self._scan = 0  # до какой позиции буфер уже просмотрен
+        self._closer: Optional[str] = None  # ждём закрытия ремарки
+
+    def feed(self, delta: str) -> List[str]:
+        """Добавляет токены и возвращает готовые фрагменты (возможно, ни одного)"""
+        self._buffer += delta
+        segments = []
+        i = self._scan
+        while i < len(self._buffer):
+            ch = self._buffer[i]
+            if self._closer is not None:
+                if ch == self._closer:
+                    self._closer = None
+                i += 1
+                continue
+            if ch in _OPENERS:
+                if ch == '*':
+                    paired = self._asterisk_paired(i)
+                    if paired is None:
+                        break
+                    if not paired:
+                        i += 1
+                        continue
+                self._closer = _OPENERS[ch]
+                i += 1
+                continue
+            cut = self._cut_at(i)
+            if cut is None:
+                # Решение зависит от ещё не пришедших символов
+                break
+            if cut:
+                segment = clean_segment(self._buffer[:i + 1])
+                self._buffer = self._buffer[i + 1:]
+                i = 0
+                if segment:
+                    segments.append(segment)
+                continue
+            i += 1
+        self._scan = i
+        return segments
+
+    def flush(self) -> Optional[str]:
+        """Остаток ответа после окончания потока"""
+        segment = clean_segment(self._buffer)
+        self._buffer = ''
+        self._scan = 0
+        self._closer = None
+        return segment or None
+
+    def _asterisk_paired(self, i: int) -> Optional[bool]:
+        """
+        Есть ли у звёздочки i парная до конца предложения.
+
+        Returns:
+            True/False, или None, если нужно дождаться следующих символов
+        """
+        for j in range(i + 1, len(self._buffer)):
+            ch = self._buffer[j]
+            if ch == '*':
+                return True
+            if ch == '\n':
+                return False
+            if ch in _SENTENCE_END or ch == '.':
+                if j + 1 == len(self._buffer):
+                    return None
+                if self._buffer[j + 1].isspace():
+                    return False
+        return None
+
+    def _cut_at(self, i: int) -> Optional[bool]:
+        """
+        Можно ли резать после символа i.
+
+        Returns:
+            True/False, или None, если нужно дождаться следующих символов
+        """
+        ch = self._buffer[i]
+        if ch not in _SENTENCE_END and ch != '.' and ch not in _CLAUSE_END:
+            return False
+        rest = self._buffer[i + 1:]
+        if not rest:
+            return None
+        if not rest[0].isspace():
+            # «...», «?!», «5.5» — конец знака ещё не наступил
+            return False
+        if ch in _SENTENCE_END:
+            return True
+        if ch in _CLAUSE_END:
+            return len(self._buffer[:i].strip()) >= self.min_clause_chars
+        following = rest.lstrip()
+        if not following:
+            return None
+        return not following[0].islower()
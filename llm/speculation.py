@@ -0,0 +1,72 @@
+"""
+Спекулятивная генерация ответа LLM.
+
+Как только STT присылает финальный фрагмент реплики, ответ начинает
+генерироваться, не дожидаясь конца реплики. Если к моменту конца реплики
+её текст совпал с тем, по которому шла генерация, готовый (или почти
+готовый) ответ используется сразу; иначе спекуляция отменяется.
+"""
+
+import asyncio
+import logging
+import re
+import time
+from typing import Optional
+
+import metrics
+
+_PUNCT_RE = re.compile(r'[^\w\s]', re.UNICODE)
+
+
+def normalize_text(text: str) -> str:
+    """Текст реплики без регистра, пунктуации и лишних пробелов"""
+    return ' '.join(_PUNCT_RE.sub(' ', text.lower()).split())
+
+
+class Speculation:
+    def __init__(self, user_text: str, task: "asyncio.Future"):
+        self.user_text = user_text
+        self.key = normalize_text(user_text)
+        self.task = task
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        task.add_done_callback(self._on_done)
+        metrics.inc('speculative.started')
+
+    def _on_done(self, task) -> None:
+        self.finished_at = time.monotonic()
+
+    def matches(self, user_text: str) -> bool:
+        return self.key == normalize_text(user_text)
+
+    def cancel(self) -> None:
+        if not self.task.done():
+            self.task.cancel()
+        metrics.inc('speculative.cancelled')
+
+    async def take(self, user_text: str) -> Optional[str]:
+        """
+        Возвращает ответ спекуляции, если она шла по тому же тексту реплики,
+        иначе отменяет её и возвращает None.
+        """
+        if not self.matches(user_text):
+            self.cancel()
+            metrics.inc('speculative.misses')
+            return None
+        now = time.monotonic()
+        # Сколько времени генерации уже прошло к концу реплики
+        done_at = self.finished_at if self.finished_at is not None else now
+        saved_ms = (min(done_at, now) - self.started_at) * 1000
+        try:
+            reply = await self.task
+        except asyncio.CancelledError:
+            metrics.inc('speculative.misses')
+            return None
+        except Exception as e:
+            logging.warning(f"[SPEC] Спекулятивный запрос завершился ошибкой: {e}")
+            metrics.inc('speculative.misses')
+            return None
+        metrics.inc('speculative.hits')
+        metrics.observe('speculative.saved_ms', saved_ms)
+        logging.info(f"[SPEC] Использован спекулятивный ответ, выиграно {saved_ms:.0f} мс")
+        return reply
@@ -0,0 +1,87 @@
+"""
+Очередь реплик клиента к LLM.
+
+Реплики одного звонка обрабатываются строго по очереди: пока агент отвечает,
+новые реплики клиента копятся и уходят в LLM одним запросом, склеенными,
+сразу после текущего ответа — слова клиента не теряются. Число одновременных
+запросов к LLM по всем звонкам ограничено (MAX_LLM_TURNS): при нагрузке
+реплики ждут своей очереди, а не порождают неограниченное число запросов.
+
+Все методы вызываются в общем цикле ввода-вывода (stt.io_loop).
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+from config import MAX_CALLS
+from llm.groq_agent import process_transcript_async
+
+# Сколько реплик (по всем звонкам) одновременно обрабатывается LLM
+MAX_LLM_TURNS = int(os.getenv('MAX_LLM_TURNS', str(MAX_CALLS)))
+
+
+class _CallTurns:
+    """Реплики одного звонка, ожидающие обработки"""
+
+    def __init__(self):
+        self.pending: List[Tuple[str, float]] = []  # (текст, время конца реплики)
+        self.worker: Optional[asyncio.Future] = None
+
+
+class TurnQueue:
+    def __init__(self, max_active: int = MAX_LLM_TURNS):
+        self.max_active = max_active
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._calls: Dict[int, _CallTurns] = {}
+
+    def submit(self, call_id: int, text: str, turn_started: float) -> None:
+        """Ставит реплику звонка в очередь. Вызывается в цикле ввода-вывода."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_active)
+        call = self._calls.setdefault(call_id, _CallTurns())
+        call.pending.append((text, turn_started))
+        if call.worker is None:
+            call.worker = asyncio.ensure_future(self._drain(call_id, call))
+        else:
+            logging.info(f"[TURNS] Звонок {call_id}: агент ещё отвечает, реплика будет добавлена к следующему запросу")
+
+    async def _drain(self, call_id: int, call: _CallTurns) -> None:
+        try:
+            while call.pending:
+                queued_at = time.monotonic()
+                async with self._slots:
+                    metrics.observe('turns.queue_wait_ms', (time.monotonic() - queued_at) * 1000)
+                    # Всё, что клиент сказал за время ожидания, — одним запросом
+                    parts, call.pending = call.pending, []
+                    if len(parts) > 1:
+                        metrics.inc('turns.merged', len(parts) - 1)
+                    text = ' '.join(part for part, _ in parts)
+                    await self._run_turn(call_id, text, parts[0][1])
+        finally:
+            call.worker = None
+            if self._calls.get(call_id) is call and not call.pending:
+                del self._calls[call_id]
+
+    @staticmethod
+    async def _run_turn(call_id: int, text: str, turn_started: float) -> None:
+        try:
+            await process_transcript_async(text, call_id)
+        except Exception as e:
+            logging.error(f"[LLM] Ошибка: {e}", exc_info=True)
+        delay_ms = int((time.time() - turn_started) * 1000)
+        logging.info(f"[LLM] Ответ готов (задержка {delay_ms} мс)")
+
+
+_turn_queue: Optional[TurnQueue] = None
+
+
+def get_turn_queue() -> TurnQueue:
+    """Глобальная очередь реплик"""
+    global _turn_queue
+    if _turn_queue is None:
+        _turn_queue = TurnQueue()
+    return _turn_queue
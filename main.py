@@ -5,6 +5,9 @@ import os
 from config import load_config
 from sip.endpoint import create_endpoint
 from sip.account import Account
+from sip.media_dispatcher import get_dispatcher
+from stt.io_loop import get_io_loop
+from stt.stt_pool import get_stt_pool
 from crm.crm_api import enrich_funnel_config_with_crm
 
 def main():
@@ -12,13 +15,16 @@ def main():
     signal.signal(signal.SIGINT, signal.SIG_DFL)
     config = load_config()
     sip_event_queue = queue.Queue()
-    sip_event_queue.current_call = None  # текущий звонок (monkey-patch)
     sip_event_queue.config = config
     
     ep = None
     acc = None
     try:
         ep = create_endpoint()
+        # Один цикл ввода-вывода обслуживает STT всех звонков;
+        # соединения с Deepgram открываются заранее, пока ждём звонков
+        get_io_loop().start()
+        get_stt_pool().start()
         acc_cfg = __import__('pjsua2').AccountConfig()
         acc_cfg.idUri = f"sip:{config['SIP_USER']}@{config['SIP_DOMAIN']}"
         acc_cfg.regConfig.registrarUri = f"sip:{config['SIP_DOMAIN']}"
@@ -35,22 +41,10 @@ def main():
         acc.sem_reg.acquire()
         logging.info("SIP-агент запущен и готов к приему звонков. Нажмите Ctrl+C для выхода.")
 
-        import time
-        while True:
-            try:
-                # Обрабатываем очередь аудиофайлов для воспроизведения
-                if hasattr(sip_event_queue, 'current_call') and sip_event_queue.current_call:
-                    # Импортируем функцию обработки очереди
-                    from sip.audio_player import process_audio_queue
-                    process_audio_queue()
-                    
-                    # Проверяем отложенное воспроизведение аудио в текущем звонке
-                    sip_event_queue.current_call.check_pending_audio()
-            except queue.Empty:
-                pass
-            except Exception as e:
-                pass
-            time.sleep(0.1)
+        # Все операции с плеерами выполняются в основном потоке (он зарегистрирован
+        # в pjlib): диспетчер просыпается сразу при постановке аудио в очередь
+        # и по таймерам окончания воспроизведения
+        get_dispatcher().run_forever()
 
     except KeyboardInterrupt:
         logging.info("Выход из программы...")
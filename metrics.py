@@ -0,0 +1,78 @@
+"""
+Простые метрики процесса: счётчики и гистограммы задержек.
+
+Все функции потокобезопасны. Гистограммы хранят последние значения
+(скользящее окно) и считают перцентили по ним.
+"""
+
+import logging
+import threading
+from collections import defaultdict, deque
+from typing import Dict, Optional
+
+HISTOGRAM_WINDOW = 1000
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(float)
+_histograms: Dict[str, deque] = {}
+
+
+def inc(name: str, value: float = 1) -> None:
+    """Увеличивает счётчик name на value"""
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name: str, value: float) -> None:
+    """Добавляет значение в гистограмму name"""
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = deque(maxlen=HISTOGRAM_WINDOW)
+        hist.append(value)
+
+
+def get_counter(name: str) -> float:
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def percentile(name: str, q: float) -> Optional[float]:
+    """Возвращает q-й перцентиль (0..100) гистограммы или None, если она пуста"""
+    with _lock:
+        values = sorted(_histograms.get(name, ()))
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(q / 100.0 * (len(values) - 1)))))
+    return values[index]
+
+
+def histogram_count(name: str) -> int:
+    with _lock:
+        return len(_histograms.get(name, ()))
+
+
+def snapshot() -> dict:
+    """Снимок всех метрик: счётчики и count/p50/p95 гистограмм"""
+    with _lock:
+        counters = dict(_counters)
+        names = list(_histograms.keys())
+    histograms = {}
+    for name in names:
+        histograms[name] = {
+            'count': histogram_count(name),
+            'p50': percentile(name, 50),
+            'p95': percentile(name, 95),
+        }
+    return {'counters': counters, 'histograms': histograms}
+
+
+def log_snapshot(prefix: str = "") -> None:
+    """Пишет в лог метрики, имена которых начинаются с prefix"""
+    snap = snapshot()
+    lines = [f"{k}={v:g}" for k, v in sorted(snap['counters'].items()) if k.startswith(prefix)]
+    for name, h in sorted(snap['histograms'].items()):
+        if name.startswith(prefix) and h['count']:
+            lines.append(f"{name}: n={h['count']} p50={h['p50']:.1f} p95={h['p95']:.1f}")
+    if lines:
+        logging.info("[METRICS] " + "; ".join(lines))
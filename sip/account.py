@@ -2,16 +2,22 @@ import threading
 import queue
 import pjsua2 as pj
 from .call import Call
+from .session import create_session, get_session, remove_session
+from .media_dispatcher import get_dispatcher
+from .recording_store import get_recording_store
+from llm.dialog_history import open_dialog_history, close_dialog_history
+from llm.funnel_state import FunnelState
 import re
 from crm.status_config import STAGE_STATUS_IDS
-import uuid
 import os
 import time
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
-# Создаем папку для временных файлов записей
-TMP_RECORDINGS_DIR = Path("/tmp/pjsua_recordings")
-TMP_RECORDINGS_DIR.mkdir(exist_ok=True)
+# Запись звонков в файл необязательна: STT получает аудио напрямую из памяти
+RECORD_CALLS = os.getenv('RECORD_CALLS', '1') != '0'
+
+# Пул подготовки входящих звонков: поиск сделки, подключение STT, прогрев агента
+_setup_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="call_setup")
 
 class Account(pj.Account):
     def __init__(self, sip_event_queue, transcript_queue=None):
@@ -27,71 +33,116 @@ class Account(pj.Account):
 
     def onIncomingCall(self, prm):
         print("[PJSUA] Входящий звонок...")
-        call_id = str(uuid.uuid4())
         call = Call(self, prm.callId)
-        self.sip_event_queue.current_call = call
-
-        from llm.groq_agent import get_llm_agent
-        get_llm_agent()
+        session = create_session(prm.callId, call)
 
         ci = call.getInfo()
         print(f"[PJSUA] Звонок с номера: {ci.remoteUri}")
         match = re.search(r'sip:([^@>]+)@', ci.remoteUri)
-        if match:
-            phone_number = match.group(1)
-            print(f"[PJSUA] Номер звонящего: {phone_number}")
-            
-            # 1. Распознать контакт и лид
-            from crm.crm_api import AmoCRMClient, wait_for_contact_and_lead
-            amocrm_client = AmoCRMClient()
-            max_attempts = 5
-            lead_found = False
-            
-            for attempt in range(1, max_attempts + 1):
-                contact, lead = wait_for_contact_and_lead(phone_number, amocrm_client, ringback_callback=lambda **kwargs: None)
-                if lead and 'id' in lead:
-                    call.lead_id = lead['id']
-                    if hasattr(self.sip_event_queue, 'config') and isinstance(self.sip_event_queue.config, dict):
-                        self.sip_event_queue.config['ACTIVE_LEAD_ID'] = lead['id']
-                    print(f"[CRM] Контакт и сделка найдены: contact_id={contact.get('id') if contact else None}, lead_id={lead['id']}")
-                    lead_found = True
-                    break
-                else:
-                    print(f"[CRM] Попытка {attempt}: не удалось найти контакт/сделку по номеру")
-                    if attempt < max_attempts:
-                        time.sleep(1.0)
-            
-            if not lead_found:
-                print("[CRM] Не удалось найти сделку за 5 попыток, сбрасываем вызов")
-                try:
-                    call.hangup()
-                    return
-                except Exception as e:
-                    print(f"[CRM] Ошибка при сбросе вызова: {e}")
-                    return
-            
-            # 2. Принять вызов
-            timestamp = int(time.time())
-            filename = TMP_RECORDINGS_DIR / f"call_{timestamp}.wav"
-            call.connect_stt_session(str(filename))
-
-            call_prm = pj.CallOpParam()
-            call_prm.statusCode = 200
-            call.answer(call_prm)
-            print("[PJSUA] Звонок автоматически принят")
-            
-            # 3. Изменить статус сделки
-            if lead_found and hasattr(call, 'lead_id'):
-                status, resp = amocrm_client.update_lead_status(call.lead_id, STAGE_STATUS_IDS[0])
-                print(f"[CRM] Статус сделки обновлён: {status}, {resp}")
-        else:
+        if not match:
             print(f"[PJSUA] Не удалось извлечь номер из {ci.remoteUri}")
-            phone_number = None
+            remove_session(session.call_id)
+            call.hangup(pj.CallOpParam())
+            return
+        phone_number = match.group(1)
+        print(f"[PJSUA] Номер звонящего: {phone_number}")
+
+        # Сразу отвечаем 180 Ringing и возвращаем управление pjsua:
+        # поиск сделки, подключение STT и прогрев агента идут параллельно
+        ringing_prm = pj.CallOpParam()
+        ringing_prm.statusCode = 180
+        call.answer(ringing_prm)
+
+        filename = None
+        if RECORD_CALLS:
+            filename = get_recording_store().allocate(prm.callId)
+        call.create_stt_session(filename)
+
+        stt_ready = _setup_pool.submit(call.ensure_stt_connected)
+        _setup_pool.submit(_warm_up_agent)
+        _setup_pool.submit(_resolve_lead_and_answer, call, session, phone_number, stt_ready)
+
+
+def _warm_up_agent():
+    from llm.groq_agent import get_llm_agent
+    get_llm_agent()
+
+
+def _find_lead(phone_number, amocrm_client, max_attempts=5):
+    from crm.crm_api import wait_for_contact_and_lead
+    for attempt in range(1, max_attempts + 1):
+        contact, lead = wait_for_contact_and_lead(phone_number, amocrm_client, ringback_callback=lambda **kwargs: None)
+        if lead and 'id' in lead:
+            print(f"[CRM] Контакт и сделка найдены: contact_id={contact.get('id') if contact else None}, lead_id={lead['id']}")
+            return lead
+        print(f"[CRM] Попытка {attempt}: не удалось найти контакт/сделку по номеру")
+        if attempt < max_attempts:
+            time.sleep(1.0)
+    return None
+
+
+def _resolve_lead_and_answer(call, session, phone_number, stt_ready):
+    """
+    Выполняется в пуле: ищет сделку и принимает или сбрасывает вызов.
+    Звонок принимается только после подключения STT (stt_ready), чтобы при
+    ошибке подключения звонок уже получил сессию резервного движка.
+    """
+    from crm.crm_api import AmoCRMClient
+    from llm.groq_agent import get_llm_agent
+    amocrm_client = AmoCRMClient()
+    try:
+        lead = _find_lead(phone_number, amocrm_client)
+    except Exception as e:
+        print(f"[CRM] Ошибка поиска сделки: {e}")
+        lead = None
+
+    if get_session(session.call_id) is not session:
+        print("[PJSUA] Звонящий положил трубку до ответа")
+        return
+    if not lead:
+        print("[CRM] Не удалось найти сделку за 5 попыток, сбрасываем вызов")
+        get_dispatcher().post(_reject_call, call, session)
+        return
+
+    session.lead_id = lead['id']
+    # История лида и состояние воронки готовятся здесь, до первой реплики
+    history = open_dialog_history(session.lead_id, session)
+    session.funnel = FunnelState.from_lead(get_llm_agent().funnel_stages, lead)
+    session.history = history
+    if get_session(session.call_id) is not session:
+        # Звонок завершился, пока открывалась история. Закрытие идемпотентно,
+        # поэтому не важно, успел ли его сделать обработчик DISCONNECTED
+        close_dialog_history(history, session)
+        return
+    stt_ready.result()
+    get_dispatcher().post(_answer_call, call, session)
+
+    if lead.get('status_id') in STAGE_STATUS_IDS[1:]:
+        # Повторный звонок: этапы, пройденные раньше, не откатываем
+        return
+    status, resp = amocrm_client.update_lead_status(session.lead_id, STAGE_STATUS_IDS[0])
+    print(f"[CRM] Статус сделки обновлён: {status}, {resp}")
+
+
+def _answer_call(call, session):
+    if get_session(session.call_id) is not session:
+        return
+    try:
+        call_prm = pj.CallOpParam()
+        call_prm.statusCode = 200
+        call.answer(call_prm)
+        print("[PJSUA] Звонок автоматически принят")
+    except Exception as e:
+        print(f"[PJSUA] Ошибка при ответе на звонок: {e}")
+
+
+def _reject_call(call, session):
+    if get_session(session.call_id) is not session:
+        return
+    try:
+        call.hangup(pj.CallOpParam())
+    except Exception as e:
+        print(f"[CRM] Ошибка при сбросе вызова: {e}")
 
-        def start_streaming_after_answer():
-            while not hasattr(call, '_audio_media') or call._audio_media is None:
-                time.sleep(0.05)
-            call.start_audio_streaming(0)
-        threading.Thread(target=start_streaming_after_answer, daemon=True).start()
 
 _active_lead_id = None
\ No newline at end of file
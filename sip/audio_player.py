@@ -2,115 +2,110 @@
 Утилиты для работы с аудиоплеером PJSUA.
 
 Этот модуль содержит удобные функции для воспроизведения аудиофайлов
-через активный звонок в системе PJSUA.
+в звонки PJSUA. Каждый звонок имеет собственный плейлист в своей CallSession:
+клипы играют по очереди встык, а об окончании каждого сообщает событие
+playback finished сессии.
 """
 
 import os
 import logging
-import queue
-import threading
-from .call import Call
+from .session import get_session
+from .playlist import PRIORITY_NORMAL, PRIORITY_URGENT
 
-# Глобальная очередь для безопасной передачи аудиофайлов между потоками
-_audio_queue = queue.Queue()
-_queue_lock = threading.Lock()
 
-
-def queue_audio_for_playback(audio_file_path):
+def queue_audio_for_playback(audio_file_path, call_id, priority=PRIORITY_NORMAL, interrupt=False):
     """
-    Добавляет аудиофайл в очередь для воспроизведения.
+    Добавляет аудиофайл в плейлист звонка.
     Безопасно вызывать из любого потока.
-    
+
     Args:
         audio_file_path (str): Путь к аудиофайлу
+        call_id (int): callId звонка
+        priority (int): Приоритет клипа (меньше — раньше)
+        interrupt (bool): Прервать текущее воспроизведение и очистить очередь
+
+    Returns:
+        bool: True если файл поставлен в очередь
     """
-    try:
-        _audio_queue.put(audio_file_path, block=False)
-        logging.info(f"[AUDIO] Файл добавлен в очередь: {os.path.basename(audio_file_path)}")
-    except queue.Full:
-        logging.error("[AUDIO] Очередь воспроизведения переполнена")
+    session = get_session(call_id)
+    if not session:
+        logging.warning(f"[AUDIO] Звонок {call_id} не найден, файл не поставлен в очередь")
+        return False
+    clip = session.playlist.enqueue_file(audio_file_path, priority=priority, interrupt=interrupt)
+    if not clip:
+        return False
+    logging.info(f"[AUDIO] Файл добавлен в очередь звонка {call_id}: {os.path.basename(audio_file_path)} "
+                 f"(в очереди: {session.playlist.depth()})")
+    return True
 
 
-def process_audio_queue():
+def play_audio_to_call(call_id, audio_file_path):
     """
-    Обрабатывает очередь аудиофайлов для воспроизведения.
-    ДОЛЖНА вызываться только из основного потока PJSUA!
-    
+    Воспроизводит аудиофайл в звонок немедленно, прерывая текущее воспроизведение.
+
+    Args:
+        call_id (int): callId звонка
+        audio_file_path (str): Путь к аудиофайлу
+
     Returns:
-        bool: True если был обработан хотя бы один файл
+        bool: True если файл поставлен на воспроизведение, False в противном случае
     """
-    processed = False
-    
-    try:
-        while not _audio_queue.empty():
-            try:
-                audio_file_path = _audio_queue.get_nowait()
-                success = play_audio_to_current_call(audio_file_path)
-                if success:
-                    logging.info(f"[AUDIO] Воспроизведение началось: {os.path.basename(audio_file_path)}")
-                    processed = True
-                else:
-                    logging.error(f"[AUDIO] Не удалось воспроизвести: {audio_file_path}")
-                _audio_queue.task_done()
-            except queue.Empty:
-                break
-    except Exception as e:
-        logging.error(f"[AUDIO] Ошибка при обработке очереди: {e}")
-    
-    return processed
-
-
-def play_audio_to_current_call(audio_file_path, loop=False):
+    return queue_audio_for_playback(audio_file_path, call_id, priority=PRIORITY_URGENT, interrupt=True)
+
+
+def stop_call_audio(call_id):
     """
-    Воспроизводит аудиофайл в текущий активный звонок.
-    
+    Останавливает воспроизведение аудио в звонке и очищает его очередь.
+
     Args:
-        audio_file_path (str): Путь к аудиофайлу
-        loop (bool): Зацикливать ли воспроизведение
-        
+        call_id (int): callId звонка
+
     Returns:
-        bool: True если воспроизведение началось успешно, False в противном случае
+        int: Количество отменённых клипов
     """
-    current_call = Call.current
-    if not current_call:
-        logging.warning("[AUDIO] Нет активного звонка для воспроизведения аудио")
-        return False
-        
-    return current_call.play_audio_file(audio_file_path, loop)
+    session = get_session(call_id)
+    if not session:
+        return 0
+    return session.playlist.clear()
 
 
-def stop_current_call_audio():
+def get_playback_stats(call_id):
     """
-    Останавливает воспроизведение аудио в текущем активном звонке.
-    
+    Возвращает состояние плейлиста звонка для мониторинга.
+
+    Args:
+        call_id (int): callId звонка
+
     Returns:
-        bool: True если остановка прошла успешно, False в противном случае
+        dict: depth, pending, clips_played, clips_interrupted, underruns или None
     """
-    current_call = Call.current
-    if not current_call:
-        return True
-        
-    return current_call.stop_audio_playback()
+    session = get_session(call_id)
+    if not session:
+        return None
+    return session.playlist.stats()
 
 
-def play_welcome_message():
+def play_welcome_message(call_id):
     """
-    Воспроизводит приветственное сообщение в текущий звонок.
-    
+    Ставит приветственное сообщение в очередь звонка.
+
+    Args:
+        call_id (int): callId звонка
+
     Returns:
-        bool: True если воспроизведение началось успешно, False в противном случае
+        bool: True если файл поставлен в очередь, False в противном случае
     """
     welcome_file = os.path.join(os.path.dirname(__file__), '..', 'ElevenLabs_Text_to_Speech_audio.wav')
-    return play_audio_to_current_call(welcome_file)
+    return queue_audio_for_playback(welcome_file, call_id)
 
 
 def get_audio_file_path(filename):
     """
     Получает полный путь к аудиофайлу относительно корня проекта.
-    
+
     Args:
         filename (str): Имя файла
-        
+
     Returns:
         str: Полный путь к файлу
     """
@@ -0,0 +1,89 @@
+"""
+Перебивание агента клиентом (barge-in).
+
+Когда клиент начинает говорить, пока агент думает или говорит, текущая
+реплика агента отменяется: плейлист звонка очищается, незавершённые
+запросы LLM/TTS этой реплики прерываются, а в историю записывается
+только услышанная часть ответа.
+"""
+
+import logging
+from typing import Optional
+
+from .session import get_session, AgentTurn
+
+# Средний темп речи TTS (символов в секунду) для оценки услышанной части,
+# пока полная длина аудио ещё неизвестна
+CHARS_PER_SECOND = 15.0
+
+
+def _clip_heard_ratio(call, clip, text: str) -> float:
+    port = call.stream_port
+    if clip.needs_player:
+        progress = call.file_playback_progress()
+        return progress if progress is not None else 0.0
+    played = clip.played_bytes(port)
+    if clip.closed and clip.written:
+        return min(1.0, played / clip.written)
+    if not text or port is None:
+        return 0.0
+    heard_chars = played / float(port.bytes_per_second) * CHARS_PER_SECOND
+    return min(1.0, heard_chars / len(text))
+
+
+def _estimate_heard_ratio(call, turn: AgentTurn) -> float:
+    """Доля озвученного текста реплики, которую клиент успел услышать"""
+    total = sum(len(text) for text, _ in turn.segments)
+    if not total:
+        return 0.0
+    heard = sum(len(text) * _clip_heard_ratio(call, clip, text) for text, clip in turn.segments)
+    return min(1.0, heard / total)
+
+
+def handle_barge_in(call_id) -> Optional[float]:
+    """
+    Отменяет текущую реплику агента, если она ещё не прозвучала полностью.
+    Безопасно вызывать из любого потока.
+
+    Args:
+        call_id (int): callId звонка
+
+    Returns:
+        Доля услышанного ответа (0..1), None если перебивать было нечего
+    """
+    session = get_session(call_id)
+    if not session or not session.call or not session.current_turn:
+        return None
+    turn = session.current_turn
+    call = session.call
+
+    from llm.groq_agent import get_llm_agent, GroqAgent
+
+    with turn.lock:
+        if turn.cancelled.is_set():
+            return None
+        generating = turn.reply_text is None
+        if generating:
+            if turn.llm_done:
+                return None
+            # Ответ ещё генерируется — он уже неактуален
+            turn.cancel()
+            if not turn.segments:
+                logging.info(f"[BARGE-IN] Звонок {call_id}: отменен запрос к LLM (реплика {turn.turn_id})")
+                return 0.0
+        elif turn.tts_done and not session.playlist.is_active():
+            # Реплика уже прозвучала полностью
+            return None
+        heard_ratio = _estimate_heard_ratio(call, turn)
+        turn.cancel()
+        if generating:
+            # Начало ответа уже звучит: услышанную часть агент запишет в историю сам
+            turn.heard_text = GroqAgent._cut_heard_text(turn.spoken_text, heard_ratio)
+
+    dropped = session.playlist.clear()
+    logging.info(f"[BARGE-IN] Звонок {call_id}: реплика {turn.turn_id} прервана, "
+                 f"услышано {heard_ratio:.0%}, отброшено клипов: {dropped}")
+
+    if not generating:
+        get_llm_agent().record_interrupted_reply(session, turn.reply_text, heard_ratio)
+    return heard_ratio
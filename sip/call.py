@@ -1,30 +1,51 @@
 import threading
 import os
 import time
-import wave
 import pjsua2 as pj
-from stt.deepgram_stt import stt_from_wav, DeepgramSTTSession
-from sip.utils import get_active_lead_id
+from stt.stt_pool import get_stt_pool, create_stt_session, NARROWBAND_RATE
+from stt.base import RATE as STT_RATE
+from sip.session import remove_session
+from sip.media_ports import AudioTapPort, StreamingPlayerPort, EofAudioPlayer
+from sip.recorder import BackgroundWavWriter
+from sip.recording_store import get_recording_store
+from sip.media_dispatcher import get_dispatcher
+from llm.dialog_history import close_dialog_history
+from llm.context_window import schedule_summary
+
+# Передавать в STT аудио узкополосных звонков на родной частоте кодека
+STT_NATIVE_RATE = os.getenv('STT_NATIVE_RATE', '1') != '0'
+# Запас к длительности файла, после которого плеер без EOF считается завершённым,
+# и предельное время воспроизведения файла неизвестной длительности (с)
+PLAYER_EOF_GRACE = 1.0
+MAX_FILE_PLAYBACK = 30.0
 
 class Call(pj.Call):
-    current = None
     def __init__(self, acc, call_id=pj.PJSUA_INVALID_ID):
         super().__init__(acc, call_id)
         self.acc = acc
         self.connected = False
         self.audio_streaming = False
         self.stop_streaming = threading.Event()
-        self._recorder = None
+        self._tap = None  # AudioTapPort: PCM звонка для STT и записи
+        self._wav_writer = None
+        self._stream_port = None  # StreamingPlayerPort: потоковое воспроизведение TTS
         self._stream_thread = None
         self._audio_media = None
         self._stt_session = None
+        self._stt_fallback = False  # звонок переключен на резервный движок STT
         self._recording_filename = None
-        self.lead_id = None
+        self.session = None  # CallSession, назначается в create_session
         self._player = None
         self._player_start_time = 0
-        self._max_playback_duration = 30
-        self._current_audio_duration = 0  # Длительность текущего файла
-        Call.current = self
+
+    @property
+    def lead_id(self):
+        return self.session.lead_id if self.session else None
+
+    @property
+    def stream_port(self):
+        """Порт потокового воспроизведения или None, если медиа ещё не активно"""
+        return self._stream_port
 
     def onCallState(self, prm):
         ci = self.getInfo()
@@ -34,19 +55,34 @@ class Call(pj.Call):
             self.connected = False
             self.stop_streaming.set()
             try:
-                if self._audio_media and self._recorder:
+                if self._audio_media and self._tap:
                     for mi in ci.media:
                         if (mi.type == pj.PJMEDIA_TYPE_AUDIO and 
                             mi.status == pj.PJSUA_CALL_MEDIA_ACTIVE):
-                            self._audio_media.stopTransmit(self._recorder)
+                            self._audio_media.stopTransmit(self._tap)
                             break
             except Exception as e:
                 print(f"[PJSUA] Ошибка при остановке аудио: {e}")
+            if self._wav_writer:
+                # Перекодирование и индексация — после того, как поток записи закроет файл
+                lead_id = self.lead_id
+                self._wav_writer.close(on_closed=lambda path: get_recording_store().finalize(path, lead_id))
+                self._wav_writer = None
+            if self.session:
+                self.session.playlist.clear()
+            if self._stream_port:
+                try:
+                    self._stream_port.stop()
+                    if self._audio_media:
+                        self._stream_port.stopTransmit(self._audio_media)
+                except Exception as e:
+                    print(f"[PJSUA] Ошибка при остановке потокового плеера: {e}")
+                self._stream_port = None
             if self._stream_thread and self._stream_thread.is_alive():
                 self._stream_thread.join(timeout=1.0)
             try:
-                if self._recorder:
-                    self._recorder = None
+                if self._tap:
+                    self._tap = None
                 if self._audio_media:
                     self._audio_media = None
                 if self._player:
@@ -56,17 +92,14 @@ class Call(pj.Call):
                             self._player.stopTransmit(self._audio_media)
                         self._player = None
                         self._player_start_time = 0
-                        self._current_audio_duration = 0
                     except Exception as e:
                         print(f"[PJSUA] Ошибка при освобождении плеера: {e}")
                         self._player = None  # Принудительно очищаем
                         self._player_start_time = 0
-                        self._current_audio_duration = 0
             except Exception as e:
                 print(f"[PJSUA] Ошибка при освобождении медиа ресурсов: {e}")
-            if hasattr(self.acc.sip_event_queue, 'current_call'):
-                self.acc.sip_event_queue.current_call = None
-            Call.current = None
+            if self.session:
+                remove_session(self.session.call_id)
             if self._stt_session:
                 self._stt_session.close()
             
@@ -86,56 +119,112 @@ class Call(pj.Call):
         ci = self.getInfo()
         for mi in ci.media:
             if mi.type == pj.PJMEDIA_TYPE_AUDIO and mi.status == pj.PJSUA_CALL_MEDIA_ACTIVE:
-                print("[PJSUA] Медиа активно, запускаем запись аудиофайла...")
+                print("[PJSUA] Медиа активно, подключаем аудио звонка к STT...")
+                codec_clock_rate = None
                 try:
                     si = self.getStreamInfo(mi.index)
+                    codec_clock_rate = si.codecClockRate
                     print(f"[PJSUA] Кодек: {si.codecName} @ {si.codecClockRate} Hz")
                 except Exception as e:
                     print(f"[PJSUA] Не удалось получить информацию о кодеке: {e}")
-                self.start_audio_streaming(mi.index)
+                self.start_audio_streaming(mi.index, codec_clock_rate)
+
+    def create_stt_session(self, recording_filename=None):
+        """
+        Берёт STT-сессию звонка (stt.base.STTSession) из пула соединений.
+        Если пул пуст, сессия ещё не подключена; аудио, пришедшее до
+        подключения, копится в её буфере.
 
-    def connect_stt_session(self, filename):
-        self._recording_filename = filename
-        self._stt_session = DeepgramSTTSession(filename)
-        self._stt_session.connect()
+        Args:
+            recording_filename (str): Путь для записи звонка в WAV; None — без записи
 
-    def _get_audio_duration(self, audio_file_path):
-        try:
-            with wave.open(audio_file_path, 'rb') as wav_file:
-                frames = wav_file.getnframes()
-                sample_rate = wav_file.getframerate()
-                duration = frames / float(sample_rate)
-                return duration
-        except Exception as e:
-            print(f"[AUDIO] Не удалось определить длительность файла {audio_file_path}: {e}")
-            return 0
+        Returns:
+            STTSession: сессия звонка; connect() для подключённой сессии не блокирует
+        """
+        self._recording_filename = recording_filename
+        call_id = self.session.call_id if self.session else None
+        self._stt_session = get_stt_pool().acquire(call_id)
+        if self.session:
+            self.session.stt_session = self._stt_session
+        return self._stt_session
 
-    def check_pending_audio(self):
+    def connect_stt_session(self, recording_filename=None):
         """
-        Проверяет естественное окончание воспроизведения.
-        Должен вызываться из основного потока.
+        Создает и подключает STT-сессию звонка.
+
+        Args:
+            recording_filename (str): Путь для записи звонка в WAV; None — без записи
+        """
+        self.create_stt_session(recording_filename).connect()
+
+    def ensure_stt_connected(self):
+        """
+        Дожидается подключения STT-сессии звонка. Если подключиться не удалось,
+        ошибка учитывается пулом (переключение на резерв), а звонок получает
+        сессию резервного движка.
         """
+        stt_session = self._stt_session
+        if not stt_session:
+            return
+        try:
+            stt_session.connect()
+            return
+        except Exception as e:
+            print(f"[STT] Не удалось подключить {stt_session.name}: {e}")
+        fallback = get_stt_pool().connect_failed(stt_session)
+        if fallback is None:
+            print("[STT] Резервного движка нет, звонок остаётся без распознавания")
+            return
+        self._stt_session = fallback
+        self._stt_fallback = True
+        if self.session:
+            self.session.stt_session = fallback
+        if self.stop_streaming.is_set():
+            # Звонок завершился, пока шло подключение
+            fallback.close()
+            return
+        print(f"[STT] Звонок переключен на {fallback.name}")
+        try:
+            fallback.connect()
+        except Exception as e:
+            print(f"[STT] Не удалось подключить {fallback.name}: {e}")
+
+    def _on_player_eof(self, player):
+        # Вызывается из медиапотока: переносим обработку в диспетчер
+        get_dispatcher().post(self._finish_file_playback, player)
+
+    def _finish_file_playback(self, player):
+        if player is not self._player:
+            return  # плеер уже остановлен или заменён
         try:
-            # Проверка окончания воспроизведения
-            if (self._player and self._player_start_time > 0):
-                elapsed_time = time.time() - self._player_start_time
-                
-                # Сначала проверяем естественное окончание по длительности файла
-                if (self._current_audio_duration > 0 and 
-                    elapsed_time >= self._current_audio_duration + 0.5):  # +0.5с буфер
-                    print(f"[AUDIO] Воспроизведение завершено естественным образом ({self._current_audio_duration:.1f}с)")
-                    self.stop_audio_playback()
-                # Затем проверяем таймаут как запасной вариант
-                elif elapsed_time > self._max_playback_duration:
-                    print(f"[AUDIO] Принудительная остановка воспроизведения по таймауту ({self._max_playback_duration}с)")
-                    self.stop_audio_playback()
-                
+            if self._audio_media:
+                player.stopTransmit(self._audio_media)
         except Exception as e:
-            print(f"[AUDIO] Ошибка в check_pending_audio: {e}")
+            print(f"[AUDIO] Ошибка при освобождении плеера: {e}")
+        self._player = None
+        self._player_start_time = 0
+        print(f"[AUDIO] Воспроизведение завершено: {os.path.basename(player.path)} ({player.duration:.1f}с)")
+        self._emit_playback_finished(source='file', path=player.path,
+                                     duration=player.duration, interrupted=False)
+
+    def _on_player_watchdog(self, player):
+        # Плеер не сообщил EOF (например, файл обрезан): иначе плейлист звонка встанет
+        if player is not self._player:
+            return
+        print(f"[AUDIO] Нет EOF от плеера, воспроизведение завершено по таймеру: {os.path.basename(player.path)}")
+        self._finish_file_playback(player)
+
+    def _emit_playback_finished(self, source, path=None, duration=0.0, interrupted=False):
+        if self.session:
+            self.session.emit_playback_finished(source=source, path=path,
+                                                duration=duration, interrupted=interrupted)
 
     def play_audio_file(self, audio_file_path, loop=False):
         """
-        Универсальный метод для воспроизведения аудиофайла абоненту.
+        Воспроизводит аудиофайл абоненту плеером pjsua.
+        Об окончании файла сообщает событие playback finished сессии звонка.
+        Реплики агента ставятся в плейлист сессии; напрямую этот метод нужен
+        только для файлов, формат которых не совпадает с форматом порта.
 
         Args:
             audio_file_path (str): Путь к аудиофайлу
@@ -157,26 +246,20 @@ class Call(pj.Call):
         try:
             # Остановка предыдущего плеера если он есть
             if self._player:
-                try:
-                    self._player.stopTransmit(self._audio_media)
-                    self._player = None
-                    # Небольшая пауза для стабилизации медиа потока
-                    time.sleep(0.01)
-                except Exception as e:
-                    print(f"[AUDIO] Предупреждение при остановке предыдущего плеера: {e}")
-            
-            # Определяем длительность файла перед воспроизведением
-            self._current_audio_duration = self._get_audio_duration(audio_file_path)
+                self.stop_audio_playback()
             
             # Создание и запуск нового плеера
-            self._player = pj.AudioMediaPlayer()
-            self._player.createPlayer(audio_file_path, pj.PJMEDIA_FILE_NO_LOOP if not loop else 0)
+            player = EofAudioPlayer(audio_file_path, self._on_player_eof).create(loop)
             
             # Правильная последовательность: сначала запускаем передачу от плеера к медиа
-            self._player.startTransmit(self._audio_media)
-            self._player_start_time = time.time()  # Запоминаем время начала
+            self._player = player
+            player.startTransmit(self._audio_media)
+            self._player_start_time = time.monotonic()  # Запоминаем время начала
+            if not loop:
+                deadline = player.duration + PLAYER_EOF_GRACE if player.duration > 0 else MAX_FILE_PLAYBACK
+                get_dispatcher().call_later(deadline, self._on_player_watchdog, player)
             
-            duration_info = f" (длительность: {self._current_audio_duration:.1f}с)" if self._current_audio_duration > 0 else ""
+            duration_info = f" (длительность: {player.duration:.1f}с)" if player.duration > 0 else ""
             print(f"[AUDIO] Воспроизведение началось: {os.path.basename(audio_file_path)}{duration_info}")
             return True
             
@@ -187,41 +270,92 @@ class Call(pj.Call):
 
     def stop_audio_playback(self):
         """
-        Останавливает текущее воспроизведение аудио.
+        Останавливает текущее воспроизведение файла.
         
         Returns:
             bool: True если остановка прошла успешно, False в противном случае
         """
-        if not self._player:
+        player = self._player
+        if not player:
             return True
             
+        self._player = None
+        self._player_start_time = 0
         try:
             # Правильная последовательность: сначала остановка передачи, потом очистка
             if self._audio_media:
-                self._player.stopTransmit(self._audio_media)
-            self._player = None
-            self._player_start_time = 0  # Сбрасываем время
-            self._current_audio_duration = 0  # Сбрасываем длительность
+                player.stopTransmit(self._audio_media)
             print("[AUDIO] Воспроизведение остановлено")
             return True
         except Exception as e:
             print(f"[AUDIO] Ошибка при остановке воспроизведения: {e}")
-            self._player = None  # Принудительно очищаем даже при ошибке
-            self._player_start_time = 0
-            self._current_audio_duration = 0
             return False
+        finally:
+            self._emit_playback_finished(source='file', path=player.path,
+                                         duration=player.duration, interrupted=True)
+
+    def file_playback_progress(self):
+        """
+        Возвращает долю проигранного текущего файла (0..1) или None,
+        если файл не воспроизводится либо его длительность неизвестна.
+        """
+        player = self._player
+        if not player or self._player_start_time <= 0 or player.duration <= 0:
+            return None
+        elapsed = time.monotonic() - self._player_start_time
+        return min(1.0, elapsed / player.duration)
 
-    def start_audio_streaming(self, media_index):
+    def _ingest_rate(self, codec_clock_rate):
+        """
+        Частота, с которой аудио звонка передаётся в STT и запись.
+        Узкополосные кодеки (PCMU/PCMA, 8 кГц) передаются на родной частоте:
+        передискретизация до 16 кГц не добавляет информации, а удваивает трафик.
+        """
+        if self.session and self.session.ingest_rate:
+            return self.session.ingest_rate
+        if STT_NATIVE_RATE and codec_clock_rate == NARROWBAND_RATE:
+            return NARROWBAND_RATE
+        return STT_RATE
+
+    def _use_stt_rate(self, sample_rate):
+        """Заменяет STT-сессию звонка на сессию с нужной частотой, если она ещё не запущена"""
+        if not self._stt_session or self._stt_session.sample_rate == sample_rate:
+            return
+        pool = get_stt_pool()
+        backend = self._stt_session.name
+        pool.release(self._stt_session)
+        call_id = self.session.call_id if self.session else None
+        if self._stt_fallback:
+            # Не возвращаемся к движку, к которому звонок не смог подключиться
+            self._stt_session = create_stt_session(backend, call_id, sample_rate)
+        else:
+            self._stt_session = pool.acquire(call_id, sample_rate)
+        if self.session:
+            self.session.stt_session = self._stt_session
+        print(f"[PJSUA] STT переключен на {sample_rate} Гц")
+
+    def start_audio_streaming(self, media_index, codec_clock_rate=None):
         if self.audio_streaming:
             return
         self.audio_streaming = True
-        filename = self._recording_filename
-        print(f"[PJSUA] Запись идёт: {filename}")
         try:
-            self._recorder = pj.AudioMediaRecorder()
-            self._recorder.createRecorder(filename)
             self._audio_media = pj.AudioMedia.typecastFromMedia(self.getMedia(media_index))
-            self._audio_media.startTransmit(self._recorder)
+            ingest_rate = self._ingest_rate(codec_clock_rate)
+            self._use_stt_rate(ingest_rate)
+            # Порт на частоте ingest_rate: мост сам приводит к ней аудио звонка
+            self._tap = AudioTapPort(clock_rate=ingest_rate).create(f"tap_{self.getId()}")
+            if self._stt_session:
+                self._tap.add_sink(self._stt_session.feed_audio)
+            if self._recording_filename:
+                self._wav_writer = BackgroundWavWriter(self._recording_filename, clock_rate=ingest_rate).start()
+                self._tap.add_sink(self._wav_writer.write)
+                print(f"[PJSUA] Запись идёт: {self._recording_filename}")
+            self._audio_media.startTransmit(self._tap)
+            self._stream_port = StreamingPlayerPort().create(f"tts_{self.getId()}")
+            self._stream_port.startTransmit(self._audio_media)
+            if self.session:
+                # Клипы, поставленные до появления медиа, начинают играть сейчас
+                self.session.playlist.kick()
             if self._stt_session:
                 self._stt_session.start_streaming()
             
@@ -230,26 +364,29 @@ class Call(pj.Call):
             return
 
     def _start_post_call_processing(self):
-        """Запускает постобработку завершенного звонка"""
+        """Запускает постобработку завершенного звонка и сворачивает журнал истории"""
+        history = self.session.history if self.session else None
         try:
             # Проверяем наличие ID лида
-            if not hasattr(self, 'lead_id') or not self.lead_id:
+            if not self.lead_id:
                 print("[POST_PROCESSOR] Нет ID лида для постобработки")
                 return
             
-            # Загружаем историю диалога
-            from llm.groq_agent import get_llm_agent
-            agent = get_llm_agent()
-            history = agent._load_history(self.lead_id)
+            # История звонка уже в памяти, с диска не перечитывается
+            messages = history.snapshot() if history else []
             
-            if not history:
+            if not messages:
                 print(f"[POST_PROCESSOR] Нет истории для лида {self.lead_id}")
                 return
             
             # Запускаем постобработку
             from llm.post_call_processor import process_call_end
-            process_call_end(self.lead_id, history)
+            process_call_end(self.lead_id, messages)
             print(f"[POST_PROCESSOR] Постобработка запущена для лида {self.lead_id}")
             
         except Exception as e:
-            print(f"[POST_PROCESSOR] Ошибка запуска постобработки: {e}")
\ No newline at end of file
+            print(f"[POST_PROCESSOR] Ошибка запуска постобработки: {e}")
+        finally:
+            # Краткое содержание для следующих звонков лида считается в фоне
+            schedule_summary(history)
+            close_dialog_history(history, self.session)
\ No newline at end of file
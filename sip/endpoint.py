@@ -1,5 +1,6 @@
 import pjsua2 as pj
 import logging
+from config import MAX_CALLS
 
 def create_endpoint():
     ep = pj.Endpoint()
@@ -8,7 +9,7 @@ def create_endpoint():
     ep_cfg = pj.EpConfig()
     ep_cfg.logConfig.level = 2
     ep_cfg.logConfig.consoleLevel = 2
-    ep_cfg.uaConfig.maxCalls = 4
+    ep_cfg.uaConfig.maxCalls = MAX_CALLS
     ep_cfg.medConfig.quality = 6
     ep_cfg.uaConfig.userAgent = "Python SIP Agent"
     ep_cfg.medConfig.sndClockRate = 16000
@@ -0,0 +1,117 @@
+"""
+Диспетчер медиа-задач PJSUA.
+
+Все операции с объектами pjsua (плееры, порты, ответ на звонок) должны
+выполняться в потоке, зарегистрированном в pjlib. Диспетчер владеет таким
+потоком: задачи из любых потоков ставятся через post(), отложенные — через
+call_later(). Поток просыпается сразу при появлении задачи или наступлении
+таймера, а без работы спит на условной переменной и не расходует CPU.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+
+class TimerHandle:
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class MediaDispatcher:
+    def __init__(self, name: str = "media_dispatcher"):
+        self.name = name
+        self._cond = threading.Condition()
+        self._tasks = deque()
+        self._timers = []
+        self._seq = itertools.count()
+        self._stopped = False
+        self._thread_ident = None
+
+    def post(self, fn: Callable, *args) -> None:
+        """Ставит задачу на выполнение в потоке диспетчера. Безопасно из любого потока."""
+        with self._cond:
+            self._tasks.append((fn, args))
+            self._cond.notify()
+
+    def call_later(self, delay: float, fn: Callable, *args) -> TimerHandle:
+        """Выполняет задачу в потоке диспетчера через delay секунд"""
+        handle = TimerHandle(time.monotonic() + max(0.0, delay))
+        with self._cond:
+            heapq.heappush(self._timers, (handle.deadline, next(self._seq), handle, fn, args))
+            self._cond.notify()
+        return handle
+
+    def in_dispatcher_thread(self) -> bool:
+        return threading.get_ident() == self._thread_ident
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def run_forever(self) -> None:
+        """
+        Обрабатывает задачи в текущем потоке до вызова stop().
+        Поток должен быть зарегистрирован в pjlib (основной поток — уже зарегистрирован).
+        """
+        self._thread_ident = threading.get_ident()
+        logging.info(f"[DISPATCH] Диспетчер {self.name} запущен")
+        while True:
+            with self._cond:
+                while not self._stopped and not self._tasks and not self._due_timer_ready():
+                    timeout = None
+                    if self._timers:
+                        timeout = max(0.0, self._timers[0][0] - time.monotonic())
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    break
+                batch = list(self._tasks)
+                self._tasks.clear()
+                now = time.monotonic()
+                while self._timers and self._timers[0][0] <= now:
+                    _, _, handle, fn, args = heapq.heappop(self._timers)
+                    if not handle.cancelled:
+                        batch.append((fn, args))
+            for fn, args in batch:
+                try:
+                    fn(*args)
+                except Exception:
+                    logging.exception(f"[DISPATCH] Ошибка в задаче {getattr(fn, '__name__', fn)}")
+        logging.info(f"[DISPATCH] Диспетчер {self.name} остановлен")
+
+    def start_in_thread(self, endpoint) -> threading.Thread:
+        """Запускает диспетчер в отдельном потоке, зарегистрированном в pjlib"""
+        def run():
+            endpoint.libRegisterThread(self.name)
+            self.run_forever()
+        thread = threading.Thread(target=run, name=self.name, daemon=True)
+        thread.start()
+        return thread
+
+    def _due_timer_ready(self) -> bool:
+        # Отменённые таймеры выбрасываем сразу, чтобы не просыпаться ради них
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        return bool(self._timers) and self._timers[0][0] <= time.monotonic()
+
+
+_dispatcher: Optional[MediaDispatcher] = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher() -> MediaDispatcher:
+    """Получает глобальный диспетчер медиа-задач"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = MediaDispatcher()
+        return _dispatcher
@@ -0,0 +1,225 @@
+"""
+Пользовательские медиапорты PJSUA.
+
+AudioTapPort подключается к конференц-мосту как приёмник аудио звонка и
+передаёт каждый 10-мс кадр PCM подписчикам (STT, запись) прямо из памяти,
+без промежуточного WAV-файла.
+
+StreamingPlayerPort — источник аудио для звонка: мост забирает из него кадры
+по медиачасам, а TTS дописывает PCM по мере получения байтов от API.
+
+EofAudioPlayer — файловый плеер, сообщающий об окончании файла колбэком.
+
+Колбэки портов и плееров вызываются из медиапотока pjsua: в них нельзя
+останавливать или удалять медиаобъекты, только передавать событие дальше.
+"""
+
+import logging
+import threading
+from collections import deque
+from typing import Callable, List
+
+import pjsua2 as pj
+
+from .pcm_buffer import PcmRingBuffer, SAMPLE_WIDTH
+FRAME_MS = 10
+
+
+def _create_audio_format(clock_rate: int, frame_ms: int = FRAME_MS) -> pj.MediaFormatAudio:
+    fmt = pj.MediaFormatAudio()
+    fmt.type = pj.PJMEDIA_TYPE_AUDIO
+    fmt.clockRate = clock_rate
+    fmt.channelCount = 1
+    fmt.bitsPerSample = SAMPLE_WIDTH * 8
+    fmt.frameTimeUsec = frame_ms * 1000
+    fmt.avgBps = clock_rate * SAMPLE_WIDTH * 8
+    fmt.maxBps = fmt.avgBps
+    return fmt
+
+
+class AudioTapPort(pj.AudioMediaPort):
+    """Приёмник аудио звонка, раздающий PCM-кадры подписчикам"""
+
+    def __init__(self, clock_rate: int = 16000):
+        pj.AudioMediaPort.__init__(self)
+        self.clock_rate = clock_rate
+        self._sinks: List[Callable[[bytes], None]] = []
+        self.frames_received = 0
+
+    def create(self, name: str) -> "AudioTapPort":
+        self.createPort(name, _create_audio_format(self.clock_rate))
+        return self
+
+    def add_sink(self, sink: Callable[[bytes], None]) -> None:
+        """
+        Добавляет подписчика на кадры. Подписчик вызывается из медиапотока
+        pjsua, поэтому должен только складывать данные в буфер.
+        """
+        self._sinks.append(sink)
+
+    def remove_sink(self, sink: Callable[[bytes], None]) -> None:
+        if sink in self._sinks:
+            self._sinks.remove(sink)
+
+    def onFrameReceived(self, frame):
+        if frame.type != pj.PJMEDIA_FRAME_TYPE_AUDIO:
+            return
+        data = bytes(frame.buf)
+        if not data:
+            return
+        self.frames_received += 1
+        for sink in self._sinks:
+            try:
+                sink(data)
+            except Exception as e:
+                logging.error(f"[PJSUA] Ошибка подписчика аудио: {e}")
+
+
+class StreamingPlayerPort(pj.AudioMediaPort):
+    """
+    Источник аудио для звонка с буфером на стороне записи.
+
+    Создаётся один раз на звонок и остаётся подключенным к медиа звонка,
+    вместо создания AudioMediaPlayer на каждую реплику. Перед началом
+    воспроизведения потока накапливается prebuffer_ms аудио, чтобы
+    неравномерная доставка чанков от TTS не приводила к обрывам.
+
+    Счётчики written_bytes и played_bytes монотонны за всё время звонка,
+    поэтому позиция в потоке однозначно указывает на байт конкретного клипа.
+    Метки (add_mark) вызываются из медиапотока, когда проигрывание доходит
+    до заданной позиции.
+    """
+
+    def __init__(self, clock_rate: int = 16000, prebuffer_ms: int = 60, max_seconds: int = 120):
+        pj.AudioMediaPort.__init__(self)
+        self.clock_rate = clock_rate
+        self.frame_bytes = clock_rate * SAMPLE_WIDTH * FRAME_MS // 1000
+        self.prebuffer_bytes = clock_rate * SAMPLE_WIDTH * prebuffer_ms // 1000
+        self.buffer = PcmRingBuffer(clock_rate * SAMPLE_WIDTH * max_seconds)
+        self._lock = threading.Lock()
+        self._stream_open = False
+        self._buffering = True
+        self._pending = b""  # нечётный байт между чанками TTS
+        self._marks = deque()
+        self.underruns = 0
+        self.written_bytes = 0
+        self.played_bytes = 0
+
+    def create(self, name: str) -> "StreamingPlayerPort":
+        self.createPort(name, _create_audio_format(self.clock_rate))
+        return self
+
+    @property
+    def bytes_per_second(self) -> int:
+        return self.clock_rate * SAMPLE_WIDTH
+
+    def begin_stream(self) -> None:
+        """Сообщает, что в порт будут поступать данные (недогрузка — это обрыв)"""
+        with self._lock:
+            self._stream_open = True
+
+    def write(self, data: bytes) -> None:
+        """Дописывает PCM 16 бит моно. Безопасно вызывать из любого потока."""
+        with self._lock:
+            data = self._pending + data
+            if len(data) % SAMPLE_WIDTH:
+                self._pending = data[-1:]
+                data = data[:-1]
+            else:
+                self._pending = b""
+            self.written_bytes += len(data)
+            self.buffer.write(data)
+
+    def end_stream(self) -> None:
+        """Сообщает, что новых данных пока не будет: буфер доигрывается до конца"""
+        with self._lock:
+            self._stream_open = False
+            self._pending = b""
+
+    def add_mark(self, offset: int, callback: Callable[[], None]) -> None:
+        """
+        Вызывает callback из медиапотока, когда played_bytes достигнет offset.
+        Метки должны добавляться в порядке возрастания offset.
+        """
+        with self._lock:
+            if offset > self.played_bytes:
+                self._marks.append((offset, callback))
+                return
+        callback()
+
+    def stop(self) -> int:
+        """Прерывает воспроизведение и возвращает количество отброшенных байт"""
+        with self._lock:
+            self._stream_open = False
+            self._buffering = True
+            self._pending = b""
+            self._marks.clear()
+            dropped = self.buffer.clear()
+            self.written_bytes = self.played_bytes
+        return dropped
+
+    def is_active(self) -> bool:
+        """True, если поток открыт или в буфере остались данные"""
+        with self._lock:
+            stream_open = self._stream_open
+        return stream_open or self.buffer.available() > 0
+
+    def _next_frame(self):
+        reached = []
+        with self._lock:
+            available = self.buffer.available()
+            if self._buffering:
+                # Ждём предбуфер; хвост закрытого потока доигрываем сразу
+                if available < self.prebuffer_bytes and (self._stream_open or not available):
+                    return None
+                self._buffering = False
+            if not available:
+                if self._stream_open:
+                    self.underruns += 1
+                self._buffering = True
+                return None
+            data = self.buffer.read(self.frame_bytes)
+            self.played_bytes += len(data)
+            while self._marks and self._marks[0][0] <= self.played_bytes:
+                reached.append(self._marks.popleft()[1])
+        for callback in reached:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"[AUDIO] Ошибка обработчика метки воспроизведения: {e}")
+        if len(data) < self.frame_bytes:
+            data += b"\x00" * (self.frame_bytes - len(data))
+        return data
+
+    def onFrameRequested(self, frame):
+        data = self._next_frame()
+        if data is None:
+            frame.type = pj.PJMEDIA_FRAME_TYPE_NONE
+            frame.size = 0
+            return
+        frame.type = pj.PJMEDIA_FRAME_TYPE_AUDIO
+        frame.buf = pj.ByteVector(data)
+        frame.size = len(data)
+
+
+class EofAudioPlayer(pj.AudioMediaPlayer):
+    """Файловый плеер, сообщающий об окончании файла через on_eof"""
+
+    def __init__(self, path: str, on_eof: Callable[["EofAudioPlayer"], None]):
+        pj.AudioMediaPlayer.__init__(self)
+        self.path = path
+        self._on_eof = on_eof
+        self.duration = 0.0
+
+    def create(self, loop: bool = False) -> "EofAudioPlayer":
+        self.createPlayer(self.path, 0 if loop else pj.PJMEDIA_FILE_NO_LOOP)
+        try:
+            clock_rate = self.getPortInfo().format.clockRate
+            if clock_rate:
+                self.duration = self.getInfo().sizeSamples / float(clock_rate)
+        except Exception as e:
+            logging.warning(f"[AUDIO] Не удалось определить длительность {self.path}: {e}")
+        return self
+
+    def onEof2(self):
+        self._on_eof(self)
@@ -0,0 +1,85 @@
+"""
+Ограниченный кольцевой буфер PCM-кадров.
+
+Буфер связывает медиапоток pjsua (колбэки портов вызываются из потока
+конференц-моста) с потребителями: отправкой аудио в STT и воспроизведением.
+Запись никогда не блокирует медиапоток: при переполнении отбрасываются
+самые старые данные.
+"""
+
+import threading
+from collections import deque
+from typing import Callable, Optional
+
+SAMPLE_WIDTH = 2  # 16 бит на отсчёт
+
+
+class PcmRingBuffer:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._chunks = deque()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._waker: Optional[Callable[[], None]] = None
+        self.dropped_bytes = 0
+
+    def set_waker(self, waker: Optional[Callable[[], None]]) -> None:
+        """
+        Устанавливает функцию, вызываемую при появлении данных в пустом буфере.
+        Функция вызывается из потока писателя и не должна блокироваться.
+        """
+        self._waker = waker
+
+    def write(self, data: bytes) -> None:
+        if not data:
+            return
+        with self._lock:
+            was_empty = self._size == 0
+            self._chunks.append(data)
+            self._size += len(data)
+            while self._size > self.max_bytes and self._chunks:
+                old = self._chunks.popleft()
+                self._size -= len(old)
+                self.dropped_bytes += len(old)
+        waker = self._waker
+        if was_empty and waker:
+            waker()
+
+    def read(self, max_bytes: Optional[int] = None) -> bytes:
+        """
+        Забирает из буфера до max_bytes байт (по умолчанию — всё, что есть).
+        """
+        with self._lock:
+            if not self._chunks:
+                return b""
+            if max_bytes is None or max_bytes >= self._size:
+                data = b"".join(self._chunks)
+                self._chunks.clear()
+                self._size = 0
+                return data
+            parts = []
+            need = max_bytes
+            while need > 0 and self._chunks:
+                chunk = self._chunks.popleft()
+                if len(chunk) > need:
+                    parts.append(chunk[:need])
+                    self._chunks.appendleft(chunk[need:])
+                    need = 0
+                else:
+                    parts.append(chunk)
+                    need -= len(chunk)
+            data = b"".join(parts)
+            self._size -= len(data)
+            return data
+
+    def clear(self) -> int:
+        """Очищает буфер и возвращает количество отброшенных байт"""
+        with self._lock:
+            size = self._size
+            self._chunks.clear()
+            self._size = 0
+            return size
+
+    def available(self) -> int:
+        with self._lock:
+            return self._size
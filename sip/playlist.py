@@ -0,0 +1,306 @@
+"""
+Упорядоченный плейлист звонка.
+
+Все реплики агента (потоковый TTS, готовые файлы) воспроизводятся через
+один StreamingPlayerPort звонка. Плейлист передаёт PCM клипов в порт строго
+по очереди: данные следующего клипа дописываются сразу за концом текущего,
+поэтому клипы звучат встык, без пауз и без обрезания. Пока клип ждёт своей
+очереди, его данные копятся в памяти.
+
+Клипы с меньшим priority обгоняют ожидающие клипы (но не уже переданный
+в порт звук); interrupt=True сбрасывает всё, что играет и ждёт.
+Файлы в формате, отличном от формата порта, проигрываются плеером pjsua
+(EofAudioPlayer) после того, как порт доиграет предыдущие клипы.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+import wave
+from typing import List, Optional
+
+from .media_dispatcher import get_dispatcher
+from .pcm_buffer import SAMPLE_WIDTH
+
+PRIORITY_URGENT = 0   # короткие реплики при перебивании
+PRIORITY_HIGH = 5     # заполнители пауз ("секунду...")
+PRIORITY_NORMAL = 10  # обычные ответы агента
+
+
+class Clip:
+    kind = 'clip'
+
+    def __init__(self, playlist: "Playlist", priority: int, label: str):
+        self._playlist = playlist
+        self.priority = priority
+        self.label = label
+        self.seq = 0
+        self.cancelled = False
+        self.closed = False      # все данные клипа получены
+        self.start_offset = None  # позиция первого байта клипа в потоке порта
+        self.written = 0         # сколько байт клипа передано в порт
+        self._chunks: List[bytes] = []  # данные, ожидающие очереди клипа
+        self.needs_player = False
+
+    def __lt__(self, other: "Clip") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    @property
+    def duration(self) -> float:
+        return self.written / float(self._playlist.bytes_per_second)
+
+    def played_bytes(self, port) -> int:
+        """Сколько байт клипа уже прозвучало"""
+        if self.start_offset is None or port is None:
+            return 0
+        return max(0, min(self.written, port.played_bytes - self.start_offset))
+
+
+class StreamClip(Clip):
+    """Клип, данные которого поступают по частям (потоковый TTS)"""
+    kind = 'stream'
+
+    def write(self, data: bytes) -> None:
+        self._playlist._write(self, data)
+
+    def close(self) -> None:
+        self._playlist._close(self)
+
+
+class FileClip(Clip):
+    """Клип из готового WAV-файла"""
+    kind = 'file'
+
+    def __init__(self, playlist: "Playlist", path: str, priority: int, label: str):
+        super().__init__(playlist, priority, label or os.path.basename(path))
+        self.path = path
+        pcm = _read_pcm(path, playlist.clock_rate)
+        if pcm is None:
+            self.needs_player = True
+        else:
+            self._chunks.append(pcm)
+        self.closed = True
+
+
+def _read_pcm(path: str, clock_rate: int) -> Optional[bytes]:
+    """Читает WAV целиком, если он в формате порта (моно, 16 бит, clock_rate)"""
+    try:
+        with wave.open(path, 'rb') as wav:
+            if (wav.getnchannels() != 1 or wav.getsampwidth() != SAMPLE_WIDTH
+                    or wav.getframerate() != clock_rate):
+                return None
+            return wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None
+
+
+class Playlist:
+    def __init__(self, session, clock_rate: int = 16000):
+        self.session = session
+        self.clock_rate = clock_rate
+        self._lock = threading.RLock()
+        self._pending: List[Clip] = []  # куча по (priority, seq)
+        self._feeding: Optional[Clip] = None  # клип, данные которого сейчас идут в порт
+        self._in_port: List[Clip] = []  # переданы в порт, но ещё не доиграны
+        self._player_clip: Optional[FileClip] = None
+        self._seq = itertools.count()
+        self.clips_played = 0
+        self.clips_interrupted = 0
+        session.on_playback_finished(self._on_player_finished)
+
+    @property
+    def bytes_per_second(self) -> int:
+        return self.clock_rate * SAMPLE_WIDTH
+
+    def _port(self):
+        call = self.session.call
+        return call.stream_port if call else None
+
+    def enqueue_file(self, path: str, priority: int = PRIORITY_NORMAL, interrupt: bool = False,
+                     label: str = "") -> Optional[FileClip]:
+        """
+        Ставит WAV-файл в очередь. Безопасно вызывать из любого потока.
+
+        Returns:
+            FileClip или None, если файл не найден
+        """
+        if not os.path.exists(path):
+            logging.error(f"[PLAYLIST] Файл не найден: {path}")
+            return None
+        clip = FileClip(self, path, priority, label)
+        self._add(clip, interrupt)
+        return clip
+
+    def open_stream(self, priority: int = PRIORITY_NORMAL, interrupt: bool = False,
+                    label: str = "") -> StreamClip:
+        """
+        Создает потоковый клип: данные пишутся через write(), окончание — close().
+        Безопасно вызывать из любого потока.
+        """
+        clip = StreamClip(self, priority, label)
+        self._add(clip, interrupt)
+        return clip
+
+    def depth(self) -> int:
+        """Количество клипов, которые играют или ждут очереди"""
+        with self._lock:
+            return (len(self._pending) + len(self._in_port)
+                    + (1 if self._player_clip else 0))
+
+    def is_active(self) -> bool:
+        return self.depth() > 0
+
+    def stats(self) -> dict:
+        port = self._port()
+        with self._lock:
+            return {
+                'depth': self.depth(),
+                'pending': len(self._pending),
+                'clips_played': self.clips_played,
+                'clips_interrupted': self.clips_interrupted,
+                'underruns': port.underruns if port else 0,
+            }
+
+    def kick(self) -> None:
+        """Запускает очередь (например, когда у звонка появился медиапорт)"""
+        with self._lock:
+            self._advance_locked()
+
+    def clear(self) -> int:
+        """
+        Прерывает воспроизведение и сбрасывает все клипы.
+
+        Returns:
+            int: Количество отменённых клипов
+        """
+        port = self._port()
+        with self._lock:
+            interrupted = list(self._in_port)
+            cancelled = interrupted + list(self._pending)
+            if self._feeding and self._feeding not in cancelled:
+                cancelled.append(self._feeding)
+            player_clip = self._player_clip
+            if player_clip:
+                cancelled.append(player_clip)
+            for clip in cancelled:
+                clip.cancelled = True
+                clip._chunks = []
+            self._pending = []
+            self._feeding = None
+            self._in_port = []
+            self._player_clip = None
+            self.clips_interrupted += len(interrupted) + (1 if player_clip else 0)
+            if port:
+                port.stop()
+        dispatcher = get_dispatcher()
+        if player_clip and self.session.call:
+            dispatcher.post(self.session.call.stop_audio_playback)
+        for clip in interrupted:
+            dispatcher.post(self._emit, clip, True)
+        return len(cancelled)
+
+    def _add(self, clip: Clip, interrupt: bool) -> None:
+        if interrupt:
+            self.clear()
+        with self._lock:
+            clip.seq = next(self._seq)
+            heapq.heappush(self._pending, clip)
+            self._advance_locked()
+
+    def _write(self, clip: Clip, data: bytes) -> None:
+        with self._lock:
+            if clip.cancelled or clip.closed:
+                return
+            if clip is self._feeding:
+                self._feed(clip, data)
+            else:
+                clip._chunks.append(data)
+
+    def _close(self, clip: Clip) -> None:
+        with self._lock:
+            if clip.closed:
+                return
+            clip.closed = True
+            if clip is self._feeding:
+                self._finish_feeding_locked()
+                self._advance_locked()
+
+    def _feed(self, clip: Clip, data: bytes) -> None:
+        self._port().write(data)
+        clip.written += len(data)
+
+    def _advance_locked(self) -> None:
+        port = self._port()
+        if port is None:
+            return
+        while self._feeding is None and self._pending and self._player_clip is None:
+            clip = self._pending[0]
+            if clip.needs_player:
+                # Файл в другом формате играет плеер pjsua после того, как порт доиграет
+                if self._in_port:
+                    break
+                heapq.heappop(self._pending)
+                self._player_clip = clip
+                get_dispatcher().post(self._start_player, clip)
+                break
+            heapq.heappop(self._pending)
+            self._feeding = clip
+            port.begin_stream()
+            clip.start_offset = port.written_bytes
+            for chunk in clip._chunks:
+                self._feed(clip, chunk)
+            clip._chunks = []
+            self._in_port.append(clip)
+            if clip.closed:
+                self._finish_feeding_locked()
+        if self._feeding is None:
+            port.end_stream()
+
+    def _finish_feeding_locked(self) -> None:
+        clip = self._feeding
+        self._feeding = None
+        port = self._port()
+        if port is None:
+            return
+        # Метка срабатывает в медиапотоке, когда прозвучит последний байт клипа
+        port.add_mark(port.written_bytes, lambda: get_dispatcher().post(self._on_clip_played, clip))
+
+    def _on_clip_played(self, clip: Clip) -> None:
+        with self._lock:
+            if clip.cancelled or clip not in self._in_port:
+                return
+            self._in_port.remove(clip)
+            self.clips_played += 1
+            self._advance_locked()
+        self._emit(clip, False)
+
+    def _emit(self, clip: Clip, interrupted: bool) -> None:
+        self.session.emit_playback_finished(source=clip.kind, path=getattr(clip, 'path', None),
+                                            duration=clip.duration, interrupted=interrupted,
+                                            clip=clip)
+
+    def _start_player(self, clip: FileClip) -> None:
+        call = self.session.call
+        if clip.cancelled:
+            return
+        if not call or not call.play_audio_file(clip.path):
+            logging.error(f"[PLAYLIST] Не удалось воспроизвести: {clip.path}")
+            with self._lock:
+                if self._player_clip is clip:
+                    self._player_clip = None
+                    self._advance_locked()
+
+    def _on_player_finished(self, session, info: dict) -> None:
+        # События плеера pjsua (без clip) завершают файловый клип
+        if info.get('clip') is not None or info.get('source') != 'file':
+            return
+        with self._lock:
+            clip = self._player_clip
+            if not clip or info.get('path') != clip.path:
+                return
+            self._player_clip = None
+            if not info.get('interrupted'):
+                self.clips_played += 1
+            self._advance_locked()
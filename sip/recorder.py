@@ -0,0 +1,76 @@
+"""
+Фоновая запись аудио звонка в WAV.
+
+Кадры из медиапотока складываются в очередь, а файл пишется в отдельном
+потоке, чтобы дисковый ввод-вывод не задерживал STT и конференц-мост.
+"""
+
+import logging
+import queue
+import threading
+import wave
+from typing import Callable, Optional
+
+from .pcm_buffer import SAMPLE_WIDTH
+
+
+class BackgroundWavWriter:
+    def __init__(self, filename: str, clock_rate: int = 16000, max_pending_frames: int = 3000):
+        self.filename = filename
+        self.clock_rate = clock_rate
+        self._queue = queue.Queue(maxsize=max_pending_frames)
+        self._thread = None
+        self._on_closed = None
+        self.dropped_frames = 0
+
+    def start(self) -> "BackgroundWavWriter":
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def write(self, data: bytes) -> None:
+        """Ставит кадр в очередь записи. Не блокирует вызывающий поток."""
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            self.dropped_frames += 1
+
+    def close(self, timeout: float = 2.0, on_closed: Optional[Callable[[str], None]] = None) -> None:
+        """
+        Завершает запись.
+
+        Args:
+            timeout (float): Сколько ждать записи хвоста очереди
+            on_closed: Если задан, close() не ждёт потока записи, а on_closed(filename)
+                вызывается из него после закрытия файла
+        """
+        if not self._thread:
+            return
+        self._on_closed = on_closed
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            logging.error(f"[REC] Очередь записи переполнена при закрытии {self.filename}")
+            return
+        if on_closed is None:
+            self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def _run(self):
+        try:
+            with wave.open(self.filename, 'wb') as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(SAMPLE_WIDTH)
+                wav.setframerate(self.clock_rate)
+                while True:
+                    data = self._queue.get()
+                    if data is None:
+                        break
+                    wav.writeframesraw(data)
+            if self.dropped_frames:
+                logging.warning(f"[REC] Пропущено кадров при записи {self.filename}: {self.dropped_frames}")
+        except Exception as e:
+            logging.error(f"[REC] Ошибка записи {self.filename}: {e}")
+            return
+        if self._on_closed:
+            self._on_closed(self.filename)
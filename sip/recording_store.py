@@ -0,0 +1,145 @@
+"""
+Хранилище записей звонков.
+
+Каждому звонку выдаётся уникальный путь для WAV. После завершения звонка
+запись перекодируется в компактный формат (по умолчанию Opus в OGG)
+процессом ffmpeg, запущенным из небольшого пула потоков, исходный WAV
+удаляется. Старые записи удаляются по возрасту и суммарному размеру
+каталога, поэтому объём на диске не растёт бесконечно.
+"""
+
+import logging
+import os
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+RECORDINGS_DIR = Path(os.getenv('RECORDINGS_DIR', '/tmp/pjsua_recordings'))
+RECORDINGS_FORMAT = os.getenv('RECORDINGS_FORMAT', 'ogg')  # 'ogg' или 'wav' (без перекодирования)
+RECORDINGS_MAX_MB = int(os.getenv('RECORDINGS_MAX_MB', '2048'))
+RECORDINGS_MAX_AGE_DAYS = float(os.getenv('RECORDINGS_MAX_AGE_DAYS', '14'))
+# Ретеншн сканирует каталог не чаще, чем раз в RETENTION_INTERVAL секунд
+RETENTION_INTERVAL = 60.0
+TRANSCODE_WORKERS = 2
+
+
+def _transcode(wav_path: str, fmt: str) -> str:
+    """
+    Перекодирует WAV и удаляет исходник. Выполняется в потоке пула.
+
+    Returns:
+        str: Путь к итоговому файлу (исходный WAV, если перекодировать не удалось)
+    """
+    if fmt == 'wav':
+        return wav_path
+    out_path = os.path.splitext(wav_path)[0] + '.' + fmt
+    try:
+        subprocess.run(
+            ['ffmpeg', '-y', '-loglevel', 'error', '-i', wav_path,
+             '-c:a', 'libopus', '-b:a', '24k', '-application', 'voip', out_path],
+            check=True, capture_output=True
+        )
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        return wav_path
+    os.remove(wav_path)
+    return out_path
+
+
+class RecordingStore:
+    def __init__(self, root: Path = RECORDINGS_DIR, fmt: str = RECORDINGS_FORMAT,
+                 max_bytes: int = RECORDINGS_MAX_MB * 1024 * 1024,
+                 max_age: float = RECORDINGS_MAX_AGE_DAYS * 86400):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # Кодирует отдельный процесс ffmpeg, потоку пула остаётся только ждать его
+        self._pool = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS, thread_name_prefix="transcode")
+        self._last_retention = 0.0
+
+    def allocate(self, call_id=None) -> str:
+        """Возвращает уникальный путь для WAV-записи нового звонка"""
+        stamp = time.strftime('%Y%m%d_%H%M%S')
+        return str(self.root / f"call_{stamp}_{call_id}_{uuid.uuid4().hex[:8]}.wav")
+
+    def finalize(self, wav_path: str, lead_id=None) -> None:
+        """
+        Ставит завершённую запись на перекодирование. Не блокирует вызывающий поток.
+
+        Args:
+            wav_path (str): Путь, выданный allocate()
+            lead_id (int): ID сделки для лога
+        """
+        if not wav_path or not os.path.exists(wav_path):
+            return
+        future = self._pool.submit(_transcode, wav_path, self.fmt)
+        future.add_done_callback(lambda f: self._on_transcoded(f, wav_path, lead_id))
+
+    def _on_transcoded(self, future, wav_path: str, lead_id) -> None:
+        try:
+            path = future.result()
+        except Exception as e:
+            logging.error(f"[REC] Ошибка перекодирования {wav_path}: {e}")
+            path = wav_path
+        if path == wav_path and self.fmt != 'wav':
+            logging.warning(f"[REC] Запись оставлена в WAV (ffmpeg недоступен?): {wav_path}")
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        logging.info(f"[REC] Запись сохранена: {os.path.basename(path)} ({size // 1024} КБ), lead_id={lead_id}")
+        self.enforce_retention()
+
+    def enforce_retention(self, force: bool = False) -> int:
+        """
+        Удаляет записи старше max_age и самые старые записи сверх max_bytes.
+
+        Returns:
+            int: Количество удалённых файлов
+        """
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_retention < RETENTION_INTERVAL:
+                return 0
+            self._last_retention = now
+
+        files = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and entry.name.startswith('call_'):
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            if path.endswith('.wav') and now - mtime < RETENTION_INTERVAL:
+                continue  # запись ещё может идти или перекодироваться
+            try:
+                os.remove(path)
+                removed += 1
+                total -= size
+            except OSError as e:
+                logging.error(f"[REC] Не удалось удалить {path}: {e}")
+        if removed:
+            logging.info(f"[REC] Ретеншн: удалено записей {removed}, занято {total // (1024 * 1024)} МБ")
+        return removed
+
+
+_store: Optional[RecordingStore] = None
+_store_lock = threading.Lock()
+
+
+def get_recording_store() -> RecordingStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = RecordingStore()
+        return _store
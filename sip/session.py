@@ -0,0 +1,189 @@
+"""
+Реестр сессий звонков.
+
+Каждый входящий вызов получает собственную CallSession, в которой хранится
+всё состояние разговора: объект звонка, ID сделки, STT-сессия, очередь
+воспроизведения и состояние агента. Сессии индексируются по callId pjsua,
+поэтому один процесс обслуживает до maxCalls разговоров одновременно.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .playlist import Playlist
+
+
+class AgentTurn:
+    """
+    Одна реплика агента: от запроса к LLM до окончания воспроизведения.
+    Перебивание клиента отменяет реплику (cancel): задачи запросов к LLM
+    отменяются, запросы TTS прерываются, а cancelled видят все её потоки.
+    """
+
+    def __init__(self, turn_id: int, user_text: str):
+        self.turn_id = turn_id
+        self.user_text = user_text
+        self.reply_text = None  # заполняется после сохранения ответа в историю
+        self.llm_done = False
+        # Фрагменты ответа, отданные в TTS по мере генерации: (текст, клип плейлиста)
+        self.segments: List[Tuple[str, object]] = []
+        self.heard_text = None  # услышанная часть, если клиент перебил до конца генерации
+        # Ключ кэша ответов (llm.response_cache) и PCM фрагментов по индексу для него
+        self.cache_key: Optional[str] = None
+        self.segment_audio: Dict[int, bytes] = {}
+        self.cancelled = threading.Event()
+        # Задачи цикла ввода-вывода с запросами этой реплики (ответ LLM, спекуляция)
+        self.tasks: List[asyncio.Future] = []
+        # Функции, прерывающие запросы реплики вне цикла (потоковый TTS)
+        self._on_cancel: List[Callable[[], None]] = []
+        self._cancel_lock = threading.Lock()
+        # Сериализует сохранение ответа и перебивание
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+
+    def track(self, task: asyncio.Future) -> asyncio.Future:
+        """Привязывает задачу к реплике: перебивание её отменит"""
+        with self._cancel_lock:
+            if not self.cancelled.is_set():
+                self.tasks.append(task)
+                return task
+        task.cancel()
+        return task
+
+    def on_cancel(self, fn: Callable[[], None]) -> Callable[[], None]:
+        """
+        Вызывает fn при отмене реплики (сразу, если она уже отменена).
+        Возвращает функцию, снимающую подписку.
+        """
+        with self._cancel_lock:
+            if not self.cancelled.is_set():
+                self._on_cancel.append(fn)
+                return lambda: self._discard(fn)
+        fn()
+        return lambda: None
+
+    def _discard(self, fn: Callable[[], None]) -> None:
+        with self._cancel_lock:
+            if fn in self._on_cancel:
+                self._on_cancel.remove(fn)
+
+    def cancel(self) -> None:
+        """Отменяет реплику. Безопасно вызывать из любого потока."""
+        with self._cancel_lock:
+            self.cancelled.set()
+            tasks, self.tasks = self.tasks, []
+            callbacks, self._on_cancel = self._on_cancel, []
+        for task in tasks:
+            # Задача отменяется в потоке своего цикла (общий цикл ввода-вывода)
+            task.get_loop().call_soon_threadsafe(task.cancel)
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception as e:
+                logging.warning(f"[SESSION] Ошибка при отмене реплики {self.turn_id}: {e}")
+
+    @property
+    def spoken_text(self) -> str:
+        """Текст, отданный в TTS"""
+        return ' '.join(text for text, _ in self.segments)
+
+    @property
+    def tts_done(self) -> bool:
+        """Ответ сгенерирован и весь его звук передан в плейлист"""
+        return self.llm_done and all(clip.closed for _, clip in self.segments)
+
+
+class CallSession:
+    """Состояние одного разговора"""
+
+    def __init__(self, call_id: int, call=None):
+        self.call_id = call_id
+        self.call = call
+        self.lead_id = None
+        self.stt_session = None
+        # Частота аудио для STT; None — по кодеку звонка (см. Call.start_audio_streaming)
+        self.ingest_rate: Optional[int] = None
+        self._playback_listeners: List[Callable[["CallSession", dict], None]] = []
+        # Упорядоченный плейлист реплик агента в этот звонок
+        self.playlist = Playlist(self)
+        # Состояние агента для этого звонка
+        self.llm_busy = False
+        self.current_turn: Optional[AgentTurn] = None
+        self.speculation = None  # спекулятивный ответ LLM на незавершённую реплику
+        self.history = None  # llm.dialog_history.DialogHistory лида
+        self.funnel = None  # llm.funnel_state.FunnelState
+        self.current_question_id: Optional[int] = None  # вопрос воронки, заданный агентом последним
+        self._turn_seq = 0
+        self.created_at = time.time()
+
+    def on_playback_finished(self, listener: Callable[["CallSession", dict], None]) -> None:
+        """
+        Подписывает listener(session, info) на окончание воспроизведения в звонке.
+        info содержит source ('file' или 'stream'), path, duration, interrupted
+        и clip (клип плейлиста; None для событий самого плеера pjsua).
+        Подписчики вызываются в потоке диспетчера медиа-задач.
+        """
+        self._playback_listeners.append(listener)
+
+    def emit_playback_finished(self, **info) -> None:
+        for listener in list(self._playback_listeners):
+            try:
+                listener(self, info)
+            except Exception:
+                logging.exception(f"[SESSION] Ошибка подписчика окончания воспроизведения (звонок {self.call_id})")
+
+    def start_turn(self, user_text: str) -> AgentTurn:
+        """Начинает новую реплику агента в ответ на user_text"""
+        self._turn_seq += 1
+        turn = AgentTurn(self._turn_seq, user_text)
+        self.current_turn = turn
+        return turn
+
+    def __repr__(self):
+        return f"CallSession(call_id={self.call_id}, lead_id={self.lead_id})"
+
+
+_sessions: Dict[int, CallSession] = {}
+_sessions_lock = threading.Lock()
+
+
+def create_session(call_id: int, call=None) -> CallSession:
+    """
+    Создает и регистрирует сессию для звонка.
+
+    Args:
+        call_id: callId звонка в pjsua
+        call: Объект звонка (sip.call.Call)
+
+    Returns:
+        CallSession: Новая сессия
+    """
+    session = CallSession(call_id, call)
+    if call is not None:
+        call.session = session
+    with _sessions_lock:
+        _sessions[call_id] = session
+    return session
+
+
+def get_session(call_id: Optional[int]) -> Optional[CallSession]:
+    """Возвращает сессию по callId или None"""
+    if call_id is None:
+        return None
+    with _sessions_lock:
+        return _sessions.get(call_id)
+
+
+def remove_session(call_id: int) -> Optional[CallSession]:
+    """Удаляет сессию из реестра и возвращает её"""
+    with _sessions_lock:
+        return _sessions.pop(call_id, None)
+
+
+def get_all_sessions() -> List[CallSession]:
+    """Возвращает снимок всех активных сессий"""
+    with _sessions_lock:
+        return list(_sessions.values())
@@ -1,5 +1,10 @@
-def get_active_lead_id():
-    """Возвращает ID текущей активной сделки из очереди событий"""
-    import sip.call
-    if sip.call.Call.current and hasattr(sip.call.Call.current.acc.sip_event_queue, 'config'):
-        return sip.call.Call.current.acc.sip_event_queue.config.get('ACTIVE_LEAD_ID') 
\ No newline at end of file
+def get_active_lead_id(call_id=None):
+    """Возвращает ID сделки звонка; без call_id — сделку единственного активного звонка"""
+    from sip.session import get_session, get_all_sessions
+    session = get_session(call_id)
+    if session is None and call_id is None:
+        sessions = get_all_sessions()
+        if len(sessions) == 1:
+            session = sessions[0]
+    if session:
+        return session.lead_id
@@ -0,0 +1,219 @@
+"""
+Общий интерфейс STT-движков.
+
+Сессия распознавания получает PCM звонка через feed_audio() (из медиапотока
+pjsua) и отдаёт события: промежуточные и финальные расшифровки, начало речи
+и конец реплики. Всё, что происходит по этим событиям — локальный детектор
+конца реплики, спекулятивный запрос к LLM, перебивание агента и запуск
+ответа, — реализовано здесь один раз. Конкретный движок (Deepgram, Vosk)
+реализует только подключение (_open) и распознавание (_run_streaming)
+и вызывает обработчики _on_*.
+
+Все корутины сессий выполняются в общем цикле ввода-вывода (stt.io_loop).
+"""
+
+import asyncio
+import threading
+import time
+from typing import AsyncIterator
+
+import metrics
+from llm.groq_agent import speculate_transcript
+from llm.turn_queue import get_turn_queue
+from sip.barge_in import handle_barge_in
+from sip.pcm_buffer import PcmRingBuffer, SAMPLE_WIDTH
+from sip.session import get_session
+from stt.io_loop import get_io_loop
+from stt.local_vad import LocalVad, get_turn_silence_ms, LOCAL_BARGE_IN
+
+RATE = 16000
+CHANNELS = 1
+# Сколько секунд аудио держим, пока движок не готов принимать
+MAX_BUFFERED_SECONDS = 5
+CONNECT_TIMEOUT = 10.0
+
+
+class STTSession:
+    name = 'stt'
+    # Движок сам присылает начало речи (SpeechStarted); иначе перебивание
+    # определяется по локальному детектору речи
+    server_vad = True
+
+    def __init__(self, call_id=None, sample_rate: int = RATE):
+        self.call_id = call_id
+        # Частота PCM, которую звонок подаёт в feed_audio (родная частота кодека)
+        self.sample_rate = sample_rate
+        # PCM-кадры звонка, поступающие из медиапотока pjsua
+        self.audio = PcmRingBuffer(sample_rate * SAMPLE_WIDTH * CHANNELS * MAX_BUFFERED_SECONDS)
+        self._audio_ready = None
+        self.stop_event = threading.Event()
+        self.loop = None
+        self.connected_event = threading.Event()
+        self._connect_lock = threading.Lock()
+        self._connect_future = None
+        self._streaming = False
+        self._last_utterance_end_time = None
+        # Локальный детектор конца реплики
+        self.vad = LocalVad(sample_rate)
+        self._final_parts = []       # финальные фрагменты текущей реплики
+        self._interim_pending = False  # после последнего final пришёл непустой interim
+        self._early_fired_at = None  # когда реплика отправлена в LLM до конца реплики от движка
+
+    # --- Интерфейс для звонка ---
+
+    def feed_audio(self, data: bytes) -> None:
+        """Принимает PCM-кадр. Безопасно вызывать из медиапотока pjsua."""
+        self.audio.write(data)
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        """
+        Подключает движок в общем цикле ввода-вывода и ждёт готовности.
+        Повторный вызов для уже подключаемой сессии просто ждёт подключения.
+        """
+        self._ensure_open()
+        if not self.connected_event.wait(timeout):
+            raise TimeoutError(f'STT {self.name}: нет подключения')
+        return self
+
+    def start_streaming(self):
+        """Запускает распознавание. Не блокирует вызывающий поток."""
+        self._ensure_open()
+        return get_io_loop().submit(self._stream())
+
+    def is_healthy(self) -> bool:
+        """Сессия подключена и может быть отдана звонку"""
+        return self.connected_event.is_set() and not self.stop_event.is_set() and not self._streaming
+
+    def close(self) -> None:
+        self.stop_event.set()
+
+    # --- Реализуется движком ---
+
+    async def _open(self) -> None:
+        """Подключается к движку; по готовности вызывает connected_event.set()"""
+        raise NotImplementedError
+
+    async def _run_streaming(self) -> None:
+        """Передаёт аудио из _audio_chunks() в движок и вызывает обработчики _on_*"""
+        raise NotImplementedError
+
+    async def _on_stream_closed(self) -> None:
+        """Вызывается, если звонок завершился, пока шло подключение"""
+
+    # --- Общая логика ---
+
+    def _ensure_open(self) -> None:
+        with self._connect_lock:
+            if self._connect_future is None:
+                io_loop = get_io_loop().start()
+                self.loop = io_loop.loop
+                self._connect_future = io_loop.submit(self._open_checked())
+
+    async def _open_checked(self) -> None:
+        try:
+            await self._open()
+        except Exception:
+            self.stop_event.set()
+            raise
+        if self.stop_event.is_set():
+            await self._on_stream_closed()
+
+    async def _stream(self) -> None:
+        # Медиа может появиться раньше, чем закончится подключение:
+        # до этого момента аудио копится в self.audio
+        await asyncio.wrap_future(self._connect_future)
+        if self.stop_event.is_set():
+            return
+        self._streaming = True
+        await self._run_streaming()
+
+    def _wake_sender(self):
+        if self.loop and self._audio_ready:
+            self.loop.call_soon_threadsafe(self._audio_ready.set)
+
+    async def _audio_chunks(self) -> AsyncIterator[bytes]:
+        """PCM звонка по мере поступления, пока сессия не закрыта"""
+        ready = self._audio_ready = asyncio.Event()
+        self.audio.set_waker(self._wake_sender)
+        try:
+            while not self.stop_event.is_set():
+                chunk = self.audio.read()
+                if chunk:
+                    yield chunk
+                    continue
+                self._audio_ready.clear()
+                if self.audio.available():
+                    continue
+                try:
+                    # Таймаут нужен только для проверки stop_event
+                    await asyncio.wait_for(self._audio_ready.wait(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # Генератор оборванного соединения может завершиться позже, когда
+            # генератор нового соединения уже поставил свой waker
+            if self._audio_ready is ready:
+                self.audio.set_waker(None)
+
+    def _process_local_vad(self, chunk: bytes) -> None:
+        started = self.vad.feed(chunk)
+        if started and (LOCAL_BARGE_IN or not self.server_vad):
+            self._on_speech_started()
+        self._check_local_endpoint()
+
+    def _on_speech_started(self) -> None:
+        if self.call_id is not None:
+            handle_barge_in(self.call_id)
+
+    def _on_interim(self, transcript: str) -> None:
+        if transcript:
+            self._interim_pending = True
+
+    def _on_final(self, transcript: str) -> None:
+        if transcript:
+            print(transcript)
+            if self._early_fired_at is not None:
+                # Клиент продолжил говорить после локального конца реплики
+                metrics.inc('endpointing.resumed_after_local')
+                self._early_fired_at = None
+            self._final_parts.append(transcript)
+            if self.call_id is not None:
+                speculate_transcript(' '.join(self._final_parts), self.call_id)
+        self._interim_pending = False
+        self._check_local_endpoint()
+
+    def _check_local_endpoint(self) -> None:
+        """Завершает реплику, если финальная расшифровка уже есть, а клиент молчит"""
+        if not self._final_parts or self._interim_pending:
+            return
+        silence_ms = get_turn_silence_ms(get_session(self.call_id))
+        if not self.vad.silence_reached(silence_ms):
+            return
+        print(f"[ENDPOINT] Локальный конец речи: тишина {self.vad.trailing_silence_ms} мс (порог {silence_ms} мс)")
+        metrics.inc('endpointing.local_turns')
+        self._early_fired_at = time.time()
+        self._fire_turn()
+
+    def _on_utterance_end(self) -> None:
+        if self._final_parts:
+            # Локальный детектор не успел (или клиент продолжил речь)
+            metrics.inc('endpointing.stt_turns')
+            self._early_fired_at = None
+            self._fire_turn()
+            return
+        if self._early_fired_at is not None:
+            saved_ms = (time.time() - self._early_fired_at) * 1000
+            metrics.observe('endpointing.saved_ms', saved_ms)
+            print(f"[ENDPOINT] Реплика отправлена на {saved_ms:.0f} мс раньше конца реплики от {self.name}")
+            self._early_fired_at = None
+
+    def _fire_turn(self) -> None:
+        full_text = ' '.join([b.strip() for b in self._final_parts]).strip()
+        self._final_parts = []
+        self._interim_pending = False
+        if not full_text:
+            return
+        self._last_utterance_end_time = time.time()
+        print(f"[STT] Расшифровка: {full_text}")
+        # Реплики звонка обрабатываются по очереди, с общим ограничением на LLM
+        get_turn_queue().submit(self.call_id, full_text, self._last_utterance_end_time)
@@ -0,0 +1,159 @@
+"""
+Замер задержек STT: WAV-файлы подаются в N параллельных DeepgramSTTSession
+в реальном темпе, для каждого события считается время от подачи кадра,
+к которому относится событие, до получения события сессией.
+
+По умолчанию сессии подключаются к локальному стенду (stt.fake_deepgram),
+с --url — к указанному серверу (например, к настоящему Deepgram).
+
+    python -m stt.benchmark --sessions 8 ElevenLabs_Text_to_Speech_audio.wav
+"""
+
+import argparse
+import bisect
+import os
+import threading
+import time
+import wave
+from typing import List, Tuple
+
+# Стенду ключ не нужен, но без него сессия не подключается
+os.environ.setdefault('DEEPGRAM_API_KEY', 'local-benchmark')
+
+import metrics
+from stt.base import RATE
+from stt.deepgram_stt import DeepgramSTTSession
+from stt.fake_deepgram import serve_in_thread
+
+FRAME_MS = 10
+
+
+class BenchmarkSession(DeepgramSTTSession):
+    """Сессия без звонка: события записываются в метрики, LLM не вызывается"""
+
+    def __init__(self, url: str):
+        super().__init__(call_id=None)
+        self.url = url
+        self._fed: List[Tuple[float, float]] = []  # (секунда аудио, время подачи)
+        self._fed_lock = threading.Lock()
+        self.turns = 0
+
+    def feed_audio(self, data: bytes) -> None:
+        with self._fed_lock:
+            audio_sec = (self._fed[-1][0] if self._fed else 0.0) + len(data) / 2.0 / RATE
+            self._fed.append((audio_sec, time.monotonic()))
+        super().feed_audio(data)
+
+    def _fed_at(self, audio_sec: float) -> float:
+        """Когда был подан кадр, содержащий секунду audio_sec"""
+        with self._fed_lock:
+            index = bisect.bisect_left(self._fed, (audio_sec, 0.0))
+            index = min(index, len(self._fed) - 1)
+            return self._fed[index][1]
+
+    def _observe(self, name: str, audio_sec: float) -> None:
+        if self._fed:
+            metrics.observe(f'bench.{name}_ms', (time.monotonic() - self._fed_at(audio_sec)) * 1000)
+
+    def _handle_message(self, data: dict) -> None:
+        # Время событий отсчитывается от начала текущего соединения
+        kind = data.get('type')
+        if kind == 'SpeechStarted':
+            self._observe('speech_started', self._conn_offset + data.get('timestamp', 0))
+        elif kind == 'UtteranceEnd':
+            self._observe('utterance_end', self._conn_offset + data.get('last_word_end', 0))
+        elif 'channel' in data and isinstance(data['channel'], dict):
+            end = self._conn_offset + data.get('start', 0) + data.get('duration', 0)
+            self._observe('final' if data.get('is_final') else 'interim', end)
+        super()._handle_message(data)
+
+    def _fire_turn(self) -> None:
+        if self._final_parts:
+            self.turns += 1
+            metrics.inc('bench.turns')
+        self._final_parts = []
+        self._interim_pending = False
+
+
+def _read_pcm(path: str) -> bytes:
+    with wave.open(path, 'rb') as wav:
+        if wav.getnchannels() != 1 or wav.getsampwidth() != 2 or wav.getframerate() != RATE:
+            raise ValueError(f"{path}: нужен WAV моно 16 бит {RATE} Гц")
+        return wav.readframes(wav.getnframes())
+
+
+def _feed(session: BenchmarkSession, pcm: bytes, speed: float, trailing_silence: float) -> None:
+    frame_bytes = RATE * 2 * FRAME_MS // 1000
+    pcm = pcm + b'\0' * int(RATE * 2 * trailing_silence)
+    start = time.monotonic()
+    for i, offset in enumerate(range(0, len(pcm), frame_bytes)):
+        session.feed_audio(pcm[offset:offset + frame_bytes])
+        # Темп по абсолютному расписанию, без накопления ошибки sleep
+        delay = start + (i + 1) * FRAME_MS / 1000.0 / speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def run(wav_files: List[str], sessions: int, url: str, speed: float) -> dict:
+    pcms = [_read_pcm(path) for path in wav_files]
+    bench_sessions = [BenchmarkSession(url) for _ in range(sessions)]
+    for session in bench_sessions:
+        session.connect()
+        session.start_streaming()
+
+    started = time.monotonic()
+    feeders = []
+    for i, session in enumerate(bench_sessions):
+        t = threading.Thread(target=_feed, args=(session, pcms[i % len(pcms)], speed, 1.5), daemon=True)
+        t.start()
+        feeders.append(t)
+    for t in feeders:
+        t.join()
+    time.sleep(0.5)  # последние события
+    elapsed = time.monotonic() - started
+    for session in bench_sessions:
+        session.close()
+
+    audio_seconds = sum(len(pcms[i % len(pcms)]) / 2.0 / RATE for i in range(sessions))
+    return {
+        'sessions': sessions,
+        'audio_seconds': audio_seconds,
+        'wall_seconds': elapsed,
+        'realtime_factor': audio_seconds / elapsed,
+        'turns': sum(s.turns for s in bench_sessions),
+        'dropped_bytes': sum(s.audio.dropped_bytes for s in bench_sessions),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер задержек STT")
+    parser.add_argument('wav', nargs='+', help="WAV-файлы моно 16 бит 16 кГц")
+    parser.add_argument('--sessions', type=int, default=4)
+    parser.add_argument('--url', help="Сервер listen API; по умолчанию локальный стенд")
+    parser.add_argument('--port', type=int, default=8765, help="Порт локального стенда")
+    parser.add_argument('--speed', type=float, default=1.0, help="Темп подачи относительно реального времени")
+    parser.add_argument('--drop-after', type=float, help="Стенд обрывает соединения через N секунд аудио")
+    args = parser.parse_args()
+
+    url = args.url or serve_in_thread(port=args.port, drop_after=args.drop_after)
+    summary = run(args.wav, args.sessions, url, args.speed)
+
+    print(f"Сессий: {summary['sessions']}, аудио: {summary['audio_seconds']:.1f} с, "
+          f"время: {summary['wall_seconds']:.1f} с, x{summary['realtime_factor']:.1f} реального времени")
+    print(f"Реплик: {summary['turns']}, потеряно байт в буферах: {summary['dropped_bytes']}")
+    if metrics.get_counter('stt.reconnects'):
+        line = (f"Переподключений: {metrics.get_counter('stt.reconnects'):g}, "
+                f"повторных финалов отброшено: {metrics.get_counter('stt.duplicate_finals'):g}")
+        # Пауза пишется только для успешных переподключений
+        if metrics.histogram_count('stt.reconnect_gap_ms'):
+            line += f", пауза p95: {metrics.percentile('stt.reconnect_gap_ms', 95):.0f} мс"
+        print(line)
+    for name in ('speech_started', 'interim', 'final', 'utterance_end'):
+        key = f'bench.{name}_ms'
+        if metrics.histogram_count(key):
+            print(f"{name:>15}: n={metrics.histogram_count(key):4d} "
+                  f"p50={metrics.percentile(key, 50):7.1f} мс  p95={metrics.percentile(key, 95):7.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
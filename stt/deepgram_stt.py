@@ -5,10 +5,11 @@ import websockets
 import wave
 import json
 import logging
-from llm.groq_agent import process_transcript, process_transcript_async
-import random
-import queue
+from stt.base import STTSession, RATE, CHANNELS
+from stt.io_loop import get_io_loop
 import time
+from collections import deque
+import metrics
 
 logging.basicConfig(
     level=logging.INFO,
@@ -16,35 +17,50 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
-RATE = 16000
-CHANNELS = 1
 CHUNK = 1600
+# Интервал KeepAlive для соединений, ещё не отданных звонку
+KEEPALIVE_INTERVAL = 5.0
+# Переподключение при обрыве: пауза растёт от базовой до максимальной
+RECONNECT_BASE_DELAY = 0.25
+RECONNECT_MAX_DELAY = 5.0
+# Сколько отправленного аудио держим для досылки после переподключения
+REPLAY_SECONDS = 10.0
+DUPLICATE_TOLERANCE_SEC = 0.02
+# Сколько ждать последних расшифровок после CloseStream в конце звонка
+CLOSE_DRAIN_TIMEOUT = 1.5
+# Сколько ждать закрытия оборванного соединения перед переподключением
+DEAD_WS_CLOSE_TIMEOUT = 0.5
 
 from dotenv import load_dotenv
 load_dotenv()
 
 DEEPGRAM_API_KEY = os.getenv('DEEPGRAM_API_KEY')
+# Можно направить на локальный стенд (stt/fake_deepgram.py)
+DEEPGRAM_URL = os.getenv('DEEPGRAM_URL', 'wss://api.deepgram.com/v1/listen')
 if not DEEPGRAM_API_KEY:
-    logging.error('Не задан Deepgram API key в переменной DEEPGRAM_API_KEY')
-    exit(1)
+    logging.warning('Не задан Deepgram API key в переменной DEEPGRAM_API_KEY: Deepgram STT недоступен')
 
-class DeepgramSTTSession:
-    def __init__(self, wav_file):
-        self.wav_file = wav_file
+class DeepgramSTTSession(STTSession):
+    name = 'deepgram'
+
+    def __init__(self, call_id=None, sample_rate=RATE):
+        super().__init__(call_id, sample_rate)
+        self.url = DEEPGRAM_URL
         self.ws = None
-        self.stop_event = threading.Event()
-        self.loop = None
-        self.thread = None
-        self.connected_event = threading.Event()
+        self._keepalive_task = None
         self._send_task = None
         self._recv_task = None
-        self._last_utterance_end_time = None
+        # Единая шкала аудио сессии (секунды), общая для всех переподключений
+        self._sent_sec = 0.0  # сколько аудио отправлено
+        self._acked_sec = 0.0  # до какого момента получены финальные расшифровки
+        self._conn_offset = 0.0  # с какой секунды шкалы начинается аудио текущего соединения
+        self._replay = deque()  # (начало, PCM) отправленного, но не подтверждённого аудио
 
     async def _connect_ws(self):
         url = (
-            f"wss://api.deepgram.com/v1/listen"
+            f"{self.url}"
             f"?encoding=linear16"
-            f"&sample_rate={RATE}"
+            f"&sample_rate={self.sample_rate}"
             f"&channels={CHANNELS}"
             f"&interim_results=true"
             f"&endpointing=100"
@@ -60,103 +76,161 @@ class DeepgramSTTSession:
         logging.info('Подключено к Deepgram Realtime API')
         self.connected_event.set()
 
+    async def _open(self):
+        if not DEEPGRAM_API_KEY:
+            raise RuntimeError('Не задан DEEPGRAM_API_KEY')
+        await self._connect_ws()
+        self._keepalive_task = asyncio.ensure_future(self._keepalive_loop())
+
+    async def _on_stream_closed(self):
+        # Звонок завершился, пока шло подключение
+        await self.ws.close()
+
+    async def _run_streaming(self):
+        while True:
+            self._send_task = asyncio.ensure_future(self._send_loop())
+            self._recv_task = asyncio.ensure_future(self._receive_loop())
+            done, pending = await asyncio.wait({self._send_task, self._recv_task},
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if (self.stop_event.is_set() and self._send_task in done
+                    and not self._send_task.cancelled() and not self._send_task.exception()):
+                # Звонок завершён и CloseStream отправлен: Deepgram досылает
+                # последние Results/UtteranceEnd и сам закрывает соединение
+                try:
+                    await asyncio.wait_for(self._recv_task, CLOSE_DRAIN_TIMEOUT)
+                except Exception:
+                    pass
+                await self._close_quietly(self.ws, CLOSE_DRAIN_TIMEOUT)
+                return
+            for task in pending:
+                task.cancel()
+            if self.stop_event.is_set():
+                return
+            for task in done:
+                if not task.cancelled() and task.exception():
+                    logging.warning(f"[STT] Соединение с Deepgram потеряно: {task.exception()}")
+            if not await self._reconnect():
+                return
+
+    async def _reconnect(self) -> bool:
+        """
+        Переподключается с нарастающей паузой и досылает неподтверждённое аудио.
+        Досланное аудио уже прошло через локальный детектор конца реплики
+        и повторно в него не подаётся.
+        """
+        gap_started = time.monotonic()
+        metrics.inc('stt.reconnects')
+        await self._close_quietly(self.ws, DEAD_WS_CLOSE_TIMEOUT)
+        attempt = 0
+        while not self.stop_event.is_set():
+            delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * (2 ** attempt))
+            await asyncio.sleep(delay)
+            try:
+                await self._connect_ws()
+                break
+            except Exception as e:
+                attempt += 1
+                logging.warning(f"[STT] Переподключение к Deepgram не удалось (попытка {attempt}): {e}")
+        if self.stop_event.is_set():
+            return False
+
+        replay = [(start, chunk) for start, chunk in self._replay
+                  if start + self._chunk_sec(chunk) > self._acked_sec]
+        self._conn_offset = replay[0][0] if replay else self._sent_sec
+        for _, chunk in replay:
+            await self.ws.send(chunk)
+        gap_ms = (time.monotonic() - gap_started) * 1000
+        metrics.observe('stt.reconnect_gap_ms', gap_ms)
+        logging.info(f"[STT] Deepgram переподключен через {gap_ms:.0f} мс, "
+                     f"дослано {sum(self._chunk_sec(c) for _, c in replay):.1f} с аудио")
+        return True
+
+    @staticmethod
+    async def _close_quietly(ws, timeout: float) -> None:
+        if ws is None:
+            return
+        try:
+            await asyncio.wait_for(ws.close(), timeout)
+        except Exception:
+            pass
+
+    def _chunk_sec(self, chunk: bytes) -> float:
+        return len(chunk) / 2.0 / self.sample_rate
+
+    def _remember_sent(self, chunk: bytes) -> None:
+        self._replay.append((self._sent_sec, chunk))
+        self._sent_sec += self._chunk_sec(chunk)
+        # Храним не больше REPLAY_SECONDS и только неподтверждённое
+        while self._replay and (self._replay[0][0] < self._sent_sec - REPLAY_SECONDS
+                                or self._replay[0][0] + self._chunk_sec(self._replay[0][1]) <= self._acked_sec):
+            self._replay.popleft()
+
     async def _send_loop(self):
-        with open(self.wav_file, 'rb') as f_read:
-            f_read.seek(44)
-            position = 44
-            no_data_count = 0
-            while not self.stop_event.is_set():
-                f_read.seek(position)
-                chunk = f_read.read(CHUNK * 2)
-                if chunk:
-                    await self.ws.send(chunk)
-                    position += len(chunk)
-                    no_data_count = 0
-                else:
-                    no_data_count += 1
-                    # Динамическая задержка для увеличения скорости (начинаем с малой, увеличиваем при отсутствии данных)
-                    delay = min(0.02 + (no_data_count * 0.01), 0.1)
-                    await asyncio.sleep(delay)
-            await self.ws.send(json.dumps({"type": "CloseStream"}))
+        async for chunk in self._audio_chunks():
+            # Запоминаем до отправки: при обрыве кадр будет дослан
+            self._remember_sent(chunk)
+            await self.ws.send(chunk)
+            self._process_local_vad(chunk)
+        await self.ws.send(json.dumps({"type": "CloseStream"}))
 
     async def _receive_loop(self):
-        buffer = []
         async for message in self.ws:
-            data = json.loads(message)
-            if 'type' in data and data['type'] == 'SpeechStarted':
-                timestamp = data.get('timestamp', 0)
-                print(f"[VAD EVENT] SpeechStarted at {timestamp}s")
-                continue
-            if 'type' in data and data['type'] == 'UtteranceEnd':
-                last_word_end = data.get('last_word_end', 0)
-                self._last_utterance_end_time = time.time()
-                print(f"[UTTERANCE END] Конец речи в {last_word_end}s (ts={self._last_utterance_end_time:.3f})")
-                full_text = ' '.join([b.strip() for b in buffer]).strip()
-                if full_text:
-                    print(f"[STT] Расшифровка: {full_text}")
-                    def llm_thread():
-                        import inspect
-                        import time as _time
-                        try:
-                            if inspect.iscoroutinefunction(process_transcript_async):
-                                try:
-                                    loop = asyncio.get_running_loop()
-                                except RuntimeError:
-                                    loop = None
-                                if loop and loop.is_running():
-                                    fut = asyncio.run_coroutine_threadsafe(process_transcript_async(full_text), loop)
-                                    llm_response = fut.result()
-                                else:
-                                    llm_response = asyncio.run(process_transcript_async(full_text))
-                            else:
-                                llm_response = process_transcript(full_text)
-                        except Exception as e:
-                            llm_response = f"[LLM] Ошибка: {e}"
-                        delay_ms = None
-                        if self._last_utterance_end_time:
-                            delay_ms = int((_time.time() - self._last_utterance_end_time) * 1000)
-                        if delay_ms is not None:
-                            logging.info(f"[LLM] Ответ готов (задержка {delay_ms} мс)")
-                        else:
-                            logging.info(f"[LLM] Ответ готов")
-                    threading.Thread(target=llm_thread, daemon=True).start()
-                buffer = []
-                continue
-            if 'channel' in data:
-                if isinstance(data['channel'], dict):
-                    is_final = data.get('is_final', False)
+            self._handle_message(json.loads(message))
+
+    def _handle_message(self, data: dict) -> None:
+        if 'type' in data and data['type'] == 'SpeechStarted':
+            timestamp = data.get('timestamp', 0)
+            print(f"[VAD EVENT] SpeechStarted at {timestamp}s")
+            self._on_speech_started()
+            return
+        if 'type' in data and data['type'] == 'UtteranceEnd':
+            last_word_end = data.get('last_word_end', 0)
+            print(f"[UTTERANCE END] Конец речи в {last_word_end}s (ts={time.time():.3f})")
+            self._on_utterance_end()
+            return
+        if 'channel' in data:
+            if isinstance(data['channel'], dict):
+                is_final = data.get('is_final', False)
+                # После переподключения досланное аудио распознаётся повторно:
+                # уже подтверждённые фрагменты пропускаем
+                end_sec = self._conn_offset + data.get('start', 0) + data.get('duration', 0)
+                if end_sec <= self._acked_sec + DUPLICATE_TOLERANCE_SEC:
                     if is_final:
-                        channel = data['channel']
-                        alts = channel.get('alternatives', [])
-                        if alts and len(alts) > 0:
-                            transcript = alts[0].get('transcript', '').strip()
-                            if transcript:
-                                print(transcript)
-                            buffer.append(transcript)
-
-    def connect(self):
-        def run():
-            self.loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self.loop)
-            self.loop.run_until_complete(self._connect_ws())
-        self.thread = threading.Thread(target=run, daemon=True)
-        self.thread.start()
-        self.connected_event.wait()
-        return self
-
-    def start_streaming(self):
-        def run():
-            asyncio.set_event_loop(self.loop)
-            self._send_task = self.loop.create_task(self._send_loop())
-            self._recv_task = self.loop.create_task(self._receive_loop())
-            self.loop.run_until_complete(asyncio.gather(self._send_task, self._recv_task))
-        t = threading.Thread(target=run, daemon=True)
-        t.start()
-        return t
+                        metrics.inc('stt.duplicate_finals')
+                    return
+                if is_final:
+                    self._acked_sec = end_sec
+                channel = data['channel']
+                alts = channel.get('alternatives', [])
+                transcript = alts[0].get('transcript', '').strip() if alts else ''
+                if is_final:
+                    self._on_final(transcript)
+                else:
+                    self._on_interim(transcript)
+
+    async def _keepalive_loop(self):
+        # Пока звонок не начал передавать аудио, Deepgram закрывает
+        # соединение без данных примерно через 10 секунд
+        while not self.stop_event.is_set() and not self._streaming:
+            try:
+                await self.ws.send(json.dumps({"type": "KeepAlive"}))
+            except Exception as e:
+                logging.warning(f"Deepgram KeepAlive не отправлен: {e}")
+                return
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+
+    def is_healthy(self) -> bool:
+        """Соединение открыто и может быть отдано звонку"""
+        return super().is_healthy() and self.ws is not None and self.ws.close_code is None
 
     def close(self):
+        self.stop_event.set()
         if self.ws is None or self.loop is None:
             return
+        if self._streaming:
+            # Соединение закроет _run_streaming, дождавшись последних расшифровок
+            self._wake_sender()
+            return
         async def _close_ws():
             try:
                 await self.ws.send(json.dumps({"type": "CloseStream"}))
@@ -165,15 +239,24 @@ class DeepgramSTTSession:
             except Exception as e:
                 logging.error(f"Ошибка при закрытии Deepgram WebSocket: {e}")
         try:
-            if self.loop.is_running():
-                fut = asyncio.run_coroutine_threadsafe(_close_ws(), self.loop)
-            else:
-                self.loop.run_until_complete(_close_ws())
+            get_io_loop().submit(_close_ws())
         except Exception as e:
             logging.error(f"Ошибка при завершении Deepgram STT: {e}")
 
-def stt_from_wav(wav_file):
-    session = DeepgramSTTSession(wav_file)
+def stt_from_wav(wav_file, call_id=None, session=None):
+    """Распознает готовый WAV-файл, подавая его в сессию в реальном темпе"""
+    session = session or DeepgramSTTSession(call_id=call_id)
     session.connect()
     session.start_streaming()
-    return session 
\ No newline at end of file
+
+    def feed():
+        frame_bytes = RATE * 2 // 100  # 10 мс
+        with wave.open(wav_file, 'rb') as wav:
+            while not session.stop_event.is_set():
+                data = wav.readframes(frame_bytes // 2)
+                if not data:
+                    break
+                session.feed_audio(data)
+                time.sleep(0.01)
+    threading.Thread(target=feed, daemon=True).start()
+    return session
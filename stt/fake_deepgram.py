@@ -0,0 +1,192 @@
+"""
+Локальный стенд, совместимый с Deepgram listen API.
+
+Принимает PCM по websocket так же, как wss://api.deepgram.com/v1/listen,
+и по таймингу речи в присланном аудио отвечает событиями SpeechStarted,
+Results (промежуточными и финальными) и UtteranceEnd. Тексты реплик берутся
+по очереди из сценария. Нужен для замеров и прогона STT без платного API:
+
+    python -m stt.fake_deepgram --port 8765 --script phrases.txt
+    DEEPGRAM_URL=ws://127.0.0.1:8765/v1/listen python main.py
+
+С --drop-after стенд обрывает каждое соединение через заданное число секунд
+аудио — для проверки переподключения сессий.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import threading
+from typing import Iterable, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import websockets
+
+from stt.local_vad import LocalVad, MIN_SPEECH_MS
+
+DEFAULT_SCRIPT = [
+    "здравствуйте",
+    "да нам нужно питание для сотрудников",
+    "примерно сорок человек",
+    "москва улица ленина дом пять",
+]
+# Темп речи для промежуточных результатов (слов в секунду)
+WORDS_PER_SECOND = 2.5
+INTERIM_INTERVAL_MS = 300
+
+
+class _ScriptedStream:
+    """Состояние одного соединения: сегментация речи и выдача событий"""
+
+    def __init__(self, ws, phrases: Iterable[str], sample_rate: int, endpointing_ms: int,
+                 utterance_end_ms: int, interim: bool, vad_events: bool):
+        self.ws = ws
+        self.phrases = phrases
+        self.vad = LocalVad(sample_rate)
+        # Конец сегмента не раньше, чем детектор речи сочтёт её законченной
+        self.endpointing_ms = max(endpointing_ms, MIN_SPEECH_MS)
+        self.utterance_end_ms = utterance_end_ms
+        self.interim = interim
+        self.vad_events = vad_events
+        self.words: List[str] = []
+        self.segment_start_ms = None
+        self.last_word_end_ms = None  # конец последнего финального сегмента
+        self.final_sent = True
+        self.last_interim_ms = 0
+
+    async def _send(self, payload: dict) -> None:
+        await self.ws.send(json.dumps(payload, ensure_ascii=False))
+
+    async def _send_results(self, text: str, start_ms: int, end_ms: int, is_final: bool) -> None:
+        await self._send({
+            "type": "Results",
+            "channel_index": [0, 1],
+            "start": start_ms / 1000.0,
+            "duration": (end_ms - start_ms) / 1000.0,
+            "is_final": is_final,
+            "speech_final": is_final,
+            "channel": {"alternatives": [{"transcript": text, "confidence": 0.99, "words": []}]},
+        })
+
+    async def feed(self, chunk: bytes) -> None:
+        started = self.vad.feed(chunk)
+        now_ms = self.vad.audio_ms
+        if started:
+            speech_start_ms = now_ms - MIN_SPEECH_MS
+            if self.vad_events:
+                await self._send({"type": "SpeechStarted", "channel": [0], "timestamp": speech_start_ms / 1000.0})
+            if self.final_sent:
+                # Новая реплика сценария
+                self.words = next(self.phrases).split()
+                self.segment_start_ms = speech_start_ms
+                self.final_sent = False
+                self.last_interim_ms = now_ms
+
+        if self.final_sent:
+            if (self.last_word_end_ms is not None
+                    and now_ms - self.last_word_end_ms >= self.utterance_end_ms):
+                await self._send({"type": "UtteranceEnd", "channel": [0, 1],
+                                  "last_word_end": self.last_word_end_ms / 1000.0})
+                self.last_word_end_ms = None
+            return
+
+        speech_end_ms = now_ms - self.vad.trailing_silence_ms
+        if self.vad.trailing_silence_ms >= self.endpointing_ms:
+            await self._send_results(' '.join(self.words), self.segment_start_ms, speech_end_ms, True)
+            self.final_sent = True
+            self.last_word_end_ms = speech_end_ms
+        elif self.interim and now_ms - self.last_interim_ms >= INTERIM_INTERVAL_MS:
+            spoken = (speech_end_ms - self.segment_start_ms) / 1000.0
+            count = max(1, min(len(self.words), int(spoken * WORDS_PER_SECOND)))
+            await self._send_results(' '.join(self.words[:count]), self.segment_start_ms, speech_end_ms, False)
+            self.last_interim_ms = now_ms
+
+
+def _request_path(ws) -> str:
+    path = getattr(ws, 'path', None)
+    if path is None:
+        path = ws.request.path
+    return path
+
+
+async def _handle(ws, script: List[str], drop_after: Optional[float] = None) -> None:
+    params = {k: v[-1] for k, v in parse_qs(urlparse(_request_path(ws)).query).items()}
+    stream = _ScriptedStream(
+        ws, itertools.cycle(script),
+        sample_rate=int(params.get('sample_rate', 16000)),
+        endpointing_ms=int(params.get('endpointing', 10)),
+        utterance_end_ms=int(params.get('utterance_end_ms', 1000)),
+        interim=params.get('interim_results') == 'true',
+        vad_events=params.get('vad_events') == 'true',
+    )
+    try:
+        async for message in ws:
+            if isinstance(message, bytes):
+                await stream.feed(message)
+                if drop_after and stream.vad.audio_ms >= drop_after * 1000:
+                    await ws.close(code=1011, reason="fake drop")
+                    break
+                continue
+            control = json.loads(message)
+            if control.get('type') == 'CloseStream':
+                await stream._send({"type": "Metadata", "duration": stream.vad.audio_ms / 1000.0})
+                break
+    except websockets.ConnectionClosed:
+        pass
+
+
+async def serve(host: str = '127.0.0.1', port: int = 8765, script: Optional[List[str]] = None,
+                drop_after: Optional[float] = None):
+    """Запускает стенд в текущем цикле и возвращает объект сервера"""
+    phrases = script or DEFAULT_SCRIPT
+    server = await websockets.serve(lambda ws, *args: _handle(ws, phrases, drop_after), host, port)
+    logging.info(f"[FAKE DG] Стенд Deepgram слушает ws://{host}:{port}/v1/listen")
+    return server
+
+
+def serve_in_thread(host: str = '127.0.0.1', port: int = 8765, script: Optional[List[str]] = None,
+                    drop_after: Optional[float] = None) -> str:
+    """
+    Запускает стенд в отдельном потоке со своим циклом.
+
+    Returns:
+        str: URL для DEEPGRAM_URL
+    """
+    ready = threading.Event()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(serve(host, port, script, drop_after))
+        ready.set()
+        loop.run_forever()
+    threading.Thread(target=run, name="fake_deepgram", daemon=True).start()
+    ready.wait()
+    return f"ws://{host}:{port}/v1/listen"
+
+
+def load_script(path: str) -> List[str]:
+    """Сценарий: по одной реплике на строку"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный стенд Deepgram listen API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--script', help="Файл с репликами, по одной на строку")
+    parser.add_argument('--drop-after', type=float, help="Обрывать соединение через N секунд аудио")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    async def run():
+        await serve(args.host, args.port, load_script(args.script) if args.script else None, args.drop_after)
+        await asyncio.Future()
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Общий asyncio-цикл ввода-вывода.
+
+Один долгоживущий поток обслуживает websocket-соединения STT всех звонков:
+отправка аудио, приём расшифровок и обработка реплик выполняются как
+задачи этого цикла. Потоки pjsua и другие потоки передают в цикл работу
+через submit() и call_soon(). Запросы к LLM (общий клиент llm.groq_client)
+тоже выполняются в этом цикле.
+"""
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Callable, Coroutine, Optional
+
+
+class IoLoop:
+    def __init__(self, name: str = "stt_io"):
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self) -> "IoLoop":
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.set_exception_handler(self._handle_exception)
+        logging.info(f"[IO] Цикл {self.name} запущен")
+        self.loop.run_forever()
+
+    @staticmethod
+    def _handle_exception(loop, context) -> None:
+        logging.error(f"[IO] Необработанная ошибка в задаче: {context.get('message')}",
+                      exc_info=context.get('exception'))
+
+    def submit(self, coro: Coroutine) -> Future:
+        """Запускает корутину в цикле. Безопасно вызывать из любого потока."""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, fn: Callable, *args) -> None:
+        """Выполняет fn в потоке цикла. Безопасно вызывать из любого потока."""
+        self.start()
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def in_loop_thread(self) -> bool:
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+_io_loop: Optional[IoLoop] = None
+_io_loop_lock = threading.Lock()
+
+
+def get_io_loop() -> IoLoop:
+    global _io_loop
+    with _io_loop_lock:
+        if _io_loop is None:
+            _io_loop = IoLoop()
+        return _io_loop
@@ -0,0 +1,98 @@
+"""
+Локальный детектор речи и конца реплики по PCM звонка.
+
+Энергия считается векторно (NumPy) сразу по всем 10-мс кадрам пачки,
+порог адаптируется к уровню шума линии. Детектор позволяет запустить
+ответ агента, как только финальная расшифровка уже получена, а клиент
+молчит дольше порога, не дожидаясь UtteranceEnd от Deepgram
+(utterance_end_ms=1000 даёт задержку не меньше секунды).
+"""
+
+import os
+from typing import Dict
+
+import numpy as np
+
+from llm.funnel_config import FUNNEL_STAGES
+
+FRAME_MS = 10
+# Минимальная энергия речи (RMS, int16) и превышение над шумом
+MIN_SPEECH_RMS = 300.0
+SPEECH_TO_NOISE = 3.0
+# Сколько подряд речевых кадров считается началом речи
+MIN_SPEECH_MS = 120
+
+# Пауза, после которой реплика считается законченной, если вопрос воронки
+# не задаёт свою (поле endpointing_ms в funnel_config)
+DEFAULT_TURN_SILENCE_MS = int(os.getenv('LOCAL_ENDPOINTING_MS', '500'))
+# Перебивание агента по локальной энергии, не дожидаясь SpeechStarted от Deepgram
+LOCAL_BARGE_IN = os.getenv('LOCAL_BARGE_IN', '0') == '1'
+
+_question_silence_ms: Dict[int, int] = {
+    q['id']: q['endpointing_ms']
+    for stage in FUNNEL_STAGES
+    for q in stage['questions']
+    if q.get('endpointing_ms')
+}
+
+
+def get_turn_silence_ms(session) -> int:
+    """Порог тишины конца реплики для текущего вопроса воронки звонка"""
+    question_id = session.current_question_id if session is not None else None
+    return _question_silence_ms.get(question_id, DEFAULT_TURN_SILENCE_MS)
+
+
+class LocalVad:
+    def __init__(self, sample_rate: int = 16000):
+        self.sample_rate = sample_rate
+        self.frame_samples = sample_rate * FRAME_MS // 1000
+        self._remainder = np.zeros(0, dtype=np.int16)
+        self.noise_floor = MIN_SPEECH_RMS / SPEECH_TO_NOISE
+        self.in_speech = False
+        self._speech_run_ms = 0
+        self.trailing_silence_ms = 0
+        self.audio_ms = 0  # сколько аудио обработано с начала звонка
+
+    def feed(self, pcm: bytes) -> bool:
+        """
+        Обрабатывает пачку PCM 16 бит моно.
+
+        Returns:
+            True, если в этой пачке началась речь
+        """
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        if self._remainder.size:
+            samples = np.concatenate((self._remainder, samples))
+        n = samples.size // self.frame_samples
+        self._remainder = samples[n * self.frame_samples:]
+        if n == 0:
+            return False
+
+        frames = samples[:n * self.frame_samples].reshape(n, self.frame_samples).astype(np.float32)
+        rms = np.sqrt(np.mean(frames * frames, axis=1))
+        threshold = max(MIN_SPEECH_RMS, self.noise_floor * SPEECH_TO_NOISE)
+        voiced = rms > threshold
+
+        # Уровень шума отслеживаем по кадрам без речи
+        silent_rms = rms[~voiced]
+        if silent_rms.size:
+            self.noise_floor = 0.9 * self.noise_floor + 0.1 * float(np.median(silent_rms))
+
+        started = False
+        for is_voiced in voiced:
+            if is_voiced:
+                self._speech_run_ms += FRAME_MS
+                self.trailing_silence_ms = 0
+                if not self.in_speech and self._speech_run_ms >= MIN_SPEECH_MS:
+                    self.in_speech = True
+                    started = True
+            else:
+                self._speech_run_ms = 0
+                self.trailing_silence_ms += FRAME_MS
+                if self.in_speech and self.trailing_silence_ms >= MIN_SPEECH_MS:
+                    self.in_speech = False
+        self.audio_ms += n * FRAME_MS
+        return started
+
+    def silence_reached(self, silence_ms: int) -> bool:
+        return not self.in_speech and self.trailing_silence_ms >= silence_ms
@@ -0,0 +1,216 @@
+"""
+Пул заранее открытых соединений с Deepgram.
+
+TLS и websocket-рукопожатие занимают сотни миллисекунд, поэтому соединения
+открываются заранее и поддерживаются сообщениями KeepAlive. При ответе на
+звонок сессия берётся из пула мгновенно, а пул пополняется в фоне.
+Фоновый поток также проверяет соединения и заменяет закрытые и слишком старые.
+
+Если Deepgram не настроен или несколько подключений подряд не удались,
+звонки получают сессию резервного движка (STT_FALLBACK, по умолчанию
+офлайн-распознавание Vosk).
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import metrics
+from config import MAX_CALLS
+from stt.base import STTSession, RATE
+from stt.deepgram_stt import DeepgramSTTSession, DEEPGRAM_API_KEY
+
+STT_POOL_SIZE = int(os.getenv('STT_POOL_SIZE', str(MAX_CALLS)))
+# Соединения на 8 кГц для узкополосных звонков (PCMU/PCMA), см. Call.start_audio_streaming.
+# Этот запас открывается только после первого узкополосного звонка: на
+# широкополосных транках простаивающие соединения на 8 кГц не нужны
+NARROWBAND_RATE = 8000
+STT_POOL_NARROWBAND_SIZE = int(os.getenv('STT_POOL_NARROWBAND_SIZE', str(max(1, MAX_CALLS // 2))))
+HEALTH_CHECK_INTERVAL = 5.0
+# Соединения старше этого срока переоткрываются, не дожидаясь разрыва сервером
+MAX_IDLE_SECONDS = 300.0
+# Пауза после неудачного подключения, чтобы не долбить API
+RETRY_DELAY = 2.0
+# Основной движок ('deepgram' или 'vosk') и резервный ('' — без резерва)
+STT_BACKEND = os.getenv('STT_BACKEND', 'deepgram')
+STT_FALLBACK = os.getenv('STT_FALLBACK', 'vosk')
+# Столько неудачных подключений подряд — и звонки переключаются на резервный движок
+FAILOVER_AFTER_ERRORS = 3
+
+
+def create_stt_session(backend: str, call_id=None, sample_rate: int = RATE) -> STTSession:
+    """Создает неподключённую сессию движка backend"""
+    if backend == 'vosk':
+        from stt.vosk_stt import VoskSTTSession
+        return VoskSTTSession(call_id=call_id, sample_rate=sample_rate)
+    return DeepgramSTTSession(call_id=call_id, sample_rate=sample_rate)
+
+
+def _fallback_available() -> bool:
+    if STT_FALLBACK == 'vosk':
+        from stt.vosk_stt import is_available
+        return is_available()
+    return bool(STT_FALLBACK)
+
+
+class STTConnectionPool:
+    def __init__(self, size: int = STT_POOL_SIZE, narrowband_size: int = STT_POOL_NARROWBAND_SIZE):
+        # Отдельный запас соединений на каждую частоту дискретизации
+        self.sizes = {
+            RATE: max(0, min(size, MAX_CALLS)),
+            NARROWBAND_RATE: 0,
+        }
+        self._narrowband_size = max(0, min(narrowband_size, MAX_CALLS))
+        self._idle: Dict[int, deque] = {rate: deque() for rate in self.sizes}  # (session, opened_at)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._consecutive_failures = 0
+
+    def start(self) -> "STTConnectionPool":
+        if STT_BACKEND != 'deepgram' or not DEEPGRAM_API_KEY:
+            return self
+        if (any(self.sizes.values()) or self._narrowband_size) and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="stt_pool", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._wake.set()
+        with self._lock:
+            idle = [entry for queue in self._idle.values() for entry in queue]
+            for queue in self._idle.values():
+                queue.clear()
+        for session, _ in idle:
+            session.close()
+
+    def deepgram_available(self) -> bool:
+        return (STT_BACKEND == 'deepgram' and bool(DEEPGRAM_API_KEY)
+                and self._consecutive_failures < FAILOVER_AFTER_ERRORS)
+
+    def acquire(self, call_id, sample_rate: int = RATE) -> STTSession:
+        """
+        Выдаёт звонку подключённую сессию из пула. Если пул пуст, возвращает
+        новую неподключённую сессию — её нужно подключить через connect().
+        При недоступности Deepgram возвращает сессию резервного движка.
+        """
+        if STT_BACKEND != 'deepgram':
+            return create_stt_session(STT_BACKEND, call_id, sample_rate)
+        if not self.deepgram_available() and _fallback_available():
+            logging.warning(f"[STT POOL] Deepgram недоступен, звонок {call_id} использует {STT_FALLBACK}")
+            metrics.inc('stt_pool.failover')
+            return create_stt_session(STT_FALLBACK, call_id, sample_rate)
+        session = None
+        with self._lock:
+            if sample_rate == NARROWBAND_RATE and not self.sizes[NARROWBAND_RATE] and self._narrowband_size:
+                logging.info(f"[STT POOL] Первый узкополосный звонок: держим {self._narrowband_size} "
+                             f"соединений на {NARROWBAND_RATE} Гц")
+                self.sizes[NARROWBAND_RATE] = self._narrowband_size
+            idle = self._idle.get(sample_rate, ())
+            while idle:
+                candidate, _ = idle.popleft()
+                if candidate.is_healthy():
+                    session = candidate
+                    break
+                candidate.close()
+        self._wake.set()
+        if session is None:
+            metrics.inc('stt_pool.misses')
+            return DeepgramSTTSession(call_id=call_id, sample_rate=sample_rate)
+        metrics.inc('stt_pool.hits')
+        session.call_id = call_id
+        return session
+
+    def release(self, session: STTSession) -> None:
+        """Возвращает в пул сессию, которую звонок так и не начал использовать"""
+        with self._lock:
+            idle = self._idle.get(session.sample_rate)
+            if (isinstance(session, DeepgramSTTSession) and session.is_healthy()
+                    and idle is not None and len(idle) < self.sizes[session.sample_rate]):
+                session.call_id = None
+                idle.append((session, time.monotonic()))
+                return
+        session.close()
+
+    def connect_failed(self, session: STTSession) -> Optional[STTSession]:
+        """
+        Учитывает неудачное подключение сессии звонка наравне с подключениями
+        самого пула и возвращает для этого звонка неподключённую сессию
+        резервного движка (None, если резерва нет).
+        """
+        session.close()
+        if isinstance(session, DeepgramSTTSession):
+            self._consecutive_failures += 1
+            metrics.inc('stt_pool.connect_errors')
+            logging.error(f"[STT POOL] Звонок {session.call_id} не смог подключиться к Deepgram "
+                          f"({self._consecutive_failures} подряд)")
+        if session.name == STT_FALLBACK or not _fallback_available():
+            return None
+        metrics.inc('stt_pool.failover')
+        return create_stt_session(STT_FALLBACK, session.call_id, session.sample_rate)
+
+    def idle_count(self, sample_rate: int = RATE) -> int:
+        with self._lock:
+            return len(self._idle.get(sample_rate, ()))
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        stale = []
+        with self._lock:
+            for rate, idle in self._idle.items():
+                alive = deque()
+                for session, opened_at in idle:
+                    if session.is_healthy() and now - opened_at < MAX_IDLE_SECONDS:
+                        alive.append((session, opened_at))
+                    else:
+                        stale.append(session)
+                self._idle[rate] = alive
+        for session in stale:
+            session.close()
+
+    def _fill(self, sample_rate: int) -> bool:
+        """Дополняет запас соединений частоты sample_rate; False при ошибке подключения"""
+        while not self._stopped and self.idle_count(sample_rate) < self.sizes[sample_rate]:
+            session = DeepgramSTTSession(sample_rate=sample_rate)
+            try:
+                session.connect()
+            except Exception as e:
+                self._consecutive_failures += 1
+                logging.error(f"[STT POOL] Не удалось открыть соединение "
+                              f"({self._consecutive_failures} подряд): {e}")
+                session.close()
+                return False
+            if self._consecutive_failures >= FAILOVER_AFTER_ERRORS:
+                logging.info("[STT POOL] Deepgram снова доступен")
+            self._consecutive_failures = 0
+            with self._lock:
+                self._idle[sample_rate].append((session, time.monotonic()))
+        return True
+
+    def _run(self) -> None:
+        logging.info(f"[STT POOL] Пул соединений Deepgram: {self.sizes}")
+        while not self._stopped:
+            self._wake.clear()
+            self._prune()
+            for sample_rate in self.sizes:
+                if not self._fill(sample_rate):
+                    time.sleep(RETRY_DELAY)
+                    break
+            self._wake.wait(HEALTH_CHECK_INTERVAL)
+
+
+_pool: Optional[STTConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_stt_pool() -> STTConnectionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = STTConnectionPool()
+        return _pool
@@ -0,0 +1,92 @@
+"""
+Офлайн-распознавание речи на CPU (Vosk, русская модель).
+
+Используется как резерв при недоступности Deepgram и для прогона пайплайна
+без сети. Модель загружается один раз на процесс; распознавание идёт в пуле
+потоков, чтобы не блокировать общий цикл ввода-вывода. Vosk не присылает
+событий начала речи и конца реплики — их даёт локальный детектор речи.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import MAX_CALLS
+from stt.base import STTSession, RATE
+
+try:
+    import vosk
+except ImportError:
+    vosk = None
+
+VOSK_MODEL_PATH = os.getenv('VOSK_MODEL_PATH', os.path.join(os.path.dirname(__file__), '..', 'models', 'vosk-model-small-ru-0.22'))
+# Тишина после финального фрагмента, после которой реплика считается законченной
+# (аналог utterance_end_ms Deepgram)
+UTTERANCE_END_MS = 1000
+
+_model = None
+_model_lock = threading.Lock()
+_recognize_pool = ThreadPoolExecutor(max_workers=MAX_CALLS, thread_name_prefix="vosk")
+
+
+def is_available() -> bool:
+    return vosk is not None and os.path.isdir(VOSK_MODEL_PATH)
+
+
+def _get_model():
+    global _model
+    with _model_lock:
+        if _model is None:
+            if vosk is None:
+                raise RuntimeError('Пакет vosk не установлен')
+            vosk.SetLogLevel(-1)
+            _model = vosk.Model(VOSK_MODEL_PATH)
+            logging.info(f"[VOSK] Модель загружена: {VOSK_MODEL_PATH}")
+        return _model
+
+
+class VoskSTTSession(STTSession):
+    name = 'vosk'
+    server_vad = False
+
+    def __init__(self, call_id=None, sample_rate=RATE):
+        super().__init__(call_id, sample_rate)
+        self._recognizer = None
+        self._last_partial = ''
+        self._utterance_open = False  # был финальный фрагмент, конец реплики ещё не отправлен
+
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        model = await loop.run_in_executor(_recognize_pool, _get_model)
+        self._recognizer = vosk.KaldiRecognizer(model, self.sample_rate)
+        self.connected_event.set()
+
+    def _accept(self, chunk: bytes):
+        # Выполняется в пуле: возвращает (финальный текст, промежуточный текст)
+        if self._recognizer.AcceptWaveform(chunk):
+            return json.loads(self._recognizer.Result()).get('text', ''), None
+        return None, json.loads(self._recognizer.PartialResult()).get('partial', '')
+
+    async def _run_streaming(self):
+        loop = asyncio.get_running_loop()
+        async for chunk in self._audio_chunks():
+            self._process_local_vad(chunk)
+            final, partial = await loop.run_in_executor(_recognize_pool, self._accept, chunk)
+            if final is not None:
+                self._last_partial = ''
+                if final:
+                    self._utterance_open = True
+                self._on_final(final)
+            elif partial != self._last_partial:
+                self._last_partial = partial
+                self._on_interim(partial)
+            if self._utterance_open and self.vad.silence_reached(UTTERANCE_END_MS):
+                self._utterance_open = False
+                self._on_utterance_end()
+        if self._recognizer is not None:
+            final = json.loads(self._recognizer.FinalResult()).get('text', '')
+            if final:
+                self._on_final(final)
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def history_dir(tmp_path, monkeypatch):
+    """Каталог истории диалогов во временной папке и пустой реестр открытых историй"""
+    import llm.dialog_history as dialog_history
+    monkeypatch.setattr(dialog_history, 'HISTORY_DIR', str(tmp_path))
+    monkeypatch.setattr(dialog_history, '_open', {})
+    return tmp_path
+
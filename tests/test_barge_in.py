@@ -0,0 +1,103 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from llm.dialog_history import open_dialog_history
+from llm.groq_agent import GroqAgent
+from sip.barge_in import handle_barge_in
+from sip.session import AgentTurn, create_session, remove_session
+from stt.io_loop import get_io_loop
+from tts.elevenlabs_tts import ElevenLabsTTS
+
+
+class _HangingClient:
+    """Клиент Groq, запросы которого не отвечают, пока их не отменят"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.requests = []
+        self.cancelled = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model, messages, stream, **params):
+        self.requests.append(model)
+        self.started.set()
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            self.cancelled.append(model)
+            raise
+
+
+def test_barge_in_cancels_llm_request(history_dir):
+    """Перебивание отменяет запрос к LLM, который ещё ждёт первого токена"""
+    client = _HangingClient()
+    agent = GroqAgent.__new__(GroqAgent)
+    agent.client = client
+    agent.instructions = agent.system_prompt = 'Отвечай кратко'
+    agent.model, agent.fallback_model = 'test-hanging-primary', 'test-hanging-fallback'
+
+    session = create_session(7001, call=SimpleNamespace())
+    session.lead_id = '42'
+    session.history = open_dialog_history('42', session)
+    try:
+        reply = get_io_loop().submit(agent.process_async('Алло', 7001))
+        assert client.started.wait(timeout=2)
+
+        assert handle_barge_in(7001) == 0.0
+        assert reply.result(timeout=2) == ''
+        assert client.cancelled and sorted(client.cancelled) == sorted(client.requests)
+        assert session.history.snapshot() == [{"role": "user", "content": "Алло"}]
+    finally:
+        remove_session(7001)
+
+
+class _StallingHandler(BaseHTTPRequestHandler):
+    """Отвечает заголовками и не присылает ни одного байта аудио"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.wfile.flush()
+        self.server.released.wait(timeout=10)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_cancel_aborts_tts_waiting_for_audio():
+    """Отмена реплики прерывает запрос TTS, ожидающий первых байтов аудио"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StallingHandler)
+    server.released = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    tts = ElevenLabsTTS(api_key='test')
+    tts.base_url = f"http://127.0.0.1:{server.server_port}"
+    turn = AgentTurn(1, 'Алло')
+    done = threading.Event()
+    results = []
+
+    def on_done(ok):
+        results.append(ok)
+        done.set()
+
+    try:
+        tts.text_to_speech_stream_async('Здравствуйте!', lambda chunk: None, on_done,
+                                        cancel_event=turn.cancelled, on_cancel=turn.on_cancel)
+        # Ждём, пока поток синтеза подпишется на отмену
+        for _ in range(200):
+            if turn._on_cancel:
+                break
+            threading.Event().wait(0.01)
+        assert turn._on_cancel
+
+        turn.cancel()
+        assert done.wait(timeout=2)
+        assert results == [False]
+        assert not turn._on_cancel
+    finally:
+        server.released.set()
+        server.shutdown()
+        server.server_close()
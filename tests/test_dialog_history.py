@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+import llm.dialog_history as dialog_history
+from llm.dialog_history import open_dialog_history, close_dialog_history
+
+
+def _wait_compaction():
+    dialog_history._compact_pool.submit(lambda: None).result(timeout=2)
+
+
+def test_history_compacted_after_last_call(history_dir):
+    first, second = object(), object()
+    history = open_dialog_history('42', first)
+    assert open_dialog_history('42', second) is history
+    history.append({"role": "user", "content": "Алло"})
+
+    close_dialog_history(history, first)
+    # Повторное закрытие тем же звонком не освобождает историю второго звонка
+    close_dialog_history(history, first)
+    _wait_compaction()
+    assert dialog_history._open.get('42') is history
+    assert os.path.exists(history.journal_path)
+
+    close_dialog_history(history, second)
+    _wait_compaction()
+    assert '42' not in dialog_history._open
+    assert not os.path.exists(history.journal_path)
+    assert dialog_history.DialogHistory('42').load().messages == [{"role": "user", "content": "Алло"}]
+
+
+def test_hangup_closes_history(history_dir, monkeypatch):
+    """Постобработка после DISCONNECTED освобождает историю звонка и сворачивает журнал"""
+    pytest.importorskip('pjsua2')
+    import llm.post_call_processor
+    import sip.call
+    from sip.session import CallSession
+
+    processed = []
+    monkeypatch.setattr(llm.post_call_processor, 'process_call_end',
+                        lambda lead_id, messages: processed.append((lead_id, messages)))
+    monkeypatch.setattr(sip.call, 'schedule_summary', lambda history: None)
+
+    session = CallSession(1)
+    session.lead_id = '42'
+    session.history = open_dialog_history('42', session)
+    session.history.append({"role": "user", "content": "Алло"},
+                           {"role": "assistant", "content": "Здравствуйте!"})
+    call = sip.call.Call.__new__(sip.call.Call)
+    call.session = session
+
+    call._start_post_call_processing()
+    _wait_compaction()
+
+    assert processed and processed[0][0] == '42'
+    assert '42' not in dialog_history._open
+    assert not os.path.exists(session.history.journal_path)
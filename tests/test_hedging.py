@@ -0,0 +1,69 @@
+import asyncio
+from types import SimpleNamespace
+
+import metrics
+import llm.hedging as hedging
+from llm.hedging import hedged_stream, ttft_budget_ms
+
+
+class _FakeStream:
+    def __init__(self, delay, text):
+        self.delay = delay
+        self.text = text
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.delay)
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=self.text))])
+
+
+class _FakeClient:
+    """Клиент Groq, у которого время до первого токена задаётся для каждой модели"""
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model, messages, stream, **params):
+        return _FakeStream(self.delays[model](), model)
+
+
+async def _reply(client, primary, fallback):
+    return ''.join([delta async for delta in hedged_stream(client, [], primary, fallback)])
+
+
+def test_budget_steady_when_primary_slow(monkeypatch):
+    monkeypatch.setattr(hedging, 'HEDGE_DEFAULT_MS', 60.0)
+    monkeypatch.setattr(hedging, 'HEDGE_MIN_MS', 5.0)
+    monkeypatch.setattr(hedging, 'HEDGE_MIN_SAMPLES', 5)
+    primary, fallback = 'test-slow-primary', 'test-fallback'
+    calls = iter(range(1000))
+    # Основная модель почти всегда отвечает дольше бюджета, изредка — быстро
+    client = _FakeClient({
+        primary: lambda: 0.005 if next(calls) % 5 == 0 else 10.0,
+        fallback: lambda: 0.005,
+    })
+
+    async def run():
+        return [await _reply(client, primary, fallback) for _ in range(30)]
+
+    replies = asyncio.run(run())
+
+    assert fallback in replies
+    assert metrics.histogram_count(hedging.ttft_metric(primary)) == 30
+    # Отменённые запросы учтены не меньше чем по бюджету: бюджет не сползает к минимуму
+    assert ttft_budget_ms(primary) >= 60.0
+
+
+def test_fast_primary_is_not_hedged():
+    primary, fallback = 'test-fast-primary', 'test-fallback-unused'
+    client = _FakeClient({primary: lambda: 0.001, fallback: lambda: 0.001})
+    hedges = metrics.get_counter('llm.hedges')
+
+    assert asyncio.run(_reply(client, primary, fallback)) == primary
+    assert metrics.get_counter('llm.hedges') == hedges
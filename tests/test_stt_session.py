@@ -0,0 +1,24 @@
+import asyncio
+
+from stt.base import STTSession
+
+
+def test_stale_audio_generator_keeps_new_waker():
+    """Генератор аудио старого соединения, закрытый после переподключения, не снимает waker нового"""
+    session = STTSession(call_id=1)
+
+    async def run():
+        session.loop = asyncio.get_running_loop()
+        old = session._audio_chunks()
+        session.feed_audio(b'\x00\x00' * 160)
+        await old.__anext__()
+        new = session._audio_chunks()
+        session.feed_audio(b'\x00\x00' * 160)
+        await new.__anext__()
+        # Старый генератор завершается последним (например, при сборке мусора)
+        await old.aclose()
+        assert session.audio._waker is not None
+        await new.aclose()
+        assert session.audio._waker is None
+
+    asyncio.run(run())
@@ -2,7 +2,8 @@ import os
 import requests
 import time
 import logging
-from typing import Optional
+import socket
+from typing import Optional, Callable
 import threading
 from pathlib import Path
 import subprocess
@@ -11,12 +12,40 @@ import subprocess
 TMP_DIR = Path("/tmp/pjsua_tts")
 TMP_DIR.mkdir(exist_ok=True)
 
+# 20 мс PCM 16 кГц: достаточно мелко, чтобы начать воспроизведение сразу
+STREAM_CHUNK_BYTES = 640
+
+
+def _abort_response(response) -> None:
+    """
+    Прерывает чтение ответа из другого потока: после shutdown сокета
+    заблокированное ожидание байтов сервера сразу завершается.
+    """
+    # requests -> urllib3 -> http.client -> socket.SocketIO: у соединения сокета
+    # может уже не быть (Connection: close), у потока ответа он есть всегда
+    fp = getattr(getattr(response.raw, '_fp', None), 'fp', None)
+    sock = getattr(getattr(fp, 'raw', None), '_sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
 class ElevenLabsTTS:
     def __init__(self, api_key: Optional[str] = None):
         self.api_key = api_key or os.getenv('ELEVENLABS_API_KEY')
         self.voice_id = "wqS2JTzjt7fARO3ZxCVZ"
         self.model_id = "eleven_flash_v2_5"
         self.base_url = "https://api.elevenlabs.io"
+        self.voice_settings = {
+            "stability": 0.6,
+            "speed": 1.07,
+            "similarity_boost": 0.9,
+            "style": 0,
+            "use_speaker_boost": False,
+        }
+        # Постоянное HTTP-соединение экономит TLS-рукопожатие на каждой реплике
+        self.session = requests.Session()
         
         if not self.api_key:
             raise ValueError("ElevenLabs API key не найден в переменных окружения")
@@ -54,18 +83,12 @@ class ElevenLabsTTS:
         data = {
             "text": text,
             "model_id": self.model_id,
-            "voice_settings": {
-                "stability": 0.6,
-                "speed": 1.07,
-                "similarity_boost": 0.9,
-                "style": 0,
-                "use_speaker_boost": False,
-            }
+            "voice_settings": self.voice_settings
         }
         
         try:
             start_time = time.time()
-            response = requests.post(url, headers=headers, params=params, json=data, timeout=10)
+            response = self.session.post(url, headers=headers, params=params, json=data, timeout=10)
             
             if response.status_code == 200:
                 # Генерируем уникальное имя файла
@@ -113,6 +136,112 @@ class ElevenLabsTTS:
             logging.error(f"[TTS] Неожиданная ошибка TTS: {e}")
             return None
 
+    def text_to_speech_stream(self, text: str, on_chunk: Callable[[bytes], None],
+                              sample_rate: int = 16000,
+                              cancel_event: Optional[threading.Event] = None,
+                              on_cancel: Optional[Callable] = None) -> bool:
+        """
+        Синтезирует речь потоково и отдает сырой PCM по мере получения байтов
+        
+        Args:
+            text: Текст для озвучки
+            on_chunk: Функция, получающая чанки PCM 16 бит моно
+            sample_rate: Частота дискретизации PCM
+            cancel_event: Событие отмены; при его установке поток прерывается
+            on_cancel: Подписка на отмену (AgentTurn.on_cancel): отмена прерывает
+                и ожидание ответа сервера, а не только чтение следующего чанка
+            
+        Returns:
+            True, если поток был получен полностью
+        """
+        if not text.strip():
+            logging.warning("[TTS] Пустой текст для озвучки")
+            return False
+            
+        url = f"{self.base_url}/v1/text-to-speech/{self.voice_id}/stream"
+        
+        headers = {
+            "xi-api-key": self.api_key,
+            "Content-Type": "application/json"
+        }
+        
+        params = {
+            "output_format": f"pcm_{sample_rate}",
+            "optimize_streaming_latency": 4
+        }
+        
+        data = {
+            "text": text,
+            "model_id": self.model_id,
+            "voice_settings": self.voice_settings
+        }
+        
+        try:
+            start_time = time.time()
+            first_chunk_time = None
+            total_bytes = 0
+            with self.session.post(url, headers=headers, params=params, json=data,
+                                   stream=True, timeout=10) as response:
+                if response.status_code != 200:
+                    logging.error(f"[TTS] Ошибка API ElevenLabs: {response.status_code} - {response.text}")
+                    return False
+                unsubscribe = on_cancel(lambda: _abort_response(response)) if on_cancel else None
+                try:
+                    for chunk in response.iter_content(chunk_size=STREAM_CHUNK_BYTES):
+                        if cancel_event is not None and cancel_event.is_set():
+                            logging.info(f"[TTS] Поток прерван после {total_bytes} байт")
+                            return False
+                        if not chunk:
+                            continue
+                        if first_chunk_time is None:
+                            first_chunk_time = time.time() - start_time
+                            logging.info(f"[TTS] Первые байты аудио через {first_chunk_time * 1000:.0f} мс")
+                        total_bytes += len(chunk)
+                        on_chunk(chunk)
+                finally:
+                    if unsubscribe:
+                        unsubscribe()
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info(f"[TTS] Поток прерван после {total_bytes} байт")
+                return False
+            duration = time.time() - start_time
+            logging.info(f"[TTS] Поток завершен: {total_bytes} байт (время: {duration:.2f}с)")
+            return True
+        except requests.RequestException as e:
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info("[TTS] Запрос прерван отменой реплики")
+                return False
+            logging.error(f"[TTS] Ошибка сети при потоковом синтезе: {e}")
+            return False
+        except Exception as e:
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info("[TTS] Запрос прерван отменой реплики")
+                return False
+            logging.error(f"[TTS] Неожиданная ошибка потокового TTS: {e}")
+            return False
+
+    def text_to_speech_stream_async(self, text: str, on_chunk: Callable[[bytes], None],
+                                    on_done: Optional[Callable[[bool], None]] = None,
+                                    cancel_event: Optional[threading.Event] = None,
+                                    on_cancel: Optional[Callable] = None) -> None:
+        """
+        Потоковый синтез в отдельном потоке
+        
+        Args:
+            text: Текст для озвучки
+            on_chunk: Функция, получающая чанки PCM
+            on_done: Функция обратного вызова с результатом (True/False)
+            cancel_event: Событие отмены синтеза
+            on_cancel: Подписка на отмену синтеза
+        """
+        def worker():
+            ok = self.text_to_speech_stream(text, on_chunk, cancel_event=cancel_event, on_cancel=on_cancel)
+            if on_done:
+                on_done(ok)
+                
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+
     def text_to_speech_async(self, text: str, callback=None) -> None:
         """
         Асинхронное преобразование текста в аудио
@@ -148,3 +277,12 @@ def text_to_speech_async(text: str, callback=None) -> None:
     """Удобная функция для асинхронного TTS"""
     tts = get_tts_instance()
     tts.text_to_speech_async(text, callback)
+
+
+def text_to_speech_stream_async(text: str, on_chunk: Callable[[bytes], None],
+                                on_done: Optional[Callable[[bool], None]] = None,
+                                cancel_event: Optional[threading.Event] = None,
+                                on_cancel: Optional[Callable] = None) -> None:
+    """Удобная функция для потокового TTS"""
+    tts = get_tts_instance()
+    tts.text_to_speech_stream_async(text, on_chunk, on_done, cancel_event, on_cancel)